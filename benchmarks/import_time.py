@@ -0,0 +1,52 @@
+"""Time the imports of the compile path.
+
+Every command of the CLI and every worker of the API pays for these imports,
+so they should stay well under a second. Each module is imported in a fresh
+interpreter, and the best of several runs is reported.
+
+    python benchmarks/import_time.py --repeat 5
+"""
+import argparse
+import subprocess
+import sys
+
+MODULES = ["omop_etl.generation", "omop_etl.schema", "omop_etl.__main__"]
+
+HEAVY = ["pandas", "fastapi", "sqlalchemy", "psycopg2", "tqdm"]
+
+SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(elapsed, ",".join(heavy))
+"""
+
+
+def time_import(module: str):
+    script = SCRIPT.format(module=module, heavy=HEAVY)
+    out = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    ).stdout.split()
+    elapsed, heavy = float(out[0]), out[1:]
+    return elapsed, heavy[0].split(",") if heavy else []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for module in MODULES:
+        runs = [time_import(module) for _ in range(args.repeat)]
+        best = min(elapsed for elapsed, _ in runs)
+        heavy = runs[0][1]
+        line = f"{module:<24} {best * 1000:8.1f} ms"
+        if heavy:
+            line += f"  imports {', '.join(heavy)}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,3 @@
+__version__ = "1.0.0"
+
 from omop_etl.schema import TargetTable
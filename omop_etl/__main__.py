@@ -1,108 +1,231 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from email.policy import default
 from pathlib import Path
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-import psycopg2
 from pydantic import ValidationError
 import typer
-from tqdm import tqdm
 
-from omop_etl.schema import REQUIRED_FIELDS, Dependency, DisabledColumn, TargetTable
+from omop_etl.bundle import is_bundle, write_bundle
+from omop_etl.cache import CompileCache
+from omop_etl.catalog import CATALOG_PATH, Catalog, load_catalog
+from omop_etl.constraints import Constraints
+from omop_etl.lint import lint_rules, render_findings
+from omop_etl.plans import (
+    Thresholds,
+    read_profiles,
+    render_estimates,
+    render_report,
+    write_profiles,
+)
+from omop_etl.project import RuleFile, iter_compile, load_rules
+from omop_etl.schema import (
+    REQUIRED_FIELDS,
+    CompileMode,
+    Dependency,
+    DisabledColumn,
+    TableStorage,
+    TargetTable,
+)
+from omop_etl.watch import IncrementalCompiler, watch as watch_rules
+from omop_etl.writer import ScriptWriter, write_if_changed
 
 
 app = typer.Typer()
 
 
-def load_rules(rules: Path) -> List[Tuple[str, TargetTable]]:
-    tables = list()
-    for fn in rules.iterdir():
-        with fn.open() as f:
-            try:
-                s = f.read()
-                name = ".".join(fn.name.split(".")[:-1])
-                tables.append((name, TargetTable.parse_string(s)))
-            except ValidationError as ex:
-                name = ".".join(fn.name.split(".")[:-1])
-                tables.append((name, Dependency.parse_string(s)))
-            except Exception as ex:
-                raise ex
-                print(f"Failed to processe: {fn}")
-    return tables
-
-
 @app.command()
 def compile(
-    rules: Path = typer.Option("rules", file_okay=False, dir_okay=True, readable=True,),
+    rules: Path = typer.Option(
+        "rules",
+        file_okay=True,
+        dir_okay=True,
+        readable=True,
+        help="Directory of rule files or bundle of rules.",
+    ),
     output: Path = typer.Option(
         "sql", file_okay=False, dir_okay=True, writable=True, readable=True,
     ),
     one_file: bool = True,
     drop_tables: bool = False,
+    fuse_updates: bool = typer.Option(
+        False, help="Merge column updates that share the same FROM and WHERE."
+    ),
+    mode: CompileMode = typer.Option(
+        CompileMode.update, help="Fill the columns with updates or insert full rows."
+    ),
+    unlogged_mapping: bool = typer.Option(
+        False, help="Create the mapping tables as unlogged tables."
+    ),
+    mapping_fillfactor: Optional[int] = typer.Option(
+        None, min=10, max=100, help="Fillfactor of the mapping tables."
+    ),
+    mapping_autovacuum: Optional[bool] = typer.Option(
+        None, help="Enable or disable autovacuum on the mapping tables."
+    ),
+    bulk_load: bool = typer.Option(
+        False, help="Create and fill each mapping table in a single transaction."
+    ),
+    index_mapping: bool = typer.Option(
+        False, help="Index and analyze the key columns of the mapping tables."
+    ),
+    chunk_size: Optional[int] = typer.Option(
+        None,
+        min=1,
+        help="Run the mapping inserts and the updates in chunks of this many keys, "
+        "committing each chunk.",
+    ),
+    constraints: Optional[List[Path]] = typer.Option(
+        None,
+        exists=True,
+        dir_okay=False,
+        help="Drop these constraints of the loaded tables before the load "
+        "and rebuild them afterwards.",
+    ),
+    incremental: bool = typer.Option(
+        False,
+        help="Only add the new keys and update the rows whose sources changed "
+        "since the last load.",
+    ),
+    prune_tables: bool = typer.Option(
+        True,
+        help="Leave the tables a column lists twice or doesn't use out of its "
+        "updates.",
+    ),
+    cache_dir: Optional[Path] = typer.Option(
+        None,
+        file_okay=False,
+        help="Keep the translated rules in this directory and only translate "
+        "the rule files that changed.",
+    ),
+    stdout: bool = typer.Option(
+        False, help="Write the script to the standard output instead of etl.sql."
+    ),
+    compress: bool = typer.Option(False, "--gzip", help="Compress the scripts."),
+    jobs: int = typer.Option(
+        1,
+        min=1,
+        help="Number of processes parsing and translating the rules of a single "
+        "script at the same time.",
+    ),
+    watch: bool = typer.Option(
+        False,
+        help="Keep compiling the rules that change, and the tables that depend "
+        "on them, until interrupted.",
+    ),
 ):
-    if not output.exists():
+    storage = {
+        "unlogged": unlogged_mapping,
+        "fillfactor": mapping_fillfactor,
+        "autovacuum_enabled": mapping_autovacuum,
+        "bulk_load": bulk_load,
+    }
+    options = {
+        "FuseUpdates": fuse_updates,
+        "Mode": mode,
+        "IndexMapping": index_mapping,
+        "ChunkSize": chunk_size,
+        "Incremental": incremental,
+        "MappingStorage": TableStorage(
+            **{k: v for k, v in storage.items() if v is not None}
+        ),
+        "PruneTables": prune_tables,
+    }
+
+    if stdout and not one_file:
+        raise typer.BadParameter("--stdout writes a single script", param_hint="stdout")
+    if watch and (stdout or jobs > 1 or is_bundle(rules)):
+        raise typer.BadParameter(
+            "--watch writes to files from a directory of rules, in one process",
+            param_hint="watch",
+        )
+    if not stdout and not output.exists():
         output.mkdir()
+    suffix = ".sql.gz" if compress else ".sql"
+
+    cache = CompileCache(cache_dir)
+    if watch:
+        if one_file:
+            options = {"DropTables": drop_tables, **options}
+        definitions = Constraints.load(constraints) if constraints else None
+        compiler = IncrementalCompiler(
+            rules, output, options, one_file, compress, definitions, cache
+        )
+        try:
+            watch_rules(compiler, typer.echo)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    files = RuleFile.load(rules, cache)
+
+    def load_constraints() -> Tuple[str, str]:
+        if not constraints:
+            return "", ""
+        names = [f.table_name for f in files if f.table_name is not None]
+        return Constraints.load(constraints).scripts(names)
+
     if not one_file:
-        for name, table in load_rules(rules):
-            out_fn = output / f"{name}.sql"
-            with out_fn.open("w") as f:
-                f.write(table.get_script())
+        pre_load, post_load = load_constraints()
+        for rule in files:
+            script = rule.translate_script(options)
+            write_if_changed(output / f"{rule.name}{suffix}", script, compress)
+        if constraints:
+            write_if_changed(output / f"pre_load{suffix}", pre_load, compress)
+            write_if_changed(output / f"post_load{suffix}", post_load, compress)
     else:
-        script = ""
-        to_process = list()
-
-        tables = load_rules(rules)
-
-        deps = filter(lambda x: not isinstance(x[-1], TargetTable), tables)
-        tables = filter(lambda x: isinstance(x[-1], TargetTable), tables)
-        envs = dict()
-        for name, table in deps:
-            print(name)
-            init, env = table.translate()
-            init = [stmt.to_sql() for stmt in init]
-            init = "\n".join(init)
-            script += f"{init}\n"
-            envs[name] = env
-
-        for name, table in tables:
-            # print(name)
-            env = table.default_env
-            env["DropTables"] = drop_tables
-            if table.depends_on is not None:
-                for dep in table.depends_on:
-                    if dep in envs:
-                        schema = envs[dep]["DefaultSchema"]
-                        if schema is not None:
-                            env["DefaultSchema"] = schema
-                        env["TempTables"] = {
-                            *env["TempTables"],
-                            *envs[dep]["TempTables"],
-                        }
-            init, env = table.get_initialization(env)
-            to_process.append((table, env))
-            script += f"{init}\n"
-
-        for table, env in to_process:
-            table: TargetTable = table
-            script += table.get_script(env=env, include_initialization=False)
-            script += "\n"
-
-        out_fn = output / "etl.sql"
-        with out_fn.open("w") as f:
-            f.write(script)
+        path = None if stdout else output / f"etl{suffix}"
+        options = {"DropTables": drop_tables, **options}
+        pool = ProcessPoolExecutor(jobs) if jobs > 1 else nullcontext()
+        with pool as executor, ScriptWriter(path, compress) as writer:
+            pieces = iter_compile(files, options, executor)
+            # every rule is described, by the workers if any, once the first
+            # piece is translated, so the tables are known without parsing them
+            first = next(pieces, "")
+            pre_load, post_load = load_constraints()
+            if pre_load:
+                writer.write(f"{pre_load}\n")
+            writer.write(first)
+            writer.write_all(pieces)
+            if post_load:
+                writer.write(f"{post_load}\n")
+
+    for rule in files:
+        for warning in rule.warnings:
+            typer.echo(f"{rule.name}: {warning}", err=True)
 
 
 @app.command()
-def execute(
+def bundle(
     rules: Path = typer.Option("rules", file_okay=False, dir_okay=True, readable=True,),
-    database: str = "postgres",
-    password: str = "password",
-    host: str = "127.0.0.1",
-    user: str = "postgres",
-    port: int = 5432,
+    output: Path = typer.Option(
+        "rules.bundle", file_okay=True, dir_okay=False, writable=True
+    ),
 ):
+    """Validate the rules once and write them to a bundle that loads quickly."""
+    write_bundle(load_rules(rules), output)
+
 
-    conn = psycopg2.connect(
+@app.command()
+def catalog(
+    schema: Path = typer.Option(
+        "schema", file_okay=False, dir_okay=True, readable=True
+    ),
+    output: Path = typer.Option(CATALOG_PATH, dir_okay=False, writable=True),
+):
+    """Parse the table definitions and constraints of the schema scripts into
+    the catalog shipped with the package."""
+    parsed = Catalog.load_scripts(sorted(schema.glob("*.sql")))
+    write_if_changed(output, parsed.to_json())
+    typer.echo(f"{len(parsed)} tables written to {output}")
+
+
+def connection_parameters(
+    database: str, password: str, host: str, user: str, port: int
+) -> Dict[str, Any]:
+    return dict(
         database=database,
         password=password,
         host=host,
@@ -112,35 +235,206 @@ def execute(
         gssencmode="disable",
     )
 
-    cur = conn.cursor()
-
-    rules_iter = load_rules(rules)
-    rules_iter = tqdm(rules_iter, desc="Tables")
-    cur.execute("SET search_path TO cerner;")
-    for _, table in rules_iter:
-        if table.name in {"location"}:
-            continue
-        rules_iter.set_postfix(table=table.name, stage="CREATE")
-        stmt = table.primary_key.create_pk_table(table.name)
-        cur.execute(stmt)
-        rules_iter.set_postfix(table=table.name, stage="INSERT")
-        for stmt in table.get_insert_statements():
-            cur.execute(stmt)
-            pass
-        conn.commit()
-        rules_iter.set_postfix(table=table.name, stage="UPDATE")
-        cols_iter = [col for col in table.columns if col.enabled]
-        cols_iter = tqdm(cols_iter, desc="Columns")
-        for col in cols_iter:
-            stmt = col.get_update_statement(table.name, table.primary_key)
-            cols_iter.set_postfix(column=col.name)
-            try:
-                cur.execute(stmt)
-            except Exception as ex:
-                rules_iter.write(f"Table: {table.name} Column '{col.name}' failed")
-                rules_iter.write(str(ex))
-                raise ex
-    conn.commit()
+
+@app.command()
+def execute(
+    rules: Path = typer.Option(
+        "rules",
+        file_okay=True,
+        dir_okay=True,
+        readable=True,
+        help="Directory of rule files or bundle of rules.",
+    ),
+    database: str = "postgres",
+    password: str = "password",
+    host: str = "127.0.0.1",
+    user: str = "postgres",
+    port: int = 5432,
+    jobs: int = typer.Option(
+        1, min=1, help="Number of connections running tables at the same time."
+    ),
+    search_path: Optional[str] = typer.Option(
+        None, help="Schemas searched for unqualified tables, after the staging one."
+    ),
+    drop_tables: bool = False,
+    fuse_updates: bool = typer.Option(
+        False, help="Merge column updates that share the same FROM and WHERE."
+    ),
+    mode: CompileMode = typer.Option(
+        CompileMode.update, help="Fill the columns with updates or insert full rows."
+    ),
+    index_mapping: bool = typer.Option(
+        False, help="Index and analyze the key columns of the mapping tables."
+    ),
+    chunk_size: Optional[int] = typer.Option(
+        None,
+        min=1,
+        help="Run the mapping inserts and the updates in chunks of this many keys, "
+        "committing each chunk.",
+    ),
+    constraints: Optional[List[Path]] = typer.Option(
+        None,
+        exists=True,
+        dir_okay=False,
+        help="Drop these constraints of the loaded tables before the load "
+        "and rebuild them afterwards.",
+    ),
+    incremental: bool = typer.Option(
+        False,
+        help="Only add the new keys and update the rows whose sources changed "
+        "since the last load.",
+    ),
+    resume: bool = typer.Option(
+        False,
+        help="Skip the statements the previous run completed, as recorded in "
+        "mapping.etl_journal.",
+    ),
+    statement_timeout: Optional[int] = typer.Option(
+        None, min=1, help="Cancel the statements running for longer, in seconds."
+    ),
+    retries: int = typer.Option(
+        0, min=0, help="Retry a task this many times after a transient error."
+    ),
+    retry_backoff: float = typer.Option(
+        1.0,
+        min=0,
+        help="Seconds to wait before the first retry, doubled for each next one.",
+    ),
+    profile: Optional[Path] = typer.Option(
+        None,
+        dir_okay=False,
+        writable=True,
+        help="Run the statements under EXPLAIN ANALYZE, store their profiles in "
+        "this file and report the slowest ones.",
+    ),
+):
+    from tqdm import tqdm
+
+    from omop_etl.execution import Executor, build_tasks
+
+    options = {
+        "DropTables": drop_tables,
+        "FuseUpdates": fuse_updates,
+        "Mode": mode,
+        "IndexMapping": index_mapping,
+        "ChunkSize": chunk_size,
+        "Incremental": incremental,
+    }
+    definitions = Constraints.load(constraints) if constraints else None
+    tasks = build_tasks(load_rules(rules), options, definitions)
+
+    connection = connection_parameters(database, password, host, user, port)
+    executor = Executor(
+        connection,
+        jobs=jobs,
+        search_path=search_path,
+        resume=resume,
+        statement_timeout=statement_timeout,
+        retries=retries,
+        backoff=retry_backoff,
+        profile=profile is not None,
+    )
+    with tqdm(total=len(tasks), desc="Tasks") as progress:
+
+        def done(task):
+            progress.set_postfix(task=task.name)
+            progress.update()
+
+        try:
+            executor.run(tasks, progress=done)
+        finally:
+            # the profiles of a failed load show what ran before it failed
+            if profile is not None:
+                write_profiles(profile, executor.profiles)
+
+    if profile is not None:
+        typer.echo(render_report(executor.profiles))
+
+
+@app.command()
+def plan(
+    rules: Path = typer.Option(
+        "rules",
+        file_okay=True,
+        dir_okay=True,
+        readable=True,
+        help="Directory of rule files or bundle of rules.",
+    ),
+    database: str = "postgres",
+    password: str = "password",
+    host: str = "127.0.0.1",
+    user: str = "postgres",
+    port: int = 5432,
+    search_path: Optional[str] = typer.Option(
+        None, help="Schemas searched for unqualified tables, after the staging one."
+    ),
+    fuse_updates: bool = typer.Option(
+        False, help="Merge column updates that share the same FROM and WHERE."
+    ),
+    mode: CompileMode = typer.Option(
+        CompileMode.update, help="Fill the columns with updates or insert full rows."
+    ),
+    incremental: bool = typer.Option(
+        False,
+        help="Only add the new keys and update the rows whose sources changed "
+        "since the last load.",
+    ),
+    max_cost: Optional[float] = typer.Option(
+        None, min=0, help="Flag the statements estimated to cost more."
+    ),
+    row_explosion: float = typer.Option(
+        10.0,
+        min=1,
+        help="Flag the joins estimated to return this many times more rows than "
+        "their largest input.",
+    ),
+    seq_scan_rows: float = typer.Option(
+        1_000_000, min=0, help="Flag the sequential scans of tables this large."
+    ),
+):
+    """Estimate the cost and the rows of every statement without running them,
+    and flag the estimates above the thresholds."""
+    from omop_etl.execution import Executor, build_tasks
+
+    options = {"FuseUpdates": fuse_updates, "Mode": mode, "Incremental": incremental}
+    tasks = build_tasks(load_rules(rules), options)
+    connection = connection_parameters(database, password, host, user, port)
+    executor = Executor(connection, search_path=search_path)
+    thresholds = Thresholds(max_cost, row_explosion, seq_scan_rows)
+    estimates = executor.explain(tasks, thresholds)
+    typer.echo(render_estimates(estimates))
+    if any(e.warnings for e in estimates):
+        raise typer.Exit(1)
+
+
+@app.command()
+def lint(
+    rules: Path = typer.Option(
+        "rules",
+        file_okay=True,
+        dir_okay=True,
+        readable=True,
+        help="Directory of rule files or bundle of rules.",
+    ),
+    catalog: Path = typer.Option(
+        CATALOG_PATH, exists=True, dir_okay=False, readable=True
+    ),
+):
+    """Check the SQL of the rules for patterns that make the load slow, without
+    a database."""
+    findings = lint_rules(load_rules(rules), load_catalog(catalog))
+    if findings:
+        typer.echo(render_findings(findings))
+        raise typer.Exit(1)
+
+
+@app.command()
+def report(
+    profile: Path = typer.Option(..., exists=True, dir_okay=False, readable=True),
+    top: int = typer.Option(20, min=1, help="Number of rules and statements shown."),
+):
+    """Rank the rules and the statements of a profile stored by ``execute``."""
+    typer.echo(render_report(read_profiles(profile), top))
 
 
 if __name__ == "__main__":
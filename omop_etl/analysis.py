@@ -0,0 +1,271 @@
+import re
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple
+
+_TOKEN = re.compile(
+    r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+    |(?P<string>'(?:[^']|'')*')
+    |(?P<name>(?:[A-Za-z_][\w$]*|"(?:[^"]|"")*")
+        (?:\.(?:[A-Za-z_][\w$]*|"(?:[^"]|"")*"|\*))*)
+    |(?P<number>\d+(?:\.\d+)?(?:e[-+]?\d+)?)
+    |(?P<cast>::)
+    |(?P<op><>|!=|<=|>=|\|\||[-+*/%=<>(),;\[\]])
+    |(?P<space>\s+)
+    |(?P<other>.)
+    """,
+    re.VERBOSE | re.DOTALL | re.IGNORECASE,
+)
+
+KEYWORDS = {
+    "all",
+    "and",
+    "any",
+    "as",
+    "asc",
+    "between",
+    "by",
+    "case",
+    "cast",
+    "cross",
+    "desc",
+    "distinct",
+    "else",
+    "end",
+    "except",
+    "exists",
+    "false",
+    "from",
+    "full",
+    "group",
+    "having",
+    "ilike",
+    "in",
+    "inner",
+    "intersect",
+    "is",
+    "join",
+    "lateral",
+    "left",
+    "like",
+    "limit",
+    "not",
+    "null",
+    "offset",
+    "on",
+    "or",
+    "order",
+    "outer",
+    "right",
+    "select",
+    "some",
+    "then",
+    "true",
+    "union",
+    "using",
+    "values",
+    "when",
+    "where",
+    "with",
+}
+
+# the words that end the FROM clause of a query
+_FROM_END = {"where", "group", "order", "limit", "having", "union", "except", "window"}
+
+
+class Token(NamedTuple):
+    kind: str
+    text: str
+    depth: int
+
+    def is_keyword(self, *words: str) -> bool:
+        return self.kind == "name" and self.text in words
+
+
+def _unquote(name: str) -> str:
+    parts = re.findall(r'"(?:[^"]|"")*"|[^.]+', name)
+    return ".".join(
+        p[1:-1].replace('""', '"') if p.startswith('"') else p.lower() for p in parts
+    )
+
+
+def tokenize(sql: str) -> List[Token]:
+    """The tokens of a fragment of SQL, with the parentheses they are within.
+
+    Names are lowercased, unless quoted, and keep their qualification.
+    """
+    tokens, depth = list(), 0
+    for match in _TOKEN.finditer(sql):
+        kind, text = match.lastgroup, match.group()
+        if kind in ("comment", "space"):
+            continue
+        if kind == "name":
+            text = _unquote(text)
+        if text == ")":
+            depth -= 1
+        tokens.append(Token(kind, text, depth))
+        if text == "(":
+            depth += 1
+    return tokens
+
+
+def qualifier(name: str) -> Optional[str]:
+    """The table qualifying a column: ``foo`` in ``foo.id`` and ``cerner.foo.id``."""
+    parts = name.split(".")
+    return parts[-2] if len(parts) > 1 else None
+
+
+def _columns(tokens: Iterable[Token]) -> Iterable[Token]:
+    return (t for t in tokens if t.kind == "name" and qualifier(t.text) is not None)
+
+
+def referenced_tables(sql: str, aliases: Iterable[str]) -> Set[str]:
+    """The tables among ``aliases`` that qualify a column of the fragment."""
+    aliases = set(aliases)
+    tables = {qualifier(t.text) for t in _columns(tokenize(sql))}
+    return tables & aliases
+
+
+def mentioned_tables(sql: str, aliases: Iterable[str]) -> Set[str]:
+    """The tables among ``aliases`` whose name appears anywhere in the fragment,
+    qualifying a column or not."""
+    aliases = set(aliases)
+    return {
+        part
+        for t in tokenize(sql)
+        if t.kind == "name"
+        for part in t.text.split(".")
+        if part in aliases
+    }
+
+
+def unqualified_names(sql: str) -> List[str]:
+    """The names of a fragment that may be columns of any of its tables: the
+    unqualified names that are neither keywords, functions nor types."""
+    tokens = tokenize(sql)
+    names = list()
+    for i, t in enumerate(tokens):
+        if t.kind != "name" or "." in t.text or t.text in KEYWORDS:
+            continue
+        if i + 1 < len(tokens) and tokens[i + 1].text == "(":
+            continue
+        if i > 0 and (tokens[i - 1].kind == "cast" or tokens[i - 1].is_keyword("as")):
+            continue
+        names.append(t.text)
+    return names
+
+
+def table_columns(sql: str, table: str) -> Set[str]:
+    """The columns of ``table`` a fragment may read: the ones it qualifies with
+    the table and the names it leaves unqualified."""
+    qualified = {
+        t.text.split(".")[-1]
+        for t in _columns(tokenize(sql))
+        if qualifier(t.text) == table.lower()
+    }
+    return qualified | set(unqualified_names(sql))
+
+
+def _split(tokens: List[Token], word: str) -> List[List[Token]]:
+    depth = tokens[0].depth if tokens else 0
+    parts, current, between = list(), list(), False
+    for t in tokens:
+        if t.depth == depth and t.is_keyword("between"):
+            between = True
+        elif t.depth == depth and t.is_keyword(word):
+            if word == "and" and between:
+                # the bounds of a between are not a conjunction
+                between = False
+            else:
+                parts.append(current)
+                current = list()
+                continue
+        current.append(t)
+    parts.append(current)
+    return [p for p in parts if p]
+
+
+def _text(tokens: List[Token]) -> str:
+    return " ".join(t.text for t in tokens)
+
+
+def conjuncts(sql: str) -> List[str]:
+    """The predicates of a fragment that are joined by a top-level AND."""
+    return [_text(p) for p in _split(tokenize(sql), "and")]
+
+
+def disjuncts(sql: str) -> List[str]:
+    """The predicates of a fragment that are joined by a top-level OR."""
+    return [_text(p) for p in _split(tokenize(sql), "or")]
+
+
+def count_or(sql: str) -> int:
+    return sum(1 for t in tokenize(sql) if t.is_keyword("or"))
+
+
+def wrapped_columns(sql: str) -> List[Tuple[str, str]]:
+    """The qualified columns passed to a function or cast, with the function or
+    ``cast``, as in ``lower(foo.name)``, ``foo.id::text`` or ``cast(foo.id as
+    text)``."""
+    tokens = tokenize(sql)
+    wrapped = list()
+    for i, t in enumerate(tokens):
+        if t.kind != "name" or qualifier(t.text) is None:
+            continue
+        if i + 1 < len(tokens) and tokens[i + 1].kind == "cast":
+            wrapped.append((t.text, "cast"))
+            continue
+        # the parenthesis the column is directly within
+        j = i - 1
+        while j >= 0 and not (tokens[j].text == "(" and tokens[j].depth < t.depth):
+            j -= 1
+        if j < 1 or tokens[j - 1].kind != "name":
+            continue
+        function = tokens[j - 1].text
+        if function == "cast":
+            wrapped.append((t.text, "cast"))
+        elif function not in KEYWORDS:
+            wrapped.append((t.text, function))
+    return wrapped
+
+
+def _from_tables(tokens: List[Token]) -> Set[str]:
+    """The names and aliases of the tables in the FROM clauses of a query."""
+    defined, expecting, in_from = set(), False, False
+    for i, t in enumerate(tokens):
+        if t.is_keyword("from"):
+            in_from, expecting = True, True
+        elif not in_from:
+            continue
+        elif t.is_keyword(*_FROM_END):
+            in_from = expecting = False
+        elif t.text == "," or t.is_keyword("join"):
+            expecting = True
+        elif t.is_keyword("on", "using"):
+            expecting = False
+        elif t.kind == "name" and t.text not in KEYWORDS:
+            if expecting:
+                defined.add(t.text.split(".")[-1])
+                expecting = False
+            elif tokens[i - 1].is_keyword("as") or tokens[i - 1].kind == "name":
+                defined.add(t.text)
+    return defined
+
+
+def subqueries(sql: str) -> List[str]:
+    """The queries between parentheses in a fragment, outermost first."""
+    tokens = tokenize(sql)
+    found = list()
+    for i, t in enumerate(tokens[:-1]):
+        if t.text == "(" and tokens[i + 1].is_keyword("select"):
+            end = i + 1
+            while end < len(tokens) and tokens[end].depth > t.depth:
+                end += 1
+            found.append(_text(tokens[i + 1 : end]))
+    return found
+
+
+def correlations(subquery: str, outer: Iterable[str]) -> Set[str]:
+    """The tables of the outer query among ``outer`` that a subquery refers to
+    and doesn't define itself."""
+    inner = _from_tables(tokenize(subquery))
+    return referenced_tables(subquery, set(outer) - inner)
@@ -1,11 +1,32 @@
+import json
+import os
+import zlib
 from dataclasses import dataclass
-from typing import List
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from fastapi import FastAPI
-from fastapi.exceptions import RequestValidationError
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError, validator
 from pydantic.error_wrappers import ErrorWrapper
 
-from omop_etl.schema import REQUIRED_FIELDS, DisabledColumn, TargetTable
+from omop_etl.bundle import read_bundle
+from omop_etl.cache import CompileCache, LRUCache
+from omop_etl.generation import Serializable
+from omop_etl.lint import Finding, lint_table
+from omop_etl.project import CompileOptions, RuleFile, iter_compile
+from omop_etl.schema import (
+    REQUIRED_FIELDS,
+    BaseModel,
+    Dependency,
+    DisabledColumn,
+    TargetTable,
+)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = FastAPI()
 
@@ -32,15 +53,227 @@ def check_columns(table: TargetTable) -> List[ErrorWrapper]:
     ]
 
 
+def check_tables(table: TargetTable) -> List[ErrorWrapper]:
+    return [
+        ErrorWrapper(ValueError(reason), ("body", "columns", i, "tables", j))
+        for i, j, reason in table.redundant_tables()
+    ]
+
+
 def table_warnings(table: TargetTable) -> List[dict]:
     col_warnings = check_columns(table)
-    warnings = [*col_warnings]
+    warnings = [*col_warnings, *check_tables(table)]
     if warnings:
-        return RequestValidationError(warnings).errors()
+        return ValidationError(warnings, TargetTable).errors()
     return list()
 
 
+# translations of the tables recently posted, by their ETag
+RESULTS = LRUCache(
+    maxsize=int(os.environ.get("OMOP_ETL_CACHE_SIZE", 256)),
+    ttl=float(os.environ.get("OMOP_ETL_CACHE_TTL", 3600)),
+)
+
+
+def table_etag(table: TargetTable) -> str:
+    """A hash of the canonical form of a table, its translation depending on
+    nothing else."""
+    canonical = table.json(by_alias=True, sort_keys=True, separators=(",", ":"))
+    return f'"{CompileCache.digest("translate", canonical)}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in ("*", etag):
+            return True
+    return False
+
+
+def translate_cached(table: TargetTable, request: Request, response: Response) -> Any:
+    """The translation of a table, or a 304 when the client already has it."""
+    etag = table_etag(table)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return RESULTS.fetch(
+        etag, lambda: Result(script=table.get_script(), warnings=table_warnings(table))
+    )
+
+
 @app.post("/api/translate")
-def translate_table(table: TargetTable) -> Result:
-    return Result(script=table.get_script(), warnings=table_warnings(table))
+def translate_table(table: TargetTable, request: Request, response: Response) -> Result:
+    return translate_cached(table, request, response)
+
+
+def translate_statements(table: TargetTable) -> List[Tuple[str, Serializable]]:
+    """The statements of a table with their phase, translated but not rendered.
+
+    The table is translated before the response starts, so that an error is
+    reported by its status rather than by a truncated body.
+    """
+    env = table.default_env
+    try:
+        statements = [
+            ("initialization", stmt)
+            for stmt in table.iter_translate(env, include_process=False)
+        ]
+        statements.extend(
+            ("process", stmt)
+            for stmt in table.iter_translate(env, include_initialization=False)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return statements
+
+
+def text_lines(statements: List[Tuple[str, Serializable]]) -> Iterator[str]:
+    # a statement can span several lines, an empty one separates them
+    for i, (_, stmt) in enumerate(statements):
+        yield f"\n{stmt.to_sql()}" if i else stmt.to_sql()
+
+
+def ndjson_lines(statements: List[Tuple[str, Serializable]]) -> Iterator[str]:
+    for i, (phase, stmt) in enumerate(statements):
+        yield json.dumps(
+            {
+                "index": i,
+                "phase": phase,
+                "kind": type(stmt).__name__,
+                "sql": stmt.to_sql(),
+            }
+        )
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """The preferred encoding the client accepts, brotli only if it's installed."""
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    weights = dict()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in supported:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress(chunks: Iterator[bytes], encoding: Optional[str]) -> Iterator[bytes]:
+    """Compress the chunks, flushing each one so the client can decode it."""
+    if encoding is None:
+        yield from chunks
+    elif encoding == "gzip":
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    else:
+        compressor = brotli.Compressor()
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+
+
+@app.post("/api/translate/stream")
+def stream_table(table: TargetTable, request: Request) -> StreamingResponse:
+    """Stream the statements of a table as they are translated.
+
+    The statements are separated by an empty line, or with an ``Accept`` of
+    ``application/x-ndjson`` each is a JSON object with its phase and its kind.
+    """
+    statements = translate_statements(table)
+    ndjson = "ndjson" in request.headers.get("accept", "")
+    lines = ndjson_lines(statements) if ndjson else text_lines(statements)
+    chunks = (f"{line}\n".encode() for line in lines)
+
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    media_type = "application/x-ndjson" if ndjson else "text/plain"
+    return StreamingResponse(
+        compress(chunks, encoding), media_type=media_type, headers=headers
+    )
+
+
+@app.post("/api/lint")
+def lint(table: TargetTable) -> List[Finding]:
+    """Check the SQL of a table for patterns that make its statements slow."""
+    return lint_table(table.name, table)
+
+
+@app.get("/api/cache")
+def cache_stats() -> Dict[str, Any]:
+    """The size of the cache of the translations and how often it was hit."""
+    return RESULTS.stats()
+
+
+class Project(BaseModel):
+    """A whole rule set, compiled as the ``compile`` command does. The rules
+    are named as their files would be."""
+
+    dependencies: Dict[str, Dependency] = dict()
+    tables: Dict[str, TargetTable]
+    options: CompileOptions = CompileOptions()
+
+    @validator("tables")
+    def check_dependencies(cls, tables, values):
+        dependencies = values.get("dependencies", dict())
+        for name, table in tables.items():
+            for dep in table.depends_on or list():
+                if dep not in dependencies:
+                    raise ValueError(f'"{name}" depends on missing "{dep}"')
+        return tables
+
+    def rule_files(self) -> List[RuleFile]:
+        rules = [*self.dependencies.items(), *self.tables.items()]
+        return RuleFile.from_rules(rules, CompileCache())
+
+
+@dataclass(eq=True, frozen=True)
+class ProjectResult:
+    script: str
+    warnings: Dict[str, List[dict]]
+
+
+@app.post("/api/compile")
+def compile_project(project: Project) -> ProjectResult:
+    """Compile the tables and their dependencies into a single script."""
+    options = project.options.environment()
+    # the translation holds the GIL, threads would only add their overhead
+    script = "".join(iter_compile(project.rule_files(), options))
+    warnings = [table_warnings(table) for table in project.tables.values()]
+    return ProjectResult(script=script, warnings=dict(zip(project.tables, warnings)))
+
+
+def load_bundle() -> Dict[str, TargetTable]:
+    path = os.environ.get("OMOP_ETL_BUNDLE")
+    if not path:
+        return dict()
+    rules = read_bundle(Path(path))
+    return {r.name: r for _, r in rules if isinstance(r, TargetTable)}
+
+
+BUNDLE = load_bundle()
+
+
+@app.get("/api/tables/{name}")
+def translate_bundled_table(name: str, request: Request, response: Response) -> Result:
+    """Translate a table of the bundle named by ``OMOP_ETL_BUNDLE``."""
+    if name not in BUNDLE:
+        raise HTTPException(status_code=404, detail=f'Table "{name}" not found')
+    return translate_cached(BUNDLE[name], request, response)
 
@@ -0,0 +1,56 @@
+import gzip
+import pickle
+from pathlib import Path
+from typing import List, Tuple, Union
+
+from omop_etl import __version__
+from omop_etl.schema import Dependency, TargetTable
+
+MAGIC = b"OMOPETL\x01"
+
+Rule = Union[TargetTable, Dependency]
+
+
+def is_bundle(path: Path) -> bool:
+    if not path.is_file():
+        return False
+    with path.open("rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_bundle(rules: List[Tuple[str, Rule]], path: Path) -> None:
+    """Write validated rules to a bundle.
+
+    A bundle is a pickle of the models, so it loads without parsing or
+    validating anything. Like any pickle it must only be loaded from a trusted
+    source, and it is only valid for the version of the package that wrote it.
+    """
+    bundle = {
+        "version": __version__,
+        "rules": [
+            {
+                "name": name,
+                "table": rule.name if isinstance(rule, TargetTable) else None,
+                "depends_on": rule.depends_on,
+                "rule": rule,
+            }
+            for name, rule in rules
+        ],
+    }
+    data = pickle.dumps(bundle, protocol=pickle.HIGHEST_PROTOCOL)
+    with path.open("wb") as f:
+        f.write(MAGIC)
+        f.write(gzip.compress(data, compresslevel=6))
+
+
+def read_bundle(path: Path) -> List[Tuple[str, Rule]]:
+    with path.open("rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a bundle of rules")
+        bundle = pickle.loads(gzip.decompress(f.read()))
+    if bundle["version"] != __version__:
+        raise ValueError(
+            f"{path} was bundled by version {bundle['version']}, "
+            f"rebuild it with version {__version__}"
+        )
+    return [(r["name"], r["rule"]) for r in bundle["rules"]]
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+import pydantic
+
+from omop_etl import __version__
+from omop_etl.schema import Environment
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, pydantic.BaseModel):
+        return value.dict()
+    raise TypeError(f"{type(value)} can't be part of a cache key")
+
+
+def environment_key(env: Environment) -> str:
+    """A canonical representation of an environment."""
+    return json.dumps(env, sort_keys=True, default=_encode)
+
+
+class CompileCache:
+    """The translations of the rules, stored on disk.
+
+    The entries are keyed by a hash of everything they are computed from: the
+    content of the rule file, the environment it is translated in and the
+    version of the package. An entry is therefore never invalidated, it just
+    stops being looked up. Without a directory nothing is cached.
+    """
+
+    def __init__(self, directory: Optional[Path] = None) -> None:
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def digest(*parts: Union[str, bytes]) -> str:
+        h = hashlib.sha256(__version__.encode())
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            h.update(b"\0")
+            h.update(part)
+        return h.hexdigest()
+
+    def fetch(self, key: str, compute: Callable[[], Any]) -> Any:
+        """The entry stored under ``key``, computing and storing it if needed."""
+        if self.directory is None:
+            return compute()
+        path = self.directory / f"{key}.json"
+        try:
+            with path.open() as f:
+                value = json.load(f)
+            self.hits += 1
+            return value
+        except (FileNotFoundError, ValueError):
+            pass
+        self.misses += 1
+        value = compute()
+        # concurrent compiles may share the cache, so entries are replaced whole
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f, default=_encode)
+        os.replace(tmp, path)
+        return value
+
+
+class LRUCache:
+    """The most recently used entries, kept in memory.
+
+    At most ``maxsize`` entries are kept, the least recently used one being
+    dropped to make room for a new one. With a ``ttl`` an entry expires that
+    many seconds after it was stored. The cache can be shared by threads.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if self.ttl is None or self.clock() < expires:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Any) -> None:
+        expires = self.clock() + self.ttl if self.ttl is not None else 0
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def fetch(self, key: str, compute: Callable[[], Any]) -> Any:
+        """The entry stored under ``key``, computing and storing it if needed.
+
+        The value is computed outside of the lock, so two threads missing the
+        same key may both compute it.
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,306 @@
+import json
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from omop_etl.constraints import Constraints
+
+CATALOG_PATH = Path(__file__).parent / "data" / "catalog.json"
+
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_SEARCH_PATH = re.compile(r"set\s+search_path\s+to\s+(?P<schema>\w+)", re.IGNORECASE)
+_CREATE_TABLE = re.compile(
+    r"create\s+(?:unlogged\s+)?table\s+(?:if\s+not\s+exists\s+)?(?P<table>[\w.\"]+)"
+    r"\s*\((?P<body>.*)\)",
+    re.IGNORECASE | re.DOTALL,
+)
+_ALTERATION = re.compile(r"alter\s+table|create\s+(unique\s+)?index", re.IGNORECASE)
+_KEY_COLUMNS = re.compile(r"\((?P<columns>[^)]*)\)")
+_REFERENCES = re.compile(
+    r"references\s+(?P<table>[\w.\"]+)\s*(?:\((?P<columns>[^)]*)\))?", re.IGNORECASE
+)
+# the words that end the data type of a column definition
+_COLUMN_KEYWORDS = {
+    "null",
+    "not",
+    "primary",
+    "references",
+    "default",
+    "constraint",
+    "unique",
+    "check",
+    "collate",
+    "generated",
+}
+_TABLE_CONSTRAINTS = ("primary", "foreign", "unique", "constraint", "check")
+
+
+def _name(s: str) -> str:
+    return s.strip().strip('"').lower()
+
+
+def _columns(s: str) -> Tuple[str, ...]:
+    return tuple(_name(c) for c in s.split(",") if c.strip())
+
+
+def _split(body: str) -> List[str]:
+    """Split a table body on the commas that are not within parentheses."""
+    parts, depth, start = list(), 0, 0
+    for i, c in enumerate(body):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            parts.append(body[start:i])
+            start = i + 1
+    parts.append(body[start:])
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _foreign_key(
+    columns: Tuple[str, ...], definition: str
+) -> Optional["ForeignKeyInfo"]:
+    ref = _REFERENCES.search(definition)
+    if ref is None:
+        return None
+    references = _columns(ref.group("columns") or "")
+    return ForeignKeyInfo(columns, _name(ref.group("table")), references)
+
+
+@dataclass(frozen=True)
+class ColumnInfo:
+    name: str
+    datatype: str
+    nullable: bool = True
+
+
+@dataclass(frozen=True)
+class ForeignKeyInfo:
+    columns: Tuple[str, ...]
+    table: str
+    references: Tuple[str, ...] = tuple()
+
+
+@dataclass(frozen=True)
+class TableInfo:
+    schema: str
+    name: str
+    columns: Tuple[ColumnInfo, ...]
+    primary_key: Tuple[str, ...] = tuple()
+    foreign_keys: Tuple[ForeignKeyInfo, ...] = tuple()
+    indexes: Tuple[str, ...] = tuple()
+    _by_name: Dict[str, ColumnInfo] = field(
+        init=False, repr=False, compare=False, hash=False
+    )
+
+    def __post_init__(self):
+        object.__setattr__(self, "_by_name", {c.name: c for c in self.columns})
+
+    @property
+    def qualified_name(self) -> str:
+        return f"{self.schema}.{self.name}"
+
+    def column(self, name: str) -> Optional[ColumnInfo]:
+        return self._by_name.get(name.lower())
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._by_name
+
+    @property
+    def required_columns(self) -> Tuple[str, ...]:
+        return tuple(c.name for c in self.columns if not c.nullable)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "schema": self.schema,
+            "name": self.name,
+            "columns": [[c.name, c.datatype, c.nullable] for c in self.columns],
+            "primary_key": list(self.primary_key),
+            "foreign_keys": [
+                [list(fk.columns), fk.table, list(fk.references)]
+                for fk in self.foreign_keys
+            ],
+            "indexes": list(self.indexes),
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> "TableInfo":
+        return TableInfo(
+            schema=data["schema"],
+            name=data["name"],
+            columns=tuple(ColumnInfo(*c) for c in data["columns"]),
+            primary_key=tuple(data["primary_key"]),
+            foreign_keys=tuple(
+                ForeignKeyInfo(tuple(c), t, tuple(r))
+                for c, t, r in data["foreign_keys"]
+            ),
+            indexes=tuple(data["indexes"]),
+        )
+
+
+def parse_table_definition(schema: str, statement: str) -> Optional[TableInfo]:
+    match = _CREATE_TABLE.search(statement)
+    if match is None:
+        return None
+    name = _name(match.group("table"))
+    if "." in name:
+        schema, name = name.split(".", 1)
+
+    columns, primary_key, foreign_keys = list(), tuple(), list()
+    for part in _split(match.group("body")):
+        words = part.split()
+        first = words[0].lower()
+        if first in _TABLE_CONSTRAINTS:
+            if first == "constraint":
+                words = words[2:]
+                part = " ".join(words)
+            keys = _KEY_COLUMNS.search(part)
+            kind = words[0].lower()
+            if kind == "primary" and keys is not None:
+                primary_key = _columns(keys.group("columns"))
+            elif kind == "foreign" and keys is not None:
+                fk = _foreign_key(_columns(keys.group("columns")), part)
+                if fk is not None:
+                    foreign_keys.append(fk)
+            continue
+
+        column = _name(words[0])
+        datatype = list()
+        for word in words[1:]:
+            if word.lower() in _COLUMN_KEYWORDS:
+                break
+            datatype.append(word)
+        options = " ".join(words[1 + len(datatype) :]).lower()
+        nullable = "not null" not in options and "primary key" not in options
+        if "primary key" in options:
+            primary_key = (column,)
+        fk = _foreign_key((column,), part)
+        if fk is not None:
+            foreign_keys.append(fk)
+        columns.append(ColumnInfo(column, " ".join(datatype).lower(), nullable))
+
+    return TableInfo(schema, name, tuple(columns), primary_key, tuple(foreign_keys))
+
+
+class Catalog:
+    """The tables of the OMOP and source schemas, with their column types,
+    nullability, keys and indexes.
+
+    The catalog is parsed from the scripts in ``schema/`` by the ``catalog``
+    command and shipped with the package, so rules can be checked against it
+    without a database.
+    """
+
+    def __init__(self, tables: Iterable[TableInfo] = tuple()) -> None:
+        self.tables: Dict[Tuple[str, str], TableInfo] = {
+            (t.schema, t.name): t for t in tables
+        }
+        self._by_name: Dict[str, List[TableInfo]] = dict()
+        for t in self.tables.values():
+            self._by_name.setdefault(t.name, list()).append(t)
+
+    def table(self, name: str, schema: Optional[str] = None) -> Optional[TableInfo]:
+        """Look up a table, by its qualified name or its name in ``schema``.
+
+        An unqualified name without a schema is only found when a single
+        schema has a table of that name.
+        """
+        name = name.lower()
+        if "." in name:
+            schema, name = name.split(".", 1)
+        if schema is not None:
+            return self.tables.get((schema.lower(), name))
+        tables = self._by_name.get(name, list())
+        return tables[0] if len(tables) == 1 else None
+
+    def column(
+        self, table: str, column: str, schema: Optional[str] = None
+    ) -> Optional[ColumnInfo]:
+        info = self.table(table, schema)
+        return None if info is None else info.column(column)
+
+    def __len__(self) -> int:
+        return len(self.tables)
+
+    @staticmethod
+    def parse(scripts: Iterable[str]) -> "Catalog":
+        """Parse ``create table`` scripts and the constraints altering them."""
+        tables: Dict[Tuple[str, str], TableInfo] = dict()
+        alterations = list()
+        for script in scripts:
+            schema = "public"
+            for stmt in _COMMENTS.sub("", script).split(";"):
+                stmt = stmt.strip()
+                if not stmt:
+                    continue
+                match = _SEARCH_PATH.match(stmt)
+                if match is not None:
+                    schema = match.group("schema").lower()
+                    continue
+                table = parse_table_definition(schema, stmt)
+                if table is not None:
+                    tables[(table.schema, table.name)] = table
+                elif _ALTERATION.match(stmt):
+                    alterations.append(stmt)
+
+        constraints = Constraints.parse_string(";\n".join(alterations))
+        return Catalog(tables.values()).apply(constraints)
+
+    @staticmethod
+    def load_scripts(paths: Iterable[Path]) -> "Catalog":
+        return Catalog.parse(Path(p).read_text() for p in paths)
+
+    def apply(self, constraints: Constraints) -> "Catalog":
+        """A copy of the catalog with the given constraints and indexes."""
+        not_null: Dict[Tuple[str, str], set] = dict()
+        for c in constraints.not_null:
+            not_null.setdefault((c.table.schema, c.table.alias), set()).add(c.column)
+        primary_keys, foreign_keys = dict(), dict()
+        for c in constraints.constraints:
+            key = (c.table.schema, c.table.alias)
+            keys = _KEY_COLUMNS.search(c.definition)
+            if c.kind == "primary" and keys is not None:
+                primary_keys[key] = _columns(keys.group("columns"))
+            elif c.kind == "foreign" and keys is not None:
+                fk = _foreign_key(_columns(keys.group("columns")), c.definition)
+                if fk is not None:
+                    foreign_keys.setdefault(key, list()).append(fk)
+        indexes = dict()
+        for i in constraints.indexes:
+            indexes.setdefault((i.table.schema, i.table.alias), list()).append(i.name)
+
+        tables = list()
+        for key, t in self.tables.items():
+            required = not_null.get(key, set())
+            columns = tuple(
+                ColumnInfo(c.name, c.datatype, c.nullable and c.name not in required)
+                for c in t.columns
+            )
+            tables.append(
+                TableInfo(
+                    t.schema,
+                    t.name,
+                    columns,
+                    primary_keys.get(key, t.primary_key),
+                    (*t.foreign_keys, *foreign_keys.get(key, tuple())),
+                    (*t.indexes, *indexes.get(key, tuple())),
+                )
+            )
+        return Catalog(tables)
+
+    def to_json(self) -> str:
+        tables = [self.tables[k].to_dict() for k in sorted(self.tables)]
+        return json.dumps({"tables": tables}, separators=(",", ":"))
+
+    @staticmethod
+    def from_json(s: str) -> "Catalog":
+        return Catalog(TableInfo.from_dict(t) for t in json.loads(s)["tables"])
+
+
+@lru_cache(maxsize=None)
+def load_catalog(path: Path = CATALOG_PATH) -> Catalog:
+    """The catalog shipped with the package, read once."""
+    return Catalog.from_json(Path(path).read_text())
@@ -0,0 +1,211 @@
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from omop_etl.generation import (
+    AlterTableStatement,
+    DropIndexStatement,
+    Serializable,
+    Statement,
+    Table,
+)
+
+_NOT_NULL = re.compile(
+    r"alter\s+table\s+(?P<table>[\w.]+)\s+alter\s+column\s+(?P<column>\w+)"
+    r"\s+set\s+not\s+null",
+    re.IGNORECASE,
+)
+_ADD_CONSTRAINT = re.compile(
+    r"alter\s+table\s+(?P<table>[\w.]+)\s+add\s+constraint\s+(?P<name>\w+)"
+    r"\s+(?P<definition>.+)",
+    re.IGNORECASE | re.DOTALL,
+)
+_CREATE_INDEX = re.compile(
+    r"create\s+(unique\s+)?index\s+(concurrently\s+)?(if\s+not\s+exists\s+)?"
+    r"(?P<name>\w+)\s+on\s+(only\s+)?(?P<table>[\w.]+)",
+    re.IGNORECASE,
+)
+_REFERENCES = re.compile(r"references\s+(?P<table>[\w.]+)", re.IGNORECASE)
+
+
+def parse_table(name: str) -> Table:
+    if "." in name:
+        schema, alias = name.lower().split(".")
+        return Table(alias, schema)
+    return Table(name.lower())
+
+
+@dataclass(eq=True, frozen=True)
+class NotNull:
+    table: Table
+    column: str
+
+
+@dataclass(eq=True, frozen=True)
+class TableConstraint:
+    table: Table
+    name: str
+    definition: str
+
+    @property
+    def kind(self) -> str:
+        return self.definition.split()[0].lower()
+
+    @property
+    def references(self) -> Optional[Table]:
+        match = _REFERENCES.search(self.definition)
+        if match is None:
+            return None
+        return parse_table(match.group("table"))
+
+    @property
+    def validate_later(self) -> bool:
+        """Only foreign keys and checks can be added as ``NOT VALID``."""
+        return self.kind in {"foreign", "check"}
+
+
+@dataclass(eq=True, frozen=True)
+class Index:
+    table: Table
+    name: str
+    statement: str
+
+
+class Constraints:
+    """The constraints and indexes defined by a script such as
+    ``schema/omop_constraints.sql``.
+
+    Loading into tables that have their constraints and indexes in place pays
+    for the checks and the index maintenance on every insert and update. The
+    pre-load stage removes them and the post-load stage puts them back in
+    bulk: indexes are built once, the ``NOT NULL`` constraints of a table are
+    set with a single scan and foreign keys and checks are added as
+    ``NOT VALID`` and validated afterwards, which does not block writes.
+    """
+
+    def __init__(
+        self,
+        not_null: Iterable[NotNull] = tuple(),
+        constraints: Iterable[TableConstraint] = tuple(),
+        indexes: Iterable[Index] = tuple(),
+    ) -> None:
+        self.not_null = list(not_null)
+        self.constraints = list(constraints)
+        self.indexes = list(indexes)
+
+    @staticmethod
+    def parse_string(s: str) -> "Constraints":
+        constraints = Constraints()
+        for stmt in s.split(";"):
+            stmt = " ".join(stmt.split())
+            if not stmt or stmt.startswith("--"):
+                continue
+            match = _NOT_NULL.fullmatch(stmt)
+            if match is not None:
+                table = parse_table(match.group("table"))
+                constraints.not_null.append(NotNull(table, match.group("column")))
+                continue
+            match = _ADD_CONSTRAINT.fullmatch(stmt)
+            if match is not None:
+                table = parse_table(match.group("table"))
+                name, definition = match.group("name"), match.group("definition")
+                constraints.constraints.append(TableConstraint(table, name, definition))
+                continue
+            match = _CREATE_INDEX.match(stmt)
+            if match is not None:
+                table = parse_table(match.group("table"))
+                constraints.indexes.append(Index(table, match.group("name"), stmt))
+                continue
+            raise ValueError(f"Unsupported constraint definition: {stmt}")
+        return constraints
+
+    @staticmethod
+    def load(paths: Iterable[Path]) -> "Constraints":
+        constraints = Constraints()
+        for path in paths:
+            parsed = Constraints.parse_string(Path(path).read_text())
+            constraints.not_null.extend(parsed.not_null)
+            constraints.constraints.extend(parsed.constraints)
+            constraints.indexes.extend(parsed.indexes)
+        return constraints
+
+    def restrict(self, tables: Iterable[str]) -> "Constraints":
+        """Only keep the definitions that involve one of the given OMOP tables."""
+        loaded_tables = {Table(t.lower(), "omop") for t in tables}
+
+        def loaded(table: Optional[Table]) -> bool:
+            return table in loaded_tables
+
+        return Constraints(
+            [c for c in self.not_null if loaded(c.table)],
+            [c for c in self.constraints if loaded(c.table) or loaded(c.references)],
+            [c for c in self.indexes if loaded(c.table)],
+        )
+
+    def scripts(self, tables: Iterable[str]) -> Tuple[str, str]:
+        """The scripts run before and after loading the given tables."""
+        restricted = self.restrict(tables)
+        pre_load = "\n".join([s.to_sql() for s in restricted.pre_load()])
+        post_load = "\n".join([s.to_sql() for s in restricted.post_load()])
+        return pre_load, post_load
+
+    def pre_load(self) -> List[Serializable]:
+        """The statements that remove the constraints and the indexes.
+
+        The foreign keys are dropped first, since the keys and the indexes
+        they reference can't be dropped while they exist.
+        """
+        foreign_keys: Dict[Table, List[str]] = dict()
+        actions: Dict[Table, List[str]] = dict()
+        for c in self.constraints:
+            drops = foreign_keys if c.kind == "foreign" else actions
+            drops.setdefault(c.table, list()).append(
+                f"drop constraint if exists {c.name}"
+            )
+        for c in self.not_null:
+            actions.setdefault(c.table, list()).append(
+                f"alter column {c.column} drop not null"
+            )
+        stmts = [AlterTableStatement(t, a) for t, a in foreign_keys.items()]
+        stmts.extend(DropIndexStatement(i.name, i.table.schema) for i in self.indexes)
+        stmts.extend(AlterTableStatement(t, a) for t, a in actions.items())
+        return stmts
+
+    def post_load_stages(self) -> List[List[Serializable]]:
+        """The statements that rebuild the constraints, grouped in stages.
+
+        The statements of a stage only depend on the previous stages and
+        touch different tables or only take weak locks, so each stage can be
+        run across several sessions.
+        """
+        indexes: Dict[Table, List[str]] = dict()
+        for c in self.constraints:
+            if not c.validate_later:
+                indexes.setdefault(c.table, list()).append(
+                    f"add constraint {c.name} {c.definition}"
+                )
+        build = [AlterTableStatement(t, a) for t, a in indexes.items()]
+        build.extend(Statement(f"{i.statement};") for i in self.indexes)
+
+        actions: Dict[Table, List[str]] = dict()
+        for c in self.not_null:
+            actions.setdefault(c.table, list()).append(
+                f"alter column {c.column} set not null"
+            )
+        for c in self.constraints:
+            if c.validate_later:
+                actions.setdefault(c.table, list()).append(
+                    f"add constraint {c.name} {c.definition} not valid"
+                )
+        add = [AlterTableStatement(t, a) for t, a in actions.items()]
+
+        validate = [
+            AlterTableStatement(c.table, (f"validate constraint {c.name}",))
+            for c in self.constraints
+            if c.validate_later
+        ]
+        return [stage for stage in (build, add, validate) if stage]
+
+    def post_load(self) -> List[Serializable]:
+        return [stmt for stage in self.post_load_stages() for stmt in stage]
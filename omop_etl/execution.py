@@ -0,0 +1,515 @@
+import hashlib
+import itertools
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from omop_etl.constraints import Constraints
+from omop_etl.generation import Serializable, Statement, Table, transaction_control
+from omop_etl.plans import (
+    StatementEstimate,
+    StatementProfile,
+    Thresholds,
+    explain_statement,
+    explainable,
+    planned_query,
+    planning_setup,
+    scanned_relations,
+)
+from omop_etl.project import Rule, split_rules, table_environment
+from omop_etl.schema import (
+    CompileMode,
+    Environment,
+    TargetColumn,
+    TargetTable,
+    create_watermark_table,
+)
+
+STAGING_SCHEMA = "staging"
+
+_QUALIFIED = re.compile(r"\b(mapping|omop)\.(\w+)\b", re.IGNORECASE)
+_WORD = re.compile(r"\b\w+\b")
+_TEMP_TABLE = re.compile(
+    r"\bcreate\s+(?:local\s+)?temp(?:orary)?\s+table\s+(?:if\s+not\s+exists\s+)?(\w+)",
+    re.IGNORECASE,
+)
+
+JOURNAL_TABLE = Table("etl_journal", "mapping")
+
+# connection failures, serialization failures, deadlocks, lack of resources
+# and restarts of the server are worth retrying, unlike a statement timeout
+_TRANSIENT_ERRORS = ("08", "40001", "40P01", "53", "57P01", "57P02", "57P03")
+
+
+@dataclass
+class Task:
+    name: str
+    statements: List[Serializable]
+    depends_on: Set[str] = field(default_factory=set)
+    rule: Optional[str] = None
+
+    def to_sql(self):
+        return "\n".join(stmt.to_sql() for stmt in self.statements)
+
+    def fingerprints(self) -> List[str]:
+        """Identify each statement by the task, its normalized SQL and how many
+        identical statements come before it in the task."""
+        seen: Dict[str, int] = dict()
+        fingerprints = list()
+        for stmt in self.statements:
+            sql = " ".join(stmt.to_sql().split())
+            seen[sql] = seen.get(sql, -1) + 1
+            h = hashlib.sha256(self.name.encode())
+            for part in (sql, str(seen[sql])):
+                h.update(b"\0")
+                h.update(part.encode())
+            fingerprints.append(h.hexdigest())
+        return fingerprints
+
+    def remaining(self, done: Set[str]) -> List[Tuple[Serializable, str]]:
+        """The statements left to run, with their fingerprints, once the ones in
+        ``done`` have run in another session.
+
+        Temp tables don't outlive their session, so the ones the remaining
+        statements read are created again, along with the temp tables they are
+        created from.
+        """
+        statements = list(zip(self.statements, self.fingerprints()))
+        if all(fingerprint in done for _, fingerprint in statements):
+            return []
+        needed: Set[str] = set()
+        remaining = list()
+        for stmt, fingerprint in reversed(statements):
+            sql = stmt.to_sql()
+            created = {alias.lower() for alias in _TEMP_TABLE.findall(sql)}
+            if fingerprint not in done or created & needed:
+                remaining.append((stmt, fingerprint))
+                needed.update(w.lower() for w in _WORD.findall(sql))
+        return remaining[::-1]
+
+
+def temp_aliases(rule: Rule) -> Set[str]:
+    tables = [*(rule.pre_init or tuple()), *(rule.post_init or tuple())]
+    # unquoted names are folded to lowercase
+    return {t.alias.lower() for t in tables}
+
+
+def table_tasks(name: str, table: TargetTable, env: Environment) -> List[Task]:
+    """The tasks loading a table, the last one being named after the rule.
+
+    In staged mode the staging tables of the column groups are computed by
+    their own tasks, between the creation of the mapping table and the insert
+    of the rows.
+    """
+    if env.get("Mode") != CompileMode.staged:
+        stmts, _ = table.translate(env)
+        return [Task(name, stmts)]
+    init, env = table.translate_initialization(env)
+    staging, assemble, env = table.translate_staged(env)
+    keys = Task(f"{name} keys", init, rule=name)
+    groups = [
+        Task(f"{name} {stmt.alias}", [stmt], {keys.name}, rule=name)
+        for stmt in staging
+    ]
+    rows = Task(name, assemble, {keys.name, *(t.name for t in groups)})
+    return [keys, *groups, rows]
+
+
+def translate_rules(
+    rules: Iterable[Tuple[str, Rule]], options: Environment
+) -> List[Tuple[str, Rule, List[Task]]]:
+    """Translate every rule the way ``compile`` does, into the tasks of each rule."""
+    deps, tables = split_rules(rules)
+    envs = dict()
+    translated = list()
+    for name, dep in deps:
+        env = dep.default_env
+        env.update(options)
+        stmts, env = dep.translate(env)
+        envs[name] = env
+        translated.append((name, dep, [Task(name, stmts)]))
+    for name, table in tables:
+        env = table_environment(table, envs, options)
+        translated.append((name, table, table_tasks(name, table, env)))
+    return translated
+
+
+def build_tasks(
+    rules: Iterable[Tuple[str, Rule]],
+    options: Environment = None,
+    constraints: Optional[Constraints] = None,
+) -> List[Task]:
+    """Split the rules into tasks and find the order they have to run in.
+
+    A rule runs after the rules in its ``depends_on``, after the tables its
+    columns reference and after any rule whose mapping table, OMOP table or
+    temp tables its SQL reads. Temp tables only live in the session that
+    created them, so the ones other rules read are promoted to unlogged tables
+    in the staging schema.
+    """
+    rules = list(rules)
+    options = dict(options or dict())
+    by_table = {r.name.lower(): n for n, r in rules if isinstance(r, TargetTable)}
+    aliases = {name: temp_aliases(rule) for name, rule in rules}
+
+    edges: Dict[str, Set[str]] = {name: set() for name, _ in rules}
+    promoted = set()
+    staged = options.get("Mode") == CompileMode.staged
+    for name, rule in rules:
+        if not isinstance(rule, TargetTable) or staged:
+            # dependencies exist to be shared with the tables that depend on them
+            # and staged tables compute their columns on other connections
+            promoted.update(aliases[name])
+        for dep in rule.depends_on or tuple():
+            if dep in edges and dep != name:
+                edges[name].add(dep)
+        if isinstance(rule, TargetTable):
+            for col in rule.columns:
+                if isinstance(col, TargetColumn) and col.reference is not None:
+                    ref = col.reference[0].lower()
+                    if ref in by_table and by_table[ref] != name:
+                        edges[name].add(by_table[ref])
+
+    for name, _, rule_tasks in translate_rules(rules, options):
+        sql = "\n".join(task.to_sql() for task in rule_tasks)
+        for _, table in _QUALIFIED.findall(sql):
+            other = by_table.get(table.lower())
+            if other is not None and other != name:
+                edges[name].add(other)
+        words = {word.lower() for word in _WORD.findall(sql)} - aliases[name]
+        for other, defined in aliases.items():
+            used = words & defined
+            if other != name and used:
+                edges[name].add(other)
+                promoted.update(used)
+
+    options["PromotedTables"] = promoted
+    options["StagingSchema"] = STAGING_SCHEMA
+    tasks = list()
+    for name, _, rule_tasks in translate_rules(rules, options):
+        for task in rule_tasks:
+            task.depends_on.update(edges[name])
+        tasks.extend(rule_tasks)
+    if promoted:
+        schema = Task(
+            "create staging schema",
+            [Statement(f"create schema if not exists {STAGING_SCHEMA};")],
+        )
+        for task in tasks:
+            task.depends_on.add(schema.name)
+        tasks.insert(0, schema)
+
+    if options.get("Incremental", False):
+        # concurrent creations of the same table could conflict
+        state = Task("create watermark table", [create_watermark_table()])
+        for task in tasks:
+            task.depends_on.add(state.name)
+        tasks.insert(0, state)
+
+    if constraints is not None:
+        loaded = [t.name for t in tasks]
+        names = [r.name for _, r in rules if isinstance(r, TargetTable)]
+        constraints = constraints.restrict(names)
+        pre_load = Task("drop constraints", constraints.pre_load())
+        for task in tasks:
+            task.depends_on.add(pre_load.name)
+        tasks.insert(0, pre_load)
+        previous = set(loaded)
+        for i, stage in enumerate(constraints.post_load_stages()):
+            stage_tasks = [
+                Task(f"constraints {i + 1}.{j + 1}", [stmt], set(previous))
+                for j, stmt in enumerate(stage)
+            ]
+            tasks.extend(stage_tasks)
+            previous = {t.name for t in stage_tasks}
+
+    check_acyclic(tasks)
+    return tasks
+
+
+def topological_order(tasks: List[Task]) -> List[Task]:
+    """The tasks in an order they can run in one after the other."""
+    by_name = {t.name: t for t in tasks}
+    remaining = {t.name: set(t.depends_on) for t in tasks}
+    for deps in remaining.values():
+        deps.intersection_update(remaining)
+    ordered = list()
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            cycle = ", ".join(sorted(remaining))
+            raise ValueError(f"Circular dependency between: {cycle}")
+        for name in ready:
+            del remaining[name]
+            ordered.append(by_name[name])
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return ordered
+
+
+def check_acyclic(tasks: List[Task]) -> None:
+    topological_order(tasks)
+
+
+def create_journal_table() -> Statement:
+    journal = JOURNAL_TABLE.to_sql()
+    return Statement(
+        f"create table if not exists {journal} (fingerprint text primary key,"
+        " task text not null, finished_at timestamptz not null default now());"
+    )
+
+
+def is_transient(ex: Exception) -> bool:
+    """Whether running the statement again may succeed."""
+    import psycopg2
+
+    code = getattr(ex, "pgcode", None)
+    if code is None:
+        # the connection was lost before the server could answer
+        return isinstance(ex, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    return code.startswith(_TRANSIENT_ERRORS)
+
+
+_TABLE_ROWS = """
+select n.nspname || '.' || c.relname, c.reltuples
+from pg_class c join pg_namespace n on n.oid = c.relnamespace
+where n.nspname || '.' || c.relname = any(%s) and c.reltuples >= 0;
+"""
+
+_AVAILABLE_CONNECTIONS = """
+select least(
+    (select nullif(datconnlimit, -1) from pg_database
+     where datname = current_database())
+    - (select count(*) from pg_stat_activity where datname = current_database()),
+    (select nullif(rolconnlimit, -1) from pg_roles where rolname = current_user)
+    - (select count(*) from pg_stat_activity where usename = current_user),
+    current_setting('max_connections')::int
+    - current_setting('superuser_reserved_connections')::int
+    - (select count(*) from pg_stat_activity)
+);
+"""
+
+
+class Executor:
+    """Run tasks over a pool of connections, each task once its dependencies
+    are done.
+
+    The statements run in autocommit, as they would with ``psql`` on the
+    compiled script, and each task cleans up its temp tables so the
+    connection can be handed to the next task.
+
+    Every statement that completes is recorded in a journal, so a failed load
+    can be resumed where it stopped. A statement is only recorded once it
+    committed, and a chunked statement that failed starts again from its first
+    chunk. A task that fails on a transient error is retried on a new
+    connection after waiting ``backoff`` seconds, twice as long every time,
+    and only runs the statements it has left.
+
+    When profiling, the statements run under EXPLAIN ANALYZE where they can and
+    their profiles are collected in ``profiles``.
+    """
+
+    def __init__(
+        self,
+        connection: Dict[str, Any],
+        jobs: int = 1,
+        search_path: Optional[str] = None,
+        resume: bool = False,
+        statement_timeout: Optional[int] = None,
+        retries: int = 0,
+        backoff: float = 1.0,
+        profile: bool = False,
+    ) -> None:
+        self.connection = connection
+        self.jobs = jobs
+        self.search_path = search_path
+        self.resume = resume
+        self.statement_timeout = statement_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.profile = profile
+        self.profiles: List[StatementProfile] = list()
+
+    def available_connections(self) -> Optional[int]:
+        """How many sessions the database, the role and the server still accept."""
+        import psycopg2
+
+        conn = psycopg2.connect(**self.connection)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(_AVAILABLE_CONNECTIONS)
+                (available,) = cur.fetchone()
+        finally:
+            conn.close()
+        # the probing connection is counted and is now free again
+        return None if available is None else available + 1
+
+    def clamp_jobs(self) -> int:
+        available = self.available_connections()
+        if available is not None:
+            return max(1, min(self.jobs, available))
+        return max(1, self.jobs)
+
+    def prepare(self, conn) -> None:
+        conn.autocommit = True
+        search_path = self.search_path or '"$user", public'
+        with conn.cursor() as cur:
+            cur.execute(f"set search_path to {STAGING_SCHEMA}, {search_path};")
+            if self.statement_timeout is not None:
+                cur.execute(f"set statement_timeout to '{self.statement_timeout}s';")
+
+    def open_journal(self, conn) -> Set[str]:
+        """The statements that completed in the previous run when resuming, the
+        journal is emptied otherwise."""
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(create_journal_table().to_sql())
+            if not self.resume:
+                cur.execute(f"truncate {JOURNAL_TABLE.to_sql()};")
+                return set()
+            cur.execute(f"select fingerprint from {JOURNAL_TABLE.to_sql()};")
+            return {fingerprint for (fingerprint,) in cur.fetchall()}
+
+    def execute(self, cur, task: Task, stmt: Serializable) -> None:
+        if not self.profile:
+            cur.execute(stmt.to_sql())
+            return
+        start = time.perf_counter()
+        explained = None
+        if explainable(stmt):
+            cur.execute(explain_statement(stmt))
+            (explained,) = cur.fetchone()
+        else:
+            cur.execute(stmt.to_sql())
+        elapsed = (time.perf_counter() - start) * 1000
+        rule = task.rule or task.name
+        profile = StatementProfile.from_explain(rule, stmt, elapsed, explained)
+        self.profiles.append(profile)
+
+    def run_task(self, pool, task: Task, journaled: Set[str]) -> Task:
+        journal = (
+            f"insert into {JOURNAL_TABLE.to_sql()} (fingerprint, task)"
+            " values (%s, %s) on conflict do nothing;"
+        )
+        for attempt in itertools.count():
+            remaining = task.remaining(journaled)
+            if not remaining:
+                return task
+            conn = pool.getconn()
+            try:
+                self.prepare(conn)
+                with conn.cursor() as cur:
+                    # what runs in a transaction block is only done once it commits
+                    block: Optional[List[str]] = None
+                    for stmt, fingerprint in remaining:
+                        self.execute(cur, task, stmt)
+                        cur.execute(journal, (fingerprint, task.name))
+                        control = transaction_control(stmt)
+                        if control == "begin":
+                            block = [fingerprint]
+                        elif block is None:
+                            journaled.add(fingerprint)
+                        else:
+                            block.append(fingerprint)
+                            if control in ("commit", "rollback"):
+                                journaled.update(block)
+                                block = None
+                    cur.execute("discard temp;")
+            except Exception as ex:
+                pool.putconn(conn, close=True)
+                if attempt >= self.retries or not is_transient(ex):
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+            pool.putconn(conn)
+            return task
+
+    def explain(
+        self, tasks: List[Task], thresholds: Optional[Thresholds] = None
+    ) -> List[StatementEstimate]:
+        """Estimate every statement without running it.
+
+        The tasks are planned one after the other in a single transaction that
+        is rolled back. The tables the statements create are created empty, so
+        the statements reading them can be planned, but the planner doesn't
+        know their size.
+        """
+        import psycopg2
+
+        thresholds = thresholds or Thresholds()
+        explained = list()
+        conn = psycopg2.connect(**self.connection)
+        try:
+            self.prepare(conn)
+            conn.autocommit = False
+            with conn.cursor() as cur:
+                for task in topological_order(tasks):
+                    for stmt in task.statements:
+                        query = planned_query(stmt)
+                        if query is not None:
+                            cur.execute(f"explain (verbose, format json) {query}")
+                            (plan,) = cur.fetchone()
+                            explained.append((task.rule or task.name, stmt, plan))
+                        setup = planning_setup(stmt)
+                        if setup is not None:
+                            cur.execute(setup)
+
+                relations = set()
+                for _, _, plan in explained:
+                    relations.update(scanned_relations(plan[0]["Plan"]))
+                cur.execute(_TABLE_ROWS, (sorted(relations),))
+                table_rows = dict(cur.fetchall())
+        finally:
+            conn.rollback()
+            conn.close()
+        return [
+            StatementEstimate.from_explain(rule, stmt, plan, thresholds, table_rows)
+            for rule, stmt, plan in explained
+        ]
+
+    def run(self, tasks: List[Task], progress=None) -> None:
+        from psycopg2.pool import ThreadedConnectionPool
+
+        check_acyclic(tasks)
+        jobs = self.clamp_jobs()
+        pool = ThreadedConnectionPool(1, jobs, **self.connection)
+
+        names = {t.name for t in tasks}
+        waiting = {t.name: set(t.depends_on) & names for t in tasks}
+        by_name = {t.name: t for t in tasks}
+        try:
+            conn = pool.getconn()
+            journaled = self.open_journal(conn)
+            pool.putconn(conn)
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                running = dict()
+                failure = None
+                while waiting or running:
+                    if failure is None:
+                        ready = [n for n, deps in waiting.items() if not deps]
+                        for name in ready:
+                            del waiting[name]
+                            task = by_name[name]
+                            future = executor.submit(
+                                self.run_task, pool, task, journaled
+                            )
+                            running[future] = name
+                    if not running:
+                        break
+                    completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        name = running.pop(future)
+                        if future.exception() is not None:
+                            failure = failure or (name, future.exception())
+                            continue
+                        for deps in waiting.values():
+                            deps.discard(name)
+                        if progress is not None:
+                            progress(by_name[name])
+                if failure is not None:
+                    name, ex = failure
+                    raise RuntimeError(f"Task '{name}' failed: {ex}") from ex
+        finally:
+            pool.closeall()
@@ -1,65 +1,180 @@
+import sys
+import weakref
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from dataclasses import dataclass, field, replace
+from functools import wraps
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
+
+from omop_etl.analysis import table_columns
+
+# dataclasses can only do without a __dict__ from python 3.10
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else dict()
+# and still be weakly referenced from python 3.11
+_WEAK_SLOTS = dict()
+if sys.version_info >= (3, 11):
+    _WEAK_SLOTS = {**_SLOTS, "weakref_slot": True}
+
+
+def _node(cls):
+    """An immutable node of a statement, compared and hashed by its fields."""
+    return dataclass(frozen=True, **_SLOTS)(cls)
+
+
+def _memoized(to_sql):
+    """Render a node once, the nodes being immutable their SQL can't change."""
+
+    @wraps(to_sql)
+    def wrapper(self):
+        if self._sql is None:
+            object.__setattr__(self, "_sql", to_sql(self))
+        return self._sql
+
+    return wrapper
+
+
+def _cached():
+    """A field computed from the others on first use."""
+    return field(default=None, init=False, repr=False, compare=False)
 
 
 class Serializable(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def to_sql(self):
         raise NotImplementedError
 
 
 class Expression(str, Serializable):
+    __slots__ = ()
+
     def to_sql(self):
         return self.replace("\n", " ")
 
 
 class Statement(Expression):
-    pass
+    __slots__ = ()
 
 
 class Script(Expression):
+    __slots__ = ()
+
     def to_sql(self):
         return self
 
 
-class Criterion(List[Expression], Serializable):
-    def to_sql(self):
-        return " and ".join([f"({e})" for e in self])
+_TRANSACTION_CONTROL = {
+    "begin": "begin",
+    "start": "begin",
+    "commit": "commit",
+    "end": "commit",
+    "rollback": "rollback",
+    "abort": "rollback",
+}
+
+
+def transaction_control(stmt: Serializable) -> Optional[str]:
+    """``begin``, ``commit`` or ``rollback`` if the statement starts or ends a
+    transaction block."""
+    if not isinstance(stmt, Statement):
+        return None
+    words = stmt.to_sql().lower().replace(";", " ").split()
+    if not words or words[1:] not in ([], ["work"], ["transaction"]):
+        return None
+    return _TRANSACTION_CONTROL.get(words[0])
+
+
+@_node
+class Criterion(Serializable):
+    """The conjunction of predicates, equal to any other of the same predicates
+    whatever their order."""
+
+    predicates: Tuple[Expression] = field(default=tuple(), compare=False)
+    _terms: Optional[FrozenSet[Expression]] = _cached()
+
+    def __post_init__(self):
+        if not isinstance(self.predicates, tuple):
+            object.__setattr__(self, "predicates", tuple(self.predicates))
+
+    @property
+    def terms(self) -> FrozenSet[Expression]:
+        """The predicates as a set, built the first time they are compared."""
+        if self._terms is None:
+            object.__setattr__(self, "_terms", frozenset(self.predicates))
+        return self._terms
 
     def __eq__(self, o: object) -> bool:
-        return set(self) == set(o)
+        if isinstance(o, Criterion):
+            return self.terms == o.terms
+        if isinstance(o, list):
+            return self.terms == frozenset(o)
+        return NotImplemented
 
+    def __hash__(self) -> int:
+        return hash(self.terms)
 
-@dataclass(eq=True)
+    def __iter__(self):
+        return iter(self.predicates)
+
+    def __len__(self) -> int:
+        return len(self.predicates)
+
+    def __getitem__(self, i):
+        return self.predicates[i]
+
+    def to_sql(self):
+        return " and ".join([f"({e})" for e in self.predicates])
+
+
+# the tables in use, forgotten once no statement refers to them any more
+_TABLES: Dict[Tuple[str, Optional[str]], "Table"] = weakref.WeakValueDictionary()
+
+
+@dataclass(frozen=True, **_WEAK_SLOTS)
 class Table(Serializable):
+    """A table, interned: the same table is always the same object, built and
+    rendered once while it is in use."""
+
     alias: str
     schema: Optional[str] = None
+    _sql: str = field(init=False, repr=False, compare=False)
+
+    def __new__(cls, alias: str, schema: Optional[str] = None) -> "Table":
+        table = _TABLES.get((alias, schema))
+        if table is None:
+            table = object.__new__(cls)
+            sql = alias if schema is None else f"{schema}.{alias}"
+            object.__setattr__(table, "alias", alias)
+            object.__setattr__(table, "schema", schema)
+            object.__setattr__(table, "_sql", sql)
+            # another thread may have built the same table in the meantime
+            table = _TABLES.setdefault((alias, schema), table)
+        return table
+
+    def __init__(self, alias: str, schema: Optional[str] = None) -> None:
+        # built by __new__ the first time
+        pass
+
+    def __reduce__(self):
+        return Table, (self.alias, self.schema)
 
     def to_sql(self):
-        if self.schema is None:
-            return self.alias
-        else:
-            return f"{self.schema}.{self.alias}"
-
-    def __hash__(self):
-        return hash(self.alias) + hash(self.schema)
+        return self._sql
 
 
-@dataclass(eq=True)
+@_node
 class QueryTable(Serializable):
     alias: str
     query: str
+    _sql: Optional[str] = _cached()
 
+    @_memoized
     def to_sql(self):
         q = self.query.replace("\n", " ")
         return f"({q}) as {self.alias}"
 
-    def __hash__(self):
-        return hash(self.alias) + hash(self.query)
 
-
-@dataclass
+@_node
 class Column(Serializable):
     name: str
     table: Table
@@ -69,7 +184,7 @@ class Column(Serializable):
         return f"{t}.{self.name}"
 
 
-@dataclass
+@_node
 class ColumnDefinition(Serializable):
     name: str
     datatype: str
@@ -78,104 +193,233 @@ class ColumnDefinition(Serializable):
         return f"{self.name} {self.datatype} null"
 
 
-@dataclass(eq=True)
+@_node
 class DropTableStatement(Serializable):
     table: Table
 
     def to_sql(self):
         return f"drop table if exists {self.table.to_sql()};"
 
-    def __hash__(self):
-        return hash("drop table") + hash(self.table)
+
+@_node
+class AlterTableStatement(Serializable):
+    table: Table
+    actions: Tuple[str]
+
+    def __post_init__(self):
+        object.__setattr__(self, "actions", tuple(self.actions))
+
+    def to_sql(self):
+        actions = ", ".join(self.actions)
+        return f"alter table {self.table.to_sql()} {actions};"
+
+
+@_node
+class DropIndexStatement(Serializable):
+    name: str
+    schema: Optional[str] = None
+
+    def to_sql(self):
+        name = self.name if self.schema is None else f"{self.schema}.{self.name}"
+        return f"drop index if exists {name};"
 
 
-@dataclass(eq=True)
+@_node
 class CreateTableStatement(Serializable):
     primary_key: str
     table: Table
     columns: Tuple[ColumnDefinition]
+    unlogged: bool = False
+    options: Tuple[Tuple[str, str]] = tuple()
+    if_not_exists: bool = False
 
     def __post_init__(self):
-        self.columns = tuple(self.columns)
+        object.__setattr__(self, "columns", tuple(self.columns))
+        object.__setattr__(self, "options", tuple(tuple(o) for o in self.options))
 
     def to_sql(self):
         columns = ", ".join(map(lambda c: c.to_sql(), self.columns))
-        return f"create table {self.table.to_sql()} (id serial PRIMARY KEY, {columns});"
+        kind = "unlogged table" if self.unlogged else "table"
+        if self.if_not_exists:
+            kind = f"{kind} if not exists"
+        stmt = f"create {kind} {self.table.to_sql()} (id serial PRIMARY KEY, {columns})"
+        if self.options:
+            options = ", ".join([f"{k} = {v}" for k, v in self.options])
+            stmt = f"{stmt} with ({options})"
+        return f"{stmt};"
+
+
+@_node
+class CreateIndexStatement(Serializable):
+    table: Table
+    columns: Tuple[str]
+    method: str = "btree"
+    if_not_exists: bool = False
+    unique: bool = False
+
+    def __post_init__(self):
+        object.__setattr__(self, "columns", tuple(self.columns))
+
+    @property
+    def name(self) -> str:
+        suffix = "key" if self.unique else "idx"
+        return "_".join([self.table.alias, *self.columns, suffix])
+
+    def to_sql(self):
+        columns = ", ".join(self.columns)
+        table = self.table.to_sql()
+        kind = "unique index" if self.unique else "index"
+        name = f"if not exists {self.name}" if self.if_not_exists else self.name
+        return f"create {kind} {name} on {table} using {self.method} ({columns});"
 
 
-@dataclass(eq=True)
+@_node
+class AnalyzeStatement(Serializable):
+    table: Table
+
+    def to_sql(self):
+        return f"analyze {self.table.to_sql()};"
+
+
+@_node
 class CreateTempTableStatement(Serializable):
     alias: str
     query: str
+    schema: Optional[str] = None
 
     def to_sql(self):
+        if self.schema is not None:
+            # a regular table in a shared schema is visible to other sessions
+            table = f"{self.schema}.{self.alias}"
+            return (
+                f"drop table if exists {table};\n"
+                f"create unlogged table {table} as {self.query};"
+            )
         return f"create temp table {self.alias} as {self.query};"
 
 
-@dataclass(eq=True)
+@_node
+class Join(Serializable):
+    table: Union[Table, QueryTable]
+    criterion: Criterion
+    how: str = "left"
+    _sql: Optional[str] = _cached()
+
+    def __post_init__(self):
+        if not isinstance(self.criterion, Criterion):
+            object.__setattr__(self, "criterion", Criterion(self.criterion))
+
+    @_memoized
+    def to_sql(self):
+        return f"{self.how} join {self.table.to_sql()} on {self.criterion.to_sql()}"
+
+
+@_node
 class SelectStatement(Serializable):
     expressions: Tuple[Expression]
-    source: Tuple[Table]
+    source: Tuple[Union[Table, QueryTable, Join]]
     criterion: Optional[Criterion] = None
+    distinct_on: Optional[Tuple[Expression]] = None
+    _sql: Optional[str] = _cached()
 
     def __post_init__(self):
-        self.expressions = tuple(self.expressions)
-        self.source = tuple(self.source)
-        if self.criterion is not None:
-            self.criterion = Criterion(self.criterion)
-
-    def to_sql(self):
+        object.__setattr__(self, "expressions", tuple(self.expressions))
+        object.__setattr__(self, "source", tuple(self.source))
+        if self.criterion is not None and not isinstance(self.criterion, Criterion):
+            object.__setattr__(self, "criterion", Criterion(self.criterion))
+        if self.distinct_on is not None:
+            object.__setattr__(self, "distinct_on", tuple(self.distinct_on))
+
+    @_memoized
+    def to_query(self):
+        """The select without the trailing semicolon, e.g. for use as a subquery."""
         sel = ", ".join([e.to_sql() for e in self.expressions])
-        frm = ", ".join([t.to_sql() for t in self.source])
+        if self.distinct_on is not None:
+            on = ", ".join([e.to_sql() for e in self.distinct_on])
+            sel = f"distinct on ({on}) {sel}"
+
+        frm = ""
+        for t in self.source:
+            if not frm:
+                frm = t.to_sql()
+            elif isinstance(t, Join):
+                frm = f"{frm} {t.to_sql()}"
+            else:
+                frm = f"{frm}, {t.to_sql()}"
+
         if self.criterion is None:
-            return f"select {sel} from {frm};"
+            return f"select {sel} from {frm}"
         else:
             whr = self.criterion.to_sql()
-            return f"select {sel} from {frm} where {whr};"
+            return f"select {sel} from {frm} where {whr}"
 
-    def __hash__(self) -> bool:
-        return hash(self.expressions) + hash(self.source) + hash(self.criterion)
+    def to_sql(self):
+        return f"{self.to_query()};"
 
 
-@dataclass(eq=True)
+@_node
 class InsertFromStatement(Serializable):
     columns: Tuple[str]
     target: Table
     source: SelectStatement
+    on_conflict: Optional[str] = None
+    _sql: Optional[str] = _cached()
 
     def __post_init__(self):
-        self.columns = tuple(self.columns)
+        object.__setattr__(self, "columns", tuple(self.columns))
 
+    @_memoized
     def to_sql(self):
-        select = self.source.to_sql()
+        select = self.source.to_query()
         columns = ", ".join(self.columns)
         target_table = self.target.to_sql()
-        return f"insert into {target_table} ({columns}) {select}"
+        if self.on_conflict is not None:
+            select = f"{select} on conflict {self.on_conflict}"
+        return f"insert into {target_table} ({columns}) {select};"
 
-    def __hash__(self) -> bool:
-        return hash(self.columns) + hash(self.target) + hash(self.source)
 
-
-@dataclass(eq=True)
+@_node
 class UpdateStatement(Serializable):
     column: Column
     expression: Expression
     criterion: Optional[Criterion] = None
     source: Optional[Tuple[Table]] = None
+    assignments: Tuple[Tuple[Column, Expression]] = tuple()
+    _sql: Optional[str] = _cached()
 
     def __post_init__(self):
         if self.source is not None:
-            self.source = tuple(self.source)
-
+            object.__setattr__(self, "source", tuple(self.source))
+        assignments = self.assignments or ((self.column, self.expression),)
+        object.__setattr__(self, "assignments", tuple(tuple(a) for a in assignments))
+
+    @property
+    def columns(self) -> Tuple[str]:
+        return tuple(column.name for column, _ in self.assignments)
+
+    def fuse(self, *others: "UpdateStatement") -> "UpdateStatement":
+        if not others:
+            return self
+        assignments = [a for stmt in (self, *others) for a in stmt.assignments]
+        return UpdateStatement(
+            column=self.column,
+            expression=self.expression,
+            criterion=self.criterion,
+            source=self.source,
+            assignments=assignments,
+        )
+
+    @_memoized
     def to_sql(self):
-        target_column = self.column
-        target_table = target_column.table.to_sql()
+        target_table = self.column.table.to_sql()
 
-        exp = self.expression.to_sql()
+        assignments = ", ".join(
+            [f"{col.name} = {exp.to_sql()}" for col, exp in self.assignments]
+        )
 
         clauses = list()
 
-        clauses.append(f"update {target_table} set {target_column.name} = {exp}")
+        clauses.append(f"update {target_table} set {assignments}")
 
         if self.source is not None:
             frm = ", ".join([t.to_sql() for t in self.source])
@@ -187,3 +431,96 @@ class UpdateStatement(Serializable):
 
         stmt = " ".join(clauses)
         return f"{stmt};"
+
+
+def _read_columns(stmt: UpdateStatement) -> Set[str]:
+    """The columns of the target table an update may read."""
+    sql = [exp.to_sql() for _, exp in stmt.assignments]
+    if stmt.criterion is not None:
+        sql.append(stmt.criterion.to_sql())
+    return table_columns(" ".join(sql), stmt.column.table.alias)
+
+
+def fuse_updates(statements: Iterable[Serializable]) -> List[Serializable]:
+    """Merge updates of the same table that share a FROM and WHERE clause.
+
+    Any statement that is not an update acts as a barrier. An update is only
+    moved into an earlier one if none of the updates from that one on write the
+    same columns, so the last assignment to a column still wins, or the columns
+    it reads, since the fused assignments see the values of the row before the
+    update.
+    """
+    fused = list()
+    groups = dict()
+    # the columns written from the position of each group on
+    written = dict()
+    for stmt in statements:
+        if not isinstance(stmt, UpdateStatement):
+            groups.clear()
+            written.clear()
+            fused.append(stmt)
+            continue
+
+        key = (stmt.column.table, stmt.source, stmt.criterion or Criterion())
+        columns = set(stmt.columns)
+        idx = groups.get(key)
+        if (
+            idx is not None
+            and columns.isdisjoint(written[idx])
+            and _read_columns(stmt).isdisjoint(written[idx])
+        ):
+            fused[idx].append(stmt)
+        else:
+            written.pop(idx, None)
+            idx = groups[key] = len(fused)
+            written[idx] = set()
+            fused.append([stmt])
+        for i, w in written.items():
+            if i <= idx:
+                w.update(columns)
+    return [s[0].fuse(*s[1:]) if isinstance(s, list) else s for s in fused]
+
+
+@_node
+class ChunkedStatement(Serializable):
+    """Run an update or an insert over consecutive ranges of ``size`` keys.
+
+    The range of the keys is selected by ``bounds`` and every expression in
+    ``keys`` is restricted to the current chunk. Each chunk is committed on its
+    own, so the statement has to run outside of a transaction block.
+    """
+
+    statement: Union[UpdateStatement, InsertFromStatement]
+    keys: Tuple[Expression]
+    bounds: SelectStatement
+    size: int
+
+    def __post_init__(self):
+        object.__setattr__(self, "keys", tuple(self.keys))
+
+    def chunk(self) -> Union[UpdateStatement, InsertFromStatement]:
+        """The statement restricted to the chunk starting at ``_chunk_lo``."""
+        predicates = list()
+        for key in self.keys:
+            predicates.append(Expression(f"{key} >= _chunk_lo"))
+            predicates.append(Expression(f"{key} < _chunk_lo + {self.size}"))
+
+        if isinstance(self.statement, UpdateStatement):
+            criterion = Criterion([*(self.statement.criterion or tuple()), *predicates])
+            return replace(self.statement, criterion=criterion)
+
+        select = self.statement.source
+        criterion = Criterion([*(select.criterion or tuple()), *predicates])
+        return replace(self.statement, source=replace(select, criterion=criterion))
+
+    def to_sql(self):
+        clauses = [
+            "do $chunk$ declare _chunk_lo bigint; _chunk_hi bigint; begin",
+            f"{self.bounds.to_query()} into _chunk_lo, _chunk_hi;",
+            "while _chunk_lo <= _chunk_hi loop",
+            self.chunk().to_sql(),
+            "commit;",
+            f"_chunk_lo := _chunk_lo + {self.size};",
+            "end loop; end $chunk$;",
+        ]
+        return " ".join(clauses)
@@ -0,0 +1,253 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from omop_etl.analysis import (
+    conjuncts,
+    correlations,
+    count_or,
+    disjuncts,
+    qualifier,
+    referenced_tables,
+    subqueries,
+    wrapped_columns,
+)
+from omop_etl.catalog import Catalog, TableInfo, load_catalog
+from omop_etl.schema import TableReference, TargetColumn, TargetTable
+
+# the alternatives beyond which a predicate is OR-heavy
+MAX_ALTERNATIVES = 2
+
+_CONSTANT_EQUALITY = re.compile(r"^(?P<column>[\w.]+) = (?P<value>'.*'|[-\d.]+)$")
+
+
+@dataclass(eq=True, frozen=True)
+class Finding:
+    """A pattern of a rule file that makes its statements slow."""
+
+    file: str
+    column: str
+    check: str
+    message: str
+    suggestion: str
+
+
+class _Scope:
+    """The tables a column selects from, by the name its SQL refers to them,
+    lowercased as unquoted names are."""
+
+    def __init__(self, table: TargetTable, catalog: Catalog) -> None:
+        self.catalog = catalog
+        self.default_schema = table.default_schema
+        self.temp_tables = {
+            t.alias.lower()
+            for t in [*(table.pre_init or ()), *(table.post_init or ())]
+        }
+        self.schemas: Dict[str, Optional[str]] = dict()
+
+    def add(self, source) -> str:
+        alias, schema = source.alias.lower(), None
+        if isinstance(source, TableReference) and alias not in self.temp_tables:
+            schema = source.table_schema or self.default_schema
+        self.schemas[alias] = schema
+        return alias
+
+    def info(self, alias: str) -> Optional[TableInfo]:
+        schema = self.schemas.get(alias)
+        if schema is None:
+            return None
+        return self.catalog.table(alias, schema=schema)
+
+
+def _join_suggestion(scope: _Scope, alias: str, joined: List[str]) -> str:
+    """A predicate joining a table to the others, from the keys of the catalog."""
+    info = scope.info(alias)
+    for other in joined:
+        other_info = scope.info(other)
+        if info is None or other_info is None:
+            continue
+        for a, a_info, b, b_info in (
+            (alias, info, other, other_info),
+            (other, other_info, alias, info),
+        ):
+            for fk in a_info.foreign_keys:
+                if fk.table.split(".")[-1] == b_info.name and fk.references:
+                    pairs = zip(fk.columns, fk.references)
+                    predicate = " and ".join(f"{a}.{c} = {b}.{r}" for c, r in pairs)
+                    return f"add the constraint `{predicate}`"
+            for key in b_info.primary_key:
+                # an id column is the key of too many tables to join on
+                if key != "id" and key in a_info:
+                    return f"add the constraint `{a}.{key} = {b}.{key}`"
+    tables = ", ".join(joined)
+    return f"add a constraint joining {alias} to one of {tables}"
+
+
+def _check_cartesian(
+    file: str, column: TargetColumn, scope: _Scope, predicates: List[str], start: str
+) -> List[Finding]:
+    aliases = [scope.add(t) for t in column.tables]
+    edges: Dict[str, set] = {a: set() for a in [start, *aliases]}
+    for predicate in predicates:
+        for conjunct in conjuncts(predicate):
+            tables = referenced_tables(conjunct, edges)
+            for table in tables:
+                edges[table].update(tables - {table})
+
+    joined, pending = {start}, [start]
+    while pending:
+        for other in edges[pending.pop()] - joined:
+            joined.add(other)
+            pending.append(other)
+
+    findings = list()
+    for alias in dict.fromkeys(aliases):
+        if alias in joined:
+            continue
+        message = (
+            f"{alias} is not joined to the other tables of the column, so every "
+            "row of it is combined with every row they select"
+        )
+        suggestion = _join_suggestion(scope, alias, sorted(joined - {start}) or [start])
+        findings.append(Finding(file, column.name, "cartesian", message, suggestion))
+    return findings
+
+
+def _check_wrapped(
+    file: str, location: str, scope: _Scope, constraints: Iterable[str]
+) -> List[Finding]:
+    findings = list()
+    for constraint in constraints:
+        for conjunct in conjuncts(constraint):
+            joins = len(referenced_tables(conjunct, scope.schemas)) > 1
+            # a column wrapped several times in a predicate is reported once
+            for name, function in dict(reversed(wrapped_columns(conjunct))).items():
+                alias, column = qualifier(name), name.split(".")[-1]
+                info = scope.info(alias)
+                keys = set()
+                if info is not None:
+                    keys.update(info.primary_key)
+                    keys.update(c for fk in info.foreign_keys for c in fk.columns)
+                if column not in keys and not joins:
+                    continue
+                wrapper = "a cast" if function == "cast" else f"{function}()"
+                message = (
+                    f"{wrapper} around {name} in `{conjunct}` keeps the index of "
+                    f"{alias}.{column} from being used"
+                )
+                if function == "cast" and info is not None and column in info:
+                    datatype = info.column(column).datatype
+                    suggestion = f"cast the other side to {datatype} instead"
+                else:
+                    suggestion = (
+                        f"compare {name} itself and apply {wrapper} to the other "
+                        "side, or index the expression"
+                    )
+                findings.append(
+                    Finding(file, location, "wrapped-column", message, suggestion)
+                )
+    return findings
+
+
+def _check_or(
+    file: str, location: str, scope: _Scope, constraints: Iterable[str]
+) -> List[Finding]:
+    findings = list()
+    for constraint in constraints:
+        alternatives = count_or(constraint) + 1
+        if alternatives == 1:
+            continue
+        parts = disjuncts(constraint)
+        tables = [referenced_tables(p, scope.schemas) for p in parts]
+        spans_tables = len(set().union(*tables)) > 1
+        if alternatives <= MAX_ALTERNATIVES and not spans_tables:
+            continue
+        matches = [_CONSTANT_EQUALITY.match(p) for p in parts]
+        columns = {m.group("column") for m in matches if m is not None}
+        if all(matches) and len(columns) == 1:
+            values = ", ".join(m.group("value") for m in matches)
+            suggestion = f"use `{columns.pop()} in ({values})`"
+        elif spans_tables:
+            suggestion = (
+                "split the alternatives into separate columns or rules, an OR "
+                "across tables can't be used to join them"
+            )
+        else:
+            suggestion = "rewrite the alternatives with IN or a lookup temp table"
+        message = f"`{constraint}` has {alternatives} alternatives"
+        findings.append(Finding(file, location, "or-predicate", message, suggestion))
+    return findings
+
+
+def _check_subqueries(
+    file: str, column: TargetColumn, scope: _Scope, target: str
+) -> List[Finding]:
+    outer = {target, *scope.schemas}
+    correlated = set()
+    for subquery in subqueries(column.expression):
+        correlated.update(correlations(subquery, outer))
+    if not correlated:
+        return list()
+    tables = ", ".join(sorted(correlated))
+    message = (
+        f"the expression has a subquery correlated with {tables}, which runs once "
+        "for every row updated"
+    )
+    suggestion = (
+        "add the table of the subquery to `tables` with its predicate in "
+        "`constraints`, or aggregate it once in a pre_init temp table"
+    )
+    return [Finding(file, column.name, "correlated-subquery", message, suggestion)]
+
+
+def _source_location(name: str) -> str:
+    return f"primary_key.sources.{name}"
+
+
+def lint_table(
+    file: str, table: TargetTable, catalog: Optional[Catalog] = None
+) -> List[Finding]:
+    """The slow patterns of the SQL of a table, checked against the catalog."""
+    catalog = catalog or load_catalog()
+    env = table.primary_key.update_environment(table.default_env)
+    target = table.name.lower()
+    findings = list()
+    for name, source in table.primary_key.sources.items():
+        scope = _Scope(table, catalog)
+        scope.add(source.table)
+        location, constraints = _source_location(name), list(source.constraints)
+        findings.extend(_check_wrapped(file, location, scope, constraints))
+        findings.extend(_check_or(file, location, scope, constraints))
+
+    for column in table.columns:
+        if not isinstance(column, TargetColumn) or not column.enabled:
+            continue
+        scope = _Scope(table, catalog)
+        scope.add(table.primary_key.sources[column.primary_key].table)
+        key = [p.to_sql() for p in env["PrimaryKeyConstraints"][column.primary_key]]
+        constraints = list(column.constraints or ())
+        findings.extend(
+            _check_cartesian(file, column, scope, [*key, *constraints], target)
+        )
+        findings.extend(_check_wrapped(file, column.name, scope, constraints))
+        findings.extend(_check_or(file, column.name, scope, constraints))
+        findings.extend(_check_subqueries(file, column, scope, target))
+    return findings
+
+
+def lint_rules(
+    rules: Iterable[Tuple[str, object]], catalog: Optional[Catalog] = None
+) -> List[Finding]:
+    findings = list()
+    for name, rule in rules:
+        if isinstance(rule, TargetTable):
+            findings.extend(lint_table(name, rule, catalog))
+    return findings
+
+
+def render_findings(findings: Iterable[Finding]) -> str:
+    lines = list()
+    for f in findings:
+        lines.append(f"{f.file}: {f.column}: [{f.check}] {f.message}")
+        lines.append(f"    {f.suggestion}")
+    return "\n".join(lines)
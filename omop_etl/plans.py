@@ -0,0 +1,362 @@
+import json
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from omop_etl.generation import (
+    AlterTableStatement,
+    AnalyzeStatement,
+    ChunkedStatement,
+    CreateIndexStatement,
+    CreateTableStatement,
+    CreateTempTableStatement,
+    DropIndexStatement,
+    DropTableStatement,
+    InsertFromStatement,
+    Script,
+    Serializable,
+    UpdateStatement,
+    transaction_control,
+)
+
+Plan = Dict[str, Any]
+
+
+def explainable(stmt: Serializable) -> bool:
+    """Whether the statement is a single query EXPLAIN accepts.
+
+    Chunked statements are procedural blocks and promoted temp tables are
+    dropped and created by two statements, so only their time is measured.
+    """
+    if isinstance(stmt, CreateTempTableStatement):
+        return stmt.schema is None
+    return isinstance(stmt, (UpdateStatement, InsertFromStatement))
+
+
+def explain_statement(stmt: Serializable) -> str:
+    return f"explain (analyze, buffers, format json) {stmt.to_sql()}"
+
+
+def planned_query(stmt: Serializable) -> Optional[str]:
+    """The query EXPLAIN estimates for a statement, if it has one.
+
+    A chunked statement is estimated as a whole and a temp table by the query
+    it is created from.
+    """
+    if isinstance(stmt, ChunkedStatement):
+        stmt = stmt.statement
+    if isinstance(stmt, (UpdateStatement, InsertFromStatement)):
+        return stmt.to_sql()
+    if isinstance(stmt, CreateTempTableStatement):
+        return stmt.query
+    return None
+
+
+def planning_setup(stmt: Serializable) -> Optional[str]:
+    """What runs for the statements after this one to be planned, if anything.
+
+    Temp tables are created without data, the mapping tables unless they
+    exist and the rest of the definitions as they are, while the statements
+    that write rows are only estimated. The indexes, statistics and constraints
+    of the loaded tables don't change the plans enough to be worth building.
+    Nothing may end the transaction the plans are made in and rolled back, so
+    the statements beginning and ending transaction blocks are left out, and
+    so are the scripts of the dependencies, which can commit.
+    """
+    if isinstance(stmt, CreateTableStatement):
+        return replace(stmt, if_not_exists=True).to_sql()
+    if isinstance(stmt, CreateTempTableStatement):
+        if stmt.schema is None:
+            return f"create temp table {stmt.alias} as {stmt.query} with no data;"
+        table = f"{stmt.schema}.{stmt.alias}"
+        return (
+            f"drop table if exists {table};\n"
+            f"create unlogged table {table} as {stmt.query} with no data;"
+        )
+    skipped = (
+        ChunkedStatement,
+        UpdateStatement,
+        InsertFromStatement,
+        CreateIndexStatement,
+        AnalyzeStatement,
+        DropIndexStatement,
+        DropTableStatement,
+        AlterTableStatement,
+    )
+    if isinstance(stmt, (*skipped, Script)) or transaction_control(stmt):
+        return None
+    return stmt.to_sql()
+
+
+def statement_target(stmt: Serializable) -> Tuple[Optional[str], Tuple[str, ...]]:
+    """The table a statement writes to and the columns it fills."""
+    if isinstance(stmt, ChunkedStatement):
+        stmt = stmt.statement
+    if isinstance(stmt, UpdateStatement):
+        return stmt.column.table.to_sql(), stmt.columns
+    if isinstance(stmt, InsertFromStatement):
+        return stmt.target.to_sql(), stmt.columns
+    if isinstance(stmt, CreateTempTableStatement):
+        return stmt.alias, tuple()
+    return None, tuple()
+
+
+def iter_nodes(node: Plan) -> Iterator[Plan]:
+    yield node
+    for child in node.get("Plans", tuple()):
+        yield from iter_nodes(child)
+
+
+def total_time(node: Plan) -> float:
+    """The time spent in a node and its children over all its loops, in ms."""
+    return node.get("Actual Total Time", 0.0) * node.get("Actual Loops", 1)
+
+
+def exclusive_time(node: Plan) -> float:
+    """The time spent in the node itself, without its children, in ms."""
+    children = sum(total_time(child) for child in node.get("Plans", tuple()))
+    return max(total_time(node) - children, 0.0)
+
+
+def node_label(node: Plan) -> str:
+    label = node["Node Type"]
+    if "Index Name" in node:
+        label = f"{label} using {node['Index Name']}"
+    if "Relation Name" in node:
+        label = f"{label} on {node['Relation Name']}"
+        alias = node.get("Alias")
+        if alias is not None and alias != node["Relation Name"]:
+            label = f"{label} {alias}"
+    return label
+
+
+def most_expensive_node(plan: Plan) -> Tuple[str, float]:
+    """The node the most time is spent in, with that time."""
+    node = max(iter_nodes(plan), key=exclusive_time)
+    return node_label(node), exclusive_time(node)
+
+
+def scanned_relations(plan: Plan) -> Set[str]:
+    """The tables the plan reads sequentially, qualified by their schema."""
+    return {
+        _relation(node) for node in iter_nodes(plan) if node["Node Type"] == "Seq Scan"
+    }
+
+
+def _relation(node: Plan) -> str:
+    if "Schema" in node:
+        return f"{node['Schema']}.{node['Relation Name']}"
+    return node["Relation Name"]
+
+
+def produced_rows(plan: Plan, estimated: bool = False) -> int:
+    """The rows a statement returned or, for a modification, wrote."""
+    if plan["Node Type"] == "ModifyTable" and plan.get("Plans"):
+        plan = plan["Plans"][0]
+    if estimated:
+        return int(plan["Plan Rows"])
+    return int(plan.get("Actual Rows", 0) * plan.get("Actual Loops", 1))
+
+
+@dataclass
+class StatementProfile:
+    """How long a statement took, what it wrote and where its time went.
+
+    Times are in milliseconds and buffers in blocks. The plan details are only
+    known for the statements that could be explained.
+    """
+
+    rule: str
+    table: Optional[str]
+    columns: Tuple[str, ...]
+    time: float
+    rows: Optional[int] = None
+    shared_hit: Optional[int] = None
+    shared_read: Optional[int] = None
+    temp_written: Optional[int] = None
+    node: Optional[str] = None
+    node_time: Optional[float] = None
+
+    @staticmethod
+    def from_explain(
+        rule: str, stmt: Serializable, time: float, explained: Optional[List[Plan]]
+    ) -> "StatementProfile":
+        """The profile of a statement, from the output of EXPLAIN if it has one."""
+        table, columns = statement_target(stmt)
+        profile = StatementProfile(rule, table, tuple(columns), time)
+        if explained:
+            plan = explained[0]["Plan"]
+            profile.rows = produced_rows(plan)
+            profile.shared_hit = plan.get("Shared Hit Blocks")
+            profile.shared_read = plan.get("Shared Read Blocks")
+            profile.temp_written = plan.get("Temp Written Blocks")
+            profile.node, profile.node_time = most_expensive_node(plan)
+        return profile
+
+
+@dataclass
+class Thresholds:
+    """The estimates above which a statement is flagged.
+
+    A join explodes when it estimates more than ``row_explosion`` times the
+    rows of its largest input, and a table is large from ``seq_scan_rows``.
+    """
+
+    max_cost: Optional[float] = None
+    row_explosion: float = 10.0
+    seq_scan_rows: float = 1_000_000
+
+    def check(self, plan: Plan, table_rows: Dict[str, float]) -> List[str]:
+        """Describe the estimates of the plan that exceed the thresholds.
+
+        ``table_rows`` is the estimated size of the tables, by qualified name.
+        """
+        warnings = list()
+        cost = plan["Total Cost"]
+        if self.max_cost is not None and cost > self.max_cost:
+            warnings.append(f"cost {cost:,.0f} exceeds {self.max_cost:,.0f}")
+        for node in iter_nodes(plan):
+            if "Join Type" in node and node.get("Plans"):
+                largest = max(child["Plan Rows"] for child in node["Plans"])
+                if node["Plan Rows"] > self.row_explosion * max(largest, 1):
+                    warnings.append(
+                        f"{node_label(node)} estimates {node['Plan Rows']:,.0f} rows "
+                        f"from inputs of at most {largest:,.0f}"
+                    )
+            if node["Node Type"] == "Seq Scan":
+                rows = table_rows.get(_relation(node))
+                if rows is not None and rows >= self.seq_scan_rows:
+                    warnings.append(
+                        f"sequential scan on {_relation(node)} of {rows:,.0f} rows"
+                    )
+        return warnings
+
+
+@dataclass
+class StatementEstimate:
+    """What the planner expects a statement to cost and to write."""
+
+    rule: str
+    table: Optional[str]
+    columns: Tuple[str, ...]
+    cost: float
+    rows: int
+    warnings: List[str] = field(default_factory=list)
+
+    @staticmethod
+    def from_explain(
+        rule: str,
+        stmt: Serializable,
+        explained: List[Plan],
+        thresholds: Thresholds,
+        table_rows: Dict[str, float],
+    ) -> "StatementEstimate":
+        table, columns = statement_target(stmt)
+        plan = explained[0]["Plan"]
+        return StatementEstimate(
+            rule,
+            table,
+            tuple(columns),
+            plan["Total Cost"],
+            produced_rows(plan, estimated=True),
+            thresholds.check(plan, table_rows),
+        )
+
+
+def write_profiles(path: Path, profiles: Iterable[StatementProfile]) -> None:
+    path.write_text(json.dumps([asdict(p) for p in profiles], indent=2))
+
+
+def read_profiles(path: Path) -> List[StatementProfile]:
+    profiles = list()
+    for data in json.loads(path.read_text()):
+        data["columns"] = tuple(data["columns"])
+        profiles.append(StatementProfile(**data))
+    return profiles
+
+
+def _render_table(header: List[str], rows: List[List[str]], numeric: int) -> str:
+    """Align the columns of a table, the first ``numeric`` to the right."""
+    widths = [max(len(row[i]) for row in [header, *rows]) for i in range(len(header))]
+    lines = list()
+    for row in [header, *rows]:
+        cells = [
+            cell.rjust(width) if i < numeric else cell.ljust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        ]
+        lines.append("  ".join(cells).rstrip())
+    return "\n".join(lines)
+
+
+def _number(value: Optional[float], digits: int = 0) -> str:
+    return "" if value is None else f"{value:,.{digits}f}"
+
+
+def render_report(profiles: Iterable[StatementProfile], top: int = 20) -> str:
+    """The rules and the statements that took the most time, slowest first."""
+    profiles = list(profiles)
+    totals: Dict[str, float] = dict()
+    for profile in profiles:
+        totals[profile.rule] = totals.get(profile.rule, 0.0) + profile.time
+    rules = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+    statements = sorted(profiles, key=lambda p: p.time, reverse=True)[:top]
+
+    rule_rows = [[_number(time, 1), rule] for rule, time in rules]
+    statement_rows = [
+        [
+            _number(p.time, 1),
+            _number(p.rows),
+            _number(p.shared_hit),
+            _number(p.shared_read),
+            p.rule,
+            p.table or "",
+            ", ".join(p.columns),
+            "" if p.node is None else f"{p.node} ({_number(p.node_time, 1)} ms)",
+        ]
+        for p in statements
+    ]
+    return "\n\n".join(
+        [
+            _render_table(["time (ms)", "rule"], rule_rows, 1),
+            _render_table(
+                [
+                    "time (ms)",
+                    "rows",
+                    "hit",
+                    "read",
+                    "rule",
+                    "table",
+                    "columns",
+                    "most expensive node",
+                ],
+                statement_rows,
+                4,
+            ),
+        ]
+    )
+
+
+def render_estimates(estimates: Iterable[StatementEstimate]) -> str:
+    """The estimates of the statements, the most expensive first, and the
+    warnings of the flagged ones."""
+    estimates = sorted(estimates, key=lambda e: e.cost, reverse=True)
+    rows = [
+        [
+            _number(e.cost),
+            _number(e.rows),
+            "!" if e.warnings else "",
+            e.rule,
+            e.table or "",
+            ", ".join(e.columns),
+        ]
+        for e in estimates
+    ]
+    header = ["cost", "rows", "", "rule", "table", "columns"]
+    sections = [_render_table(header, rows, 2)]
+    for e in estimates:
+        if e.warnings:
+            target = ", ".join(e.columns) or e.table or ""
+            lines = [f"{e.rule} {target}".rstrip()]
+            lines.extend(f"  {warning}" for warning in e.warnings)
+            sections.append("\n".join(lines))
+    return "\n\n".join(sections)
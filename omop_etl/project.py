@@ -0,0 +1,351 @@
+import copy
+from concurrent.futures import Executor
+from functools import partial
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from pydantic import Field
+
+from omop_etl.bundle import Rule, is_bundle, read_bundle
+from omop_etl.cache import CompileCache, environment_key
+from omop_etl.schema import (
+    BaseModel,
+    CompileMode,
+    Dependency,
+    Environment,
+    TableStorage,
+    TargetTable,
+    load_yaml,
+)
+
+
+def rule_files(rules: Path) -> List[Tuple[str, Path]]:
+    return [(".".join(fn.name.split(".")[:-1]), fn) for fn in rules.iterdir()]
+
+
+def parse_rule(s: str) -> Rule:
+    """Parse a rule file, as a table when it names one and has a primary key."""
+    data = load_yaml(s)
+    if isinstance(data, dict) and "name" in data and "primary_key" in data:
+        return TargetTable.parse_obj(data)
+    return Dependency.parse_obj(data)
+
+
+def load_rules(rules: Path) -> List[Tuple[str, Rule]]:
+    """Load the rules of a directory or of a bundle."""
+    if is_bundle(rules):
+        return read_bundle(rules)
+    return [(name, parse_rule(fn.read_text())) for name, fn in rule_files(rules)]
+
+
+def split_rules(
+    rules: Iterable[Tuple[str, Rule]]
+) -> Tuple[List[Tuple[str, Dependency]], List[Tuple[str, TargetTable]]]:
+    """Separate the dependencies from the target tables, keeping their order."""
+    rules = list(rules)
+    deps = [(n, r) for n, r in rules if not isinstance(r, TargetTable)]
+    tables = [(n, r) for n, r in rules if isinstance(r, TargetTable)]
+    return deps, tables
+
+
+def table_environment(
+    table: Union[TargetTable, "RuleFile"],
+    envs: Dict[str, Environment],
+    options: Environment = None,
+) -> Environment:
+    """The environment of a table once the dependencies it depends on have run."""
+    env = table.default_env
+    env.update(options or dict())
+    if table.depends_on is not None:
+        for dep in table.depends_on:
+            if dep in envs:
+                schema = envs[dep]["DefaultSchema"]
+                if schema is not None:
+                    env["DefaultSchema"] = schema
+                env["TempTables"] = {
+                    *env["TempTables"],
+                    *envs[dep]["TempTables"],
+                }
+    return env
+
+
+class CompileOptions(BaseModel):
+    """The options of the ``compile`` command, as the environment they set."""
+
+    drop_tables: bool = False
+    fuse_updates: bool = False
+    mode: CompileMode = CompileMode.update
+    index_mapping: bool = False
+    chunk_size: Optional[int] = Field(None, ge=1)
+    incremental: bool = False
+    mapping_storage: TableStorage = TableStorage()
+    prune_tables: bool = True
+
+    def environment(self) -> Environment:
+        return {
+            "DropTables": self.drop_tables,
+            "FuseUpdates": self.fuse_updates,
+            "Mode": self.mode,
+            "IndexMapping": self.index_mapping,
+            "ChunkSize": self.chunk_size,
+            "Incremental": self.incremental,
+            "MappingStorage": self.mapping_storage,
+            "PruneTables": self.prune_tables,
+        }
+
+
+class RuleFile:
+    """A rule file that is only parsed and translated when the cache misses."""
+
+    def __init__(
+        self, name: str, content: bytes, cache: CompileCache, rule: Rule = None
+    ) -> None:
+        self.name = name
+        self.content = content
+        self.cache = cache
+        self._rule = rule
+        self._meta = None
+
+    @staticmethod
+    def load(rules: Path, cache: CompileCache) -> List["RuleFile"]:
+        """The rule files of a directory, or the rules of a bundle."""
+        if is_bundle(rules):
+            return RuleFile.from_rules(read_bundle(rules), cache)
+        return [
+            RuleFile(name, path.read_bytes(), cache) for name, path in rule_files(rules)
+        ]
+
+    @staticmethod
+    def from_rules(
+        rules: Iterable[Tuple[str, Rule]], cache: CompileCache
+    ) -> List["RuleFile"]:
+        """Rule files of rules that are already validated."""
+        return [
+            RuleFile(name, rule.json(by_alias=True).encode(), cache, rule)
+            for name, rule in rules
+        ]
+
+    @property
+    def meta(self) -> Dict[str, Any]:
+        """What the compilation needs to know of the rule before translating it."""
+        if self._meta is None:
+            key = self.cache.digest("meta", self.content)
+            self._meta = self.cache.fetch(key, self.describe)
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta: Dict[str, Any]) -> None:
+        self._meta = meta
+
+    @property
+    def rule(self) -> Rule:
+        if self._rule is None:
+            self._rule = parse_rule(self.content.decode())
+        return self._rule
+
+    def describe(self) -> Dict[str, Any]:
+        rule = self.rule
+        warnings = list()
+        if isinstance(rule, TargetTable):
+            warnings = [
+                f"{rule.columns[i].name}: {reason}"
+                for i, _, reason in rule.redundant_tables()
+            ]
+        return {
+            "table": rule.name if isinstance(rule, TargetTable) else None,
+            "depends_on": rule.depends_on,
+            "default_env": rule.default_env,
+            "warnings": warnings,
+        }
+
+    @property
+    def table_name(self) -> Optional[str]:
+        return self.meta["table"]
+
+    @property
+    def depends_on(self) -> Optional[List[str]]:
+        return self.meta["depends_on"]
+
+    @property
+    def warnings(self) -> List[str]:
+        """What is wrong with the rule without keeping it from translating."""
+        return self.meta.get("warnings", list())
+
+    @property
+    def default_env(self) -> Environment:
+        env = dict(self.meta["default_env"])
+        env["TempTables"] = set(env["TempTables"])
+        return env
+
+    def translate(
+        self, kind: str, env: Environment, translate: Callable[[Environment], Any]
+    ) -> Any:
+        key = self.cache.digest(kind, self.content, environment_key(env))
+        return self.cache.fetch(key, lambda: translate(env))
+
+    def translate_script(self, options: Environment) -> str:
+        """The script of the rule on its own, as written to a file of its own."""
+        if self.table_name is None:
+            return self.translate_dependency()["script"]
+        env = self.default_env
+        env.update(options)
+        return self.translate("script", env, lambda env: self.rule.get_script(env=env))
+
+    def translate_dependency(self) -> Dict[str, Any]:
+        """The script of a dependency and the environment it leaves."""
+
+        def translate_dependency(env: Environment):
+            stmts, env = self.rule.translate(env)
+            env = {k: env[k] for k in ("DefaultSchema", "TempTables")}
+            return {"script": "\n".join([s.to_sql() for s in stmts]), "env": env}
+
+        return self.translate("dependency", self.default_env, translate_dependency)
+
+    def translate_table(self, env: Environment) -> Tuple[str, str]:
+        """The initialization and the processing of a table, translated at once."""
+        initialized = dict()
+
+        def translate_initialization(env: Environment):
+            init, initialized["env"] = self.rule.get_initialization(env)
+            return init
+
+        def translate_process(env: Environment):
+            if "env" not in initialized:
+                _, initialized["env"] = self.rule.translate_initialization(env)
+            env = initialized["env"]
+            return self.rule.get_script(env=env, include_initialization=False)
+
+        # the initialization fills the environment the processing is keyed by
+        init = self.translate("init", copy.deepcopy(env), translate_initialization)
+        return init, self.translate("process", env, translate_process)
+
+
+def compile_rules(
+    rules: Path, options: Environment, cache: CompileCache = None
+) -> Tuple[str, List[str]]:
+    """Translate the rules into a single script and list the tables it loads."""
+    files = RuleFile.load(rules, cache or CompileCache())
+    names = [f.table_name for f in files if f.table_name is not None]
+    return "".join(iter_compile(files, options)), names
+
+
+def _lines(statements: Iterable[str]) -> Iterator[str]:
+    for i, stmt in enumerate(statements):
+        yield f"\n{stmt}" if i else stmt
+    yield "\n"
+
+
+def _dependency_environment(translated: Dict[str, Any]) -> Environment:
+    env = dict(translated["env"])
+    env["TempTables"] = set(env["TempTables"])
+    return env
+
+
+def _translate_independent(file: RuleFile, options: Environment) -> Dict[str, Any]:
+    """Describe a rule file and translate it when it doesn't depend on another.
+
+    Run by the workers, so a rule is parsed and translated by the same one.
+    """
+    if file.table_name is None:
+        return {"meta": file.meta, "dependency": file.translate_dependency()}
+    if not file.depends_on:
+        env = table_environment(file, dict(), options)
+        return {"meta": file.meta, "table": file.translate_table(env)}
+    return {"meta": file.meta}
+
+
+def _iter_compile_concurrently(
+    files: List[RuleFile], options: Environment, executor: Executor
+) -> Iterator[str]:
+    translate = partial(_translate_independent, options=options)
+    translated = list(executor.map(translate, files))
+    for file, result in zip(files, translated):
+        file.meta = result["meta"]
+
+    envs = dict()
+    for file, result in zip(files, translated):
+        if "dependency" in result:
+            yield f"{result['dependency']['script']}\n"
+            envs[file.name] = _dependency_environment(result["dependency"])
+
+    # the tables that depend on others, now that their environments are known
+    pending = {
+        i: executor.submit(file.translate_table, table_environment(file, envs, options))
+        for i, (file, result) in enumerate(zip(files, translated))
+        if file.table_name is not None and "table" not in result
+    }
+    scripts = [
+        pending[i].result() if i in pending else result["table"]
+        for i, (file, result) in enumerate(zip(files, translated))
+        if file.table_name is not None
+    ]
+    yield from (f"{init}\n" for init, _ in scripts)
+    yield from (f"{process}\n" for _, process in scripts)
+
+
+def iter_compile(
+    files: List[RuleFile], options: Environment, executor: Optional[Executor] = None
+) -> Iterator[str]:
+    """Translate the rules into a single script, one piece at a time.
+
+    The dependencies come first, then the initialization of every table and
+    then their processing. Without a cache, the processing is rendered one
+    statement at a time so the script is never held in memory.
+
+    With an executor, the rules are parsed and translated at the same time,
+    the tables that depend on others once the environments they need are
+    known. The script is the same, but it is only written once every table is
+    translated.
+    """
+    if executor is not None:
+        yield from _iter_compile_concurrently(files, options, executor)
+        return
+
+    deps = [f for f in files if f.table_name is None]
+    tables = [f for f in files if f.table_name is not None]
+
+    envs = dict()
+    for dep in deps:
+        translated = dep.translate_dependency()
+        yield f"{translated['script']}\n"
+        envs[dep.name] = _dependency_environment(translated)
+
+    initialized = dict()
+    for table in tables:
+
+        def translate_initialization(env: Environment, table=table):
+            init, initialized[table.name] = table.rule.get_initialization(env)
+            return init
+
+        env = table_environment(table, envs, options)
+        yield f"{table.translate('init', env, translate_initialization)}\n"
+
+    for table in tables:
+
+        def initialization(env: Environment, table=table) -> Environment:
+            if table.name in initialized:
+                return initialized.pop(table.name)
+            # the initialization was cached, the environment it leaves isn't
+            _, env = table.rule.translate_initialization(env)
+            return env
+
+        def translate_process(env: Environment, table=table):
+            env = initialization(env)
+            return table.rule.get_script(env=env, include_initialization=False)
+
+        env = table_environment(table, envs, options)
+        if table.cache.directory is None:
+            env = initialization(env)
+            yield from _lines(table.rule.iter_script(env, include_initialization=False))
+        else:
+            yield f"{table.translate('process', env, translate_process)}\n"
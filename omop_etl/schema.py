@@ -1,14 +1,28 @@
+import csv
 import re
+from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Tuple, Type, TypeVar, Union
+from types import MappingProxyType
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
-import pandas as pd
 import pydantic
-from sqlalchemy import table
 import yaml
-from fastapi.params import Query
 from pydantic import Field, root_validator, validator
 
+from omop_etl.analysis import mentioned_tables, unqualified_names
 from omop_etl.generation import *
 
 C = TypeVar("C", bound="BaseModel")
@@ -34,24 +48,64 @@ class Translatable(ABC):
         raise NotImplementedError
 
 
+# libyaml is much faster when PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
+
+
+def load_yaml(s) -> Any:
+    return yaml.load(s, Loader=YAML_LOADER)
+
+
 class BaseModel(pydantic.BaseModel):
     @classmethod
     def parse_string(cls: Type[C], s) -> C:
-        data = yaml.load(s, Loader=yaml.FullLoader)
+        data = load_yaml(s)
         return cls.parse_obj(data)
 
 
 class RequiredFields:
+    """The columns of the OMOP tables that can't be null, read from the data of
+    the package the first time they are needed."""
+
+    path = Path(__file__).parent / "data" / "required_omop_columns.csv"
+
     def __init__(self) -> None:
-        self.df = pd.read_csv(Path("schema", "required_omop_columns.csv"))
+        self._fields: Optional[Mapping[str, FrozenSet[str]]] = None
 
-    def get_fields(self, name):
-        return set(self.df[self.df.table == name.lower()]["column"])
+    @property
+    def fields(self) -> Mapping[str, FrozenSet[str]]:
+        if self._fields is None:
+            fields = dict()
+            with self.path.open(newline="") as f:
+                for row in csv.DictReader(f):
+                    fields.setdefault(row["table"], set()).add(row["column"])
+            self._fields = MappingProxyType(
+                {table: frozenset(columns) for table, columns in fields.items()}
+            )
+        return self._fields
+
+    def get_fields(self, name) -> FrozenSet[str]:
+        return self.fields.get(name.lower(), frozenset())
 
 
 REQUIRED_FIELDS = RequiredFields()
 
 
+class CompileMode(str, Enum):
+    """How the rows of the OMOP tables are built.
+
+    ``update`` inserts the ids of the mapping table and then fills each column
+    with its own update. ``insert`` builds every row in a single insert.
+    ``staged`` first computes each group of columns into its own table and
+    then builds the rows by joining them, so the groups can be computed on
+    separate connections.
+    """
+
+    update = "update"
+    insert = "insert"
+    staged = "staged"
+
+
 class BaseColumn(BaseModel):
     name: str
     enabled = True
@@ -70,7 +124,11 @@ class TempTable(Query):
         if "TempTables" not in env:
             env["TempTables"] = set()
         env["TempTables"].add(self.alias)
-        return [CreateTempTableStatement(alias=self.alias, query=self.query)], env
+        schema = None
+        if self.alias.lower() in env.get("PromotedTables", set()):
+            schema = env.get("StagingSchema", "staging")
+        stmt = CreateTempTableStatement(self.alias, self.query, schema=schema)
+        return [stmt], env
 
 
 class TableReference(BaseModel, Translatable):
@@ -96,6 +154,9 @@ class TableReference(BaseModel, Translatable):
             schema = self.table_schema
         if self.alias in env["TempTables"]:
             schema = None
+        if self.alias.lower() in env.get("PromotedTables", set()):
+            # read from the staging schema by the rules that didn't create it
+            schema = env.get("StagingSchema", "staging")
 
         table = Table(self.alias, schema)
 
@@ -118,17 +179,44 @@ class ConstantTargetColumn(BaseColumn, Translatable):
 
         target_table = Table(target_table, "omop")
         col = Column(self.name, target_table)
+        criterion = None
+        if env.get("Incremental", False):
+            # the rows of the previous loads already have the constant
+            predicate = f"{col.to_sql()} is distinct from {self.constant_expression}"
+            criterion = Criterion([Expression(predicate)])
+        return [UpdateStatement(col, self.constant_expression, criterion)], env
+
+    @property
+    def constant_expression(self) -> Expression:
         if isinstance(self.constant, str):
-            const = f"'{self.constant}'"
-        else:
-            const = self.constant
-        return [UpdateStatement(col, Expression(const))], env
+            return Expression(f"'{self.constant}'")
+        return Expression(self.constant)
+
+
+WATERMARK_TABLE = Table("etl_watermark", "mapping")
+
+
+def create_watermark_table() -> Statement:
+    state = WATERMARK_TABLE.to_sql()
+    return Statement(
+        f"create table if not exists {state} (target_table text, source text,"
+        " value text, pending text, primary key (target_table, source));"
+    )
+
+
+class Watermark(BaseModel):
+    """A column of a source that grows whenever a row is added or updated,
+    such as ``updt_dt_tm``."""
+
+    column: str
+    datatype: str = "timestamp"
 
 
 class PrimaryKeySource(BaseColumn, Translatable):
     table: Union[Query, TableReference, str]
     columns: Dict[str, str]
     constraints: List[str] = tuple()
+    watermark: Optional[Watermark] = None
 
     @validator("table", pre=True)
     def check_add_default_primary_key(cls, source, values, **kwargs):
@@ -146,15 +234,60 @@ class PrimaryKeySource(BaseColumn, Translatable):
         select_cols = tuple(
             [Expression(f"{table_ref}.{c} as {table_ref}_{c}") for c, _ in cols]
         )
-        crit = (
-            Criterion([Expression(s) for s in self.constraints])
-            if len(self.constraints) > 0
-            else None
-        )
+        predicates = [Expression(s) for s in self.constraints]
+        on_conflict = None
+        if env.get("Incremental", False):
+            # keys already in the mapping table are skipped by its unique index
+            on_conflict = "do nothing"
+            if self.watermark is not None:
+                predicates.append(self.watermark_predicate(env, table_ref))
+        crit = Criterion(predicates) if len(predicates) > 0 else None
 
         select = SelectStatement(expressions=select_cols, source=tables, criterion=crit)
-        stmts = [InsertFromStatement(pk_cols, Table(target_table, "mapping"), select)]
-        return (stmts, env)
+        stmt = InsertFromStatement(
+            pk_cols, Table(target_table, "mapping"), select, on_conflict=on_conflict
+        )
+
+        chunk_size = env.get("ChunkSize")
+        column, dtype = next(iter(cols))
+        if chunk_size and INTEGER_TYPES.match(dtype):
+            key = Expression(f"{table_ref}.{column}")
+            bounds = SelectStatement(
+                expressions=(Expression(f"min({key})"), Expression(f"max({key})")),
+                source=tables,
+                criterion=crit,
+            )
+            stmt = ChunkedStatement(stmt, keys=(key,), bounds=bounds, size=chunk_size)
+        return ([stmt], env)
+
+    def watermark_predicate(self, env: Environment, table_ref: str) -> Expression:
+        """Keep the rows changed since the last load of this source."""
+        state = WATERMARK_TABLE.to_sql()
+        column, datatype = self.watermark.column, self.watermark.datatype
+        return Expression(
+            f"not exists (select 1 from {state}"
+            f" where {state}.target_table = '{env['TargetTable']}'"
+            f" and {state}.source = '{self.name}'"
+            f" and {state}.value::{datatype} >= {table_ref}.{column})"
+        )
+
+    def track_watermark(self, env: Environment) -> InsertFromStatement:
+        """Record the watermark the source has reached before the load as pending."""
+        tables, _ = self.table.translate(env)
+        table_ref = tables[0].alias
+        select = SelectStatement(
+            expressions=(
+                Expression(f"'{env['TargetTable']}'"),
+                Expression(f"'{self.name}'"),
+                Expression(f"max({table_ref}.{self.watermark.column})::text"),
+            ),
+            source=tables,
+            criterion=Criterion([Expression(s) for s in self.constraints]) or None,
+        )
+        on_conflict = "(target_table, source) do update set pending = excluded.pending"
+        return InsertFromStatement(
+            ("target_table", "source", "pending"), WATERMARK_TABLE, select, on_conflict
+        )
 
     class Config:
         @staticmethod
@@ -208,15 +341,89 @@ class TargetColumn(BaseColumn, Translatable):
         assert "PrimaryKeyConstraints" in env
         assert "TargetTable" in env
         target_table = env["TargetTable"]
-        constraints = env["PrimaryKeyConstraints"]
 
         if not self.enabled:
             return None, env
 
+        frm, whr, exp = self.translate_source(env, env["PrimaryKeyConstraints"])
+
+        col = Column(self.name, Table(target_table, "omop"))
+        statements = [UpdateStatement(col, expression=exp, criterion=whr, source=frm)]
+        return (statements, env)
+
+    @property
+    def reference(self) -> Optional[Tuple[str, str]]:
+        """The mapping table and column the values of the column are looked up in."""
+        if self.references is None:
+            return None
+        if isinstance(self.references, ForeignKey):
+            return self.references.table, self.references.column
+        ref_mapping_table, *_ = self.references.keys()
+        ref = self.references[ref_mapping_table]
+        return ref_mapping_table, f"{ref.table}_{ref.column}"
+
+    def translate_select(self, env: Environment) -> SelectStatement:
+        """Select the value of the column for each id of the mapping table."""
+        assert "MappingConstraints" in env
+        frm, whr, exp = self.translate_source(env, env["MappingConstraints"])
+        mapping_id = Expression(f"{frm[0].to_sql()}.id")
+        return SelectStatement(
+            expressions=(
+                Expression(f"{mapping_id} as id"),
+                Expression(f"{exp} as {self.name}"),
+            ),
+            source=frm,
+            criterion=whr,
+            distinct_on=(mapping_id,),
+        )
+
+    def redundant_tables(
+        self, env: Environment, constraints: Dict[str, Criterion]
+    ) -> Dict[int, str]:
+        """The entries of ``tables`` the column doesn't need, by their position,
+        with the reason.
+
+        An entry is redundant when the mapping tables or an earlier entry are
+        the same table, or when neither the expression, the constraints nor
+        the primary key criteria use it. A table is only known to be unused
+        when every column they refer to is qualified by its table.
+        """
+        criteria = constraints[self.primary_key].predicates
+        sql = "\n".join([self.expression, *(self.constraints or ()), *criteria])
+        qualified = not unqualified_names(sql)
+        seen = {Table(env["TargetTable"], "mapping").to_sql().lower()}
+        if self.references is not None:
+            seen.add(Table(self.reference[0], "mapping").to_sql().lower())
+
+        redundant = dict()
+        for i, table in enumerate(self.tables):
+            [source], _ = table.translate(env)
+            # unquoted names are case insensitive
+            name = source.to_sql().lower() if isinstance(source, Table) else source
+            if name in seen:
+                redundant[i] = f'Table "{table.alias}" is listed twice'
+            elif qualified and not mentioned_tables(sql, [table.alias.lower()]):
+                redundant[i] = f'Table "{table.alias}" is not used'
+            seen.add(name)
+        return redundant
+
+    def translate_source(
+        self, env: Environment, constraints: Dict[str, Criterion]
+    ) -> Tuple[List[Table], Criterion, Expression]:
+        target_table = env["TargetTable"]
+
         frm = [Table(target_table, "mapping")]
 
-        whr = Criterion(constraints[self.primary_key])
-        frm.extend(t for table in self.tables for t in table.translate(env)[0])
+        whr = list(constraints[self.primary_key])
+        redundant = dict()
+        if env.get("PruneTables", True):
+            redundant = self.redundant_tables(env, constraints)
+        frm.extend(
+            t
+            for i, table in enumerate(self.tables)
+            if i not in redundant
+            for t in table.translate(env)[0]
+        )
 
         if self.constraints:
             whr.extend(self.constraints)
@@ -224,13 +431,7 @@ class TargetColumn(BaseColumn, Translatable):
         exp = self.expression
 
         if self.references is not None:
-            if isinstance(self.references, ForeignKey):
-                ref_mapping_table = self.references.table
-                ref_mapping_column = self.references.column
-            else:
-                ref_mapping_table, *_ = self.references.keys()
-                ref = self.references[ref_mapping_table]
-                ref_mapping_column = f"{ref.table}_{ref.column}"
+            ref_mapping_table, ref_mapping_column = self.reference
 
             t = Table(ref_mapping_table, "mapping")
             frm.append(t)
@@ -238,15 +439,51 @@ class TargetColumn(BaseColumn, Translatable):
             whr.append(Expression(f"{t.to_sql()}.{ref_mapping_column} = {exp}"))
             exp = f"{t.to_sql()}.id"
 
-        col = Column(self.name, Table(target_table, "omop"))
-        statements = [
-            UpdateStatement(col, expression=Expression(exp), criterion=whr, source=frm)
-        ]
-        return (statements, env)
+        return frm, Criterion(whr), Expression(exp)
+
+
+INTEGER_TYPES = re.compile(
+    r"\s*(smallint|integer|int|int2|int4|int8|bigint|serial|bigserial)\s*$",
+    re.IGNORECASE,
+)
+HASH_INDEX_TYPES = re.compile(
+    r"\s*(text|varchar|char|character|bpchar|uuid)\b", re.IGNORECASE
+)
+
+
+class TableStorage(BaseModel):
+    """Storage parameters of a generated table.
+
+    Mapping tables can always be rebuilt from the sources, so they can be
+    ``unlogged`` to avoid writing them to the WAL. With ``bulk_load`` the table
+    is created and filled in the same transaction, which lets PostgreSQL skip
+    the WAL for the inserts when ``wal_level`` is ``minimal``.
+    """
+
+    unlogged: bool = False
+    fillfactor: Optional[int] = Field(None, ge=10, le=100)
+    autovacuum_enabled: Optional[bool] = None
+    bulk_load: bool = False
+
+    @property
+    def options(self) -> Tuple[Tuple[str, str]]:
+        options = list()
+        if self.fillfactor is not None:
+            options.append(("fillfactor", str(self.fillfactor)))
+        if self.autovacuum_enabled is not None:
+            options.append(("autovacuum_enabled", str(self.autovacuum_enabled).lower()))
+        return tuple(options)
+
+    def merge(self, other: Optional["TableStorage"]) -> "TableStorage":
+        """Override these parameters with the ones explicitly set on ``other``."""
+        if other is None:
+            return self
+        return self.copy(update=other.dict(exclude_unset=True))
 
 
 class PrimaryKey(BaseColumn, Translatable):
     sources: Dict[str, PrimaryKeySource]
+    storage: Optional[TableStorage] = None
 
     @validator("sources", pre=True)
     def check_add_default_primary_key(cls, sources, values, **kwargs):
@@ -267,19 +504,87 @@ class PrimaryKey(BaseColumn, Translatable):
                 columns.append(ColumnDefinition(f"{table}_{col}", datatype=dtype))
 
         table = Table(env["TargetTable"], "mapping")
-        if "DropTables" in env and env["DropTables"]:
+        storage = self.get_storage(env)
+        incremental = env.get("Incremental", False)
+        if "DropTables" in env and env["DropTables"] and not incremental:
             stmts.append(DropTableStatement(table=table))
         stmts.append(
-            CreateTableStatement(primary_key=self.name, table=table, columns=columns,)
+            CreateTableStatement(
+                primary_key=self.name,
+                table=table,
+                columns=columns,
+                unlogged=storage.unlogged,
+                options=storage.options,
+                if_not_exists=incremental,
+            )
         )
+        if incremental:
+            for _, pk in self.sources.items():
+                keys = [f"{pk.table.alias}_{col}" for col in pk.columns]
+                stmts.append(
+                    CreateIndexStatement(table, keys, if_not_exists=True, unique=True)
+                )
+        return stmts
+
+    def create_indexes(self, env: Environment) -> List[Serializable]:
+        """Index every key column of the mapping table and analyze it.
+
+        The key columns are joined by the updates of this table and by the
+        ``references`` of other tables. Text keys get a hash index as they are
+        only compared for equality, all other keys a btree index.
+        """
+        table = Table(env["TargetTable"], "mapping")
+        stmts = list()
+        for _, pk in self.sources.items():
+            for col, dtype in pk.columns.items():
+                method = "hash" if HASH_INDEX_TYPES.match(dtype) else "btree"
+                column = f"{pk.table.alias}_{col}"
+                stmts.append(
+                    CreateIndexStatement(
+                        table,
+                        (column,),
+                        method=method,
+                        if_not_exists=env.get("Incremental", False),
+                    )
+                )
+        stmts.append(AnalyzeStatement(table))
         return stmts
 
+    def track_watermarks(self, env: Environment) -> List[Serializable]:
+        """Create the state table of the incremental loads and record the
+        watermarks reached by the sources of the table."""
+        stmts = [create_watermark_table()]
+        for _, pk in self.sources.items():
+            if pk.watermark is not None:
+                stmts.append(pk.track_watermark(env))
+        return stmts
+
+    def commit_watermarks(self, env: Environment) -> List[Serializable]:
+        """Once the table is loaded, the next load starts from the pending
+        watermarks."""
+        if not any(pk.watermark is not None for pk in self.sources.values()):
+            return []
+        state = WATERMARK_TABLE.to_sql()
+        target_table = env["TargetTable"]
+        criterion = Criterion([Expression(f"{state}.target_table = '{target_table}'")])
+        return [
+            UpdateStatement(
+                Column("value", WATERMARK_TABLE),
+                Expression("pending"),
+                criterion=criterion,
+            )
+        ]
+
+    def get_storage(self, env: Environment) -> TableStorage:
+        storage = env.get("MappingStorage") or TableStorage()
+        return storage.merge(self.storage)
+
     def update_environment(self, env: Environment) -> Environment:
         assert "TargetTable" in env
         target_table = env["TargetTable"]
         map_name = env["MappingTable"]
-        default_schema = env["DefaultSchema"]
         constraints = dict()
+        mapping_constraints = dict()
         for k, pk in self.sources.items():
             predicates = [
                 Expression(f"omop.{target_table}.{self.name} = {map_name}.id")
@@ -289,13 +594,8 @@ class PrimaryKey(BaseColumn, Translatable):
                 fq_table_ref = table_ref
             elif isinstance(pk.table, TableReference):
                 table_ref = pk.table.alias
-                pk_schema = pk.table.table_schema
-                if pk_schema is None:
-                    pk_schema = default_schema
-                if table_ref not in env["TempTables"]:
-                    fq_table_ref = f"{pk_schema}.{table_ref}"
-                else:
-                    fq_table_ref = table_ref
+                [table], _ = pk.table.translate(env)
+                fq_table_ref = table.to_sql()
             else:
                 raise ValueError(f"table of type {type(pk.table)} are not supported")
             predicates.extend(
@@ -304,28 +604,63 @@ class PrimaryKey(BaseColumn, Translatable):
                     for c in pk.columns
                 ]
             )
+            if env.get("Incremental", False) and pk.watermark is not None:
+                # only the rows of the sources that changed are updated
+                predicates.append(pk.watermark_predicate(env, fq_table_ref))
             constraints[k] = Criterion(predicates)
+            mapping_constraints[k] = Criterion(predicates[1:])
 
         env["PrimaryKeyConstraints"] = constraints
+        env["MappingConstraints"] = mapping_constraints
         return env
 
     def translate(self, env: Environment) -> TranslateResponse:
         env = self.update_environment(env)
         target_table = env["TargetTable"]
         stmts = list()
+        if env.get("Incremental", False):
+            stmts.extend(self.track_watermarks(env))
         stmts.extend(self.create_table(env))
         for pk, pk_data in self.sources.items():
             stmt, _ = pk_data.translate(env)
             stmts.extend(stmt)
-        select = SelectStatement(
-            expressions=(Expression(f"mapping.{target_table}.id"),),
-            source=(Table(target_table, "mapping"),),
-        )
-        stmts.append(
-            InsertFromStatement(
-                columns=(self.name,), target=Table(target_table, "omop"), source=select
+        if env.get("IndexMapping", False):
+            stmts.extend(self.create_indexes(env))
+        if env.get("Mode", CompileMode.update) == CompileMode.update:
+            criterion = None
+            if env.get("Incremental", False):
+                # the ids of the mapping table only grow
+                criterion = Criterion(
+                    [
+                        Expression(
+                            f"mapping.{target_table}.id > (select coalesce("
+                            f"max(omop.{target_table}.{self.name}), 0)"
+                            f" from omop.{target_table})"
+                        )
+                    ]
+                )
+            select = SelectStatement(
+                expressions=(Expression(f"mapping.{target_table}.id"),),
+                source=(Table(target_table, "mapping"),),
+                criterion=criterion,
             )
-        )
+            stmts.append(
+                InsertFromStatement(
+                    columns=(self.name,),
+                    target=Table(target_table, "omop"),
+                    source=select,
+                )
+            )
+            if env.get("ChunkSize"):
+                # the chunks of the updates are selected by the omop key
+                omop = Table(target_table, "omop")
+                index = CreateIndexStatement(omop, (self.name,), if_not_exists=True)
+                stmts.append(index)
+        if env.get("ChunkSize"):
+            # chunks commit on their own and can't run in a transaction block
+            return stmts, env
+        if self.get_storage(env).bulk_load:
+            stmts = [Statement("begin;"), *stmts, Statement("commit;")]
         return stmts, env
 
 
@@ -413,6 +748,19 @@ class TargetTable(Dependency):
             )
         return col
 
+    def redundant_tables(self, env: Environment = None) -> List[Tuple[int, int, str]]:
+        """The tables the columns list but don't need, as the position of the
+        column, the position of the table in its ``tables`` and the reason."""
+        _, env = self.translate_initialization(env)
+        return [
+            (i, j, reason)
+            for i, col in enumerate(self.columns)
+            if isinstance(col, TargetColumn) and col.enabled
+            for j, reason in col.redundant_tables(
+                env, env["PrimaryKeyConstraints"]
+            ).items()
+        ]
+
     def get_insert_statements(self) -> Iterable[str]:
         stmts = self.primary_key.get_insert_statements(self.name)
         return [stmt.to_sql() for stmt in stmts]
@@ -432,14 +780,24 @@ class TargetTable(Dependency):
         env: Environment = None,
         include_initialization: bool = True,
         include_process: bool = True,
+        mode: CompileMode = None,
     ):
-        stmts, _ = self.translate(
-            env=env,
-            include_initialization=include_initialization,
-            include_process=include_process,
+        return "\n".join(
+            self.iter_script(env, include_initialization, include_process, mode)
         )
-        stmts = [stmt.to_sql() for stmt in stmts]
-        return "\n".join(stmts)
+
+    def iter_script(
+        self,
+        env: Environment = None,
+        include_initialization: bool = True,
+        include_process: bool = True,
+        mode: CompileMode = None,
+    ) -> Iterator[str]:
+        """The statements of the script, rendered one at a time."""
+        env = env or self.default_env
+        stmts = self.iter_translate(env, include_initialization, include_process, mode)
+        for stmt in stmts:
+            yield stmt.to_sql()
 
     def get_initialization(self, env: Environment = None) -> Tuple[str, Environment]:
         stmts, env = self.translate_initialization(env)
@@ -451,6 +809,9 @@ class TargetTable(Dependency):
     ) -> Tuple[str, Environment]:
         env = env or self.default_env
         statements, env = self.translate_pre_init(env)
+        if env.get("Mode") == CompileMode.staged:
+            schema = env.get("StagingSchema", "staging")
+            statements.insert(0, Statement(f"create schema if not exists {schema};"))
 
         insert, env = self.primary_key.translate(env)
         statements.extend(insert)
@@ -465,16 +826,200 @@ class TargetTable(Dependency):
         env: Environment = None,
         include_initialization: bool = True,
         include_process: bool = True,
+        mode: CompileMode = None,
     ) -> TranslateResponse:
         env = env or self.default_env
-        script = list()
-        if include_initialization:
-            statements, env = self.translate_initialization(env)
-            script.extend(statements)
-        if include_process:
-            for col in self.columns:
-                statements, _ = col.translate(env)
-                if statements is not None:
-                    script.extend(statements)
+        script = list(
+            self.iter_translate(env, include_initialization, include_process, mode)
+        )
         return script, env
 
+    def iter_translate(
+        self,
+        env: Environment,
+        include_initialization: bool = True,
+        include_process: bool = True,
+        mode: CompileMode = None,
+    ) -> Iterator[Serializable]:
+        """Translate the table one statement at a time, updating ``env`` in place.
+
+        The updates of the columns are only translated as they are consumed,
+        unless they have to be fused.
+        """
+        if mode is not None:
+            env["Mode"] = CompileMode(mode)
+        incremental = env.get("Incremental", False)
+        if incremental and env.get("Mode", CompileMode.update) != CompileMode.update:
+            raise ValueError("Incremental loads only support the update mode")
+        if include_initialization:
+            statements, _ = self.translate_initialization(env)
+            yield from statements
+        if include_process and env.get("Mode") == CompileMode.insert:
+            statements, _ = self.translate_rows(env)
+            yield from statements
+        elif include_process and env.get("Mode") == CompileMode.staged:
+            staging, assemble, _ = self.translate_staged(env)
+            yield from staging
+            yield from assemble
+        elif include_process:
+            process = self.iter_updates(env)
+            if env.get("FuseUpdates", False):
+                process = fuse_updates(list(process))
+            if env.get("ChunkSize"):
+                process = self.chunk_updates(process, env)
+            yield from process
+            if incremental:
+                yield from self.primary_key.commit_watermarks(env)
+
+    def iter_updates(self, env: Environment) -> Iterator[Serializable]:
+        for col in self.columns:
+            statements, _ = col.translate(env)
+            if statements is not None:
+                yield from statements
+
+    def chunk_updates(
+        self, statements: Iterable[Serializable], env: Environment
+    ) -> Iterator[Serializable]:
+        """Run each update over ranges of ``ChunkSize`` rows of the mapping table."""
+        target_table = env["TargetTable"]
+        mapping = Table(target_table, "mapping")
+        mapping_id = Expression(f"{mapping.to_sql()}.id")
+        omop_id = Expression(f"omop.{target_table}.{self.primary_key.name}")
+        bounds = SelectStatement(
+            expressions=(
+                Expression(f"min({mapping_id})"),
+                Expression(f"max({mapping_id})"),
+            ),
+            source=(mapping,),
+        )
+        for stmt in statements:
+            if isinstance(stmt, UpdateStatement):
+                keys = [omop_id]
+                if stmt.source is not None and mapping in stmt.source:
+                    keys.append(mapping_id)
+                stmt = ChunkedStatement(stmt, keys, bounds, env["ChunkSize"])
+            yield stmt
+
+
+    def column_groups(
+        self, env: Environment
+    ) -> Tuple[List[Tuple[str, SelectStatement]], Dict[str, List[Tuple[str, str]]]]:
+        """Group the columns that share the same tables and constraints.
+
+        Returns one query per group, selecting the id of the mapping table and
+        the columns of the group, and for each column the groups that fill it
+        in order, with ``None`` standing for a constant.
+        """
+        if "MappingConstraints" not in env:
+            env = self.primary_key.update_environment(env)
+        target_table = env["TargetTable"]
+
+        sources = dict()
+        values = dict()
+        for col in self.columns:
+            if isinstance(col, ConstantTargetColumn) and col.enabled:
+                constant = (None, col.constant_expression)
+                values.setdefault(col.name, list()).append(constant)
+            elif isinstance(col, TargetColumn) and col.enabled:
+                select = col.translate_select(env)
+                key = (select.source, select.criterion)
+                if key not in sources:
+                    sources[key] = (f"{target_table}_{len(sources)}", select, dict())
+                alias, _, expressions = sources[key]
+                expressions[col.name] = select.expressions[-1]
+                entries = [e for e in values.get(col.name, list()) if e[0] != alias]
+                values[col.name] = [*entries, (alias, f"{alias}.{col.name}")]
+
+        groups = list()
+        for alias, select, expressions in sources.values():
+            query = SelectStatement(
+                expressions=(select.expressions[0], *expressions.values()),
+                source=select.source,
+                criterion=select.criterion,
+                distinct_on=select.distinct_on,
+            )
+            groups.append((alias, query))
+        return groups, values
+
+    def assemble_rows(
+        self,
+        env: Environment,
+        tables: List[Union[Table, QueryTable]],
+        values: Dict[str, List[Tuple[str, str]]],
+    ) -> InsertFromStatement:
+        """Insert the rows of the OMOP table, joining the column groups to the
+        mapping table."""
+        target_table = env["TargetTable"]
+        mapping = Table(target_table, "mapping")
+        mapping_id = f"{mapping.to_sql()}.id"
+
+        frm = [mapping]
+        for table in tables:
+            alias = table.alias
+            frm.append(
+                Join(table, Criterion([Expression(f"{alias}.id = {mapping_id}")]))
+            )
+
+        expressions = [Expression(mapping_id)]
+        for entries in values.values():
+            branches = list()
+            default = None
+            for alias, value in reversed(entries):
+                if alias is None:
+                    default = value
+                    break
+                branches.append(f"when {alias}.id is not null then {value}")
+            if not branches:
+                expressions.append(Expression(default))
+            elif len(branches) == 1 and default is None:
+                expressions.append(Expression(entries[-1][1]))
+            else:
+                if default is not None:
+                    branches.append(f"else {default}")
+                expressions.append(Expression(f"case {' '.join(branches)} end"))
+
+        select = SelectStatement(expressions=expressions, source=frm)
+        return InsertFromStatement(
+            columns=(self.primary_key.name, *values.keys()),
+            target=Table(target_table, "omop"),
+            source=select,
+        )
+
+    def translate_rows(self, env: Environment = None) -> TranslateResponse:
+        """Build every row of the OMOP table with a single ``insert ... select``.
+
+        Columns that share the same tables and constraints are selected together
+        in one subquery that is left joined to the mapping table. When several
+        columns target the same name, the last one that matches a row wins, as
+        it would with the updates.
+        """
+        env = env or self.default_env
+        if "MappingConstraints" not in env:
+            env = self.primary_key.update_environment(env)
+        groups, values = self.column_groups(env)
+        tables = [QueryTable(alias=a, query=q.to_query()) for a, q in groups]
+        return [self.assemble_rows(env, tables, values)], env
+
+    def translate_staged(
+        self, env: Environment = None
+    ) -> Tuple[List[Serializable], List[Serializable], Environment]:
+        """Build the rows of the OMOP table from one staging table per group of
+        columns.
+
+        Returns the statements creating the staging tables, which only read the
+        sources and can run at the same time, and the statements inserting the
+        rows and dropping the staging tables.
+        """
+        env = env or self.default_env
+        if "MappingConstraints" not in env:
+            env = self.primary_key.update_environment(env)
+        schema = env.get("StagingSchema", "staging")
+        groups, values = self.column_groups(env)
+        staging = [
+            CreateTempTableStatement(alias, query.to_query(), schema=schema)
+            for alias, query in groups
+        ]
+        tables = [Table(alias, schema) for alias, _ in groups]
+        assemble = [self.assemble_rows(env, tables, values)]
+        assemble.extend(DropTableStatement(table) for table in tables)
+        return staging, assemble, env
@@ -0,0 +1,250 @@
+import queue
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import yaml
+
+from omop_etl.cache import CompileCache
+from omop_etl.constraints import Constraints
+from omop_etl.project import (
+    RuleFile,
+    _dependency_environment,
+    rule_files,
+    table_environment,
+)
+from omop_etl.schema import Environment
+from omop_etl.writer import write_if_changed
+
+
+class IncrementalCompiler:
+    """The scripts of a directory of rules, kept up to date as its files change.
+
+    The rule files are kept between updates, with their translations. A file is
+    only parsed and translated again when its content changed, and so are the
+    tables that depend on it, since the environment they are translated in
+    comes from it. A file that doesn't validate is reported and its previous
+    version is kept.
+    """
+
+    def __init__(
+        self,
+        rules: Path,
+        output: Path,
+        options: Environment,
+        one_file: bool = True,
+        compress: bool = False,
+        constraints: Optional[Constraints] = None,
+        cache: Optional[CompileCache] = None,
+    ) -> None:
+        self.rules = rules
+        self.output = output
+        self.options = options
+        self.one_file = one_file
+        self.compress = compress
+        self.constraints = constraints
+        self.cache = cache or CompileCache()
+        self.suffix = ".sql.gz" if compress else ".sql"
+        self.files: Dict[str, RuleFile] = dict()
+        self.translated: Dict[str, Any] = dict()
+        self.errors: Dict[str, str] = dict()
+        self._contents: Dict[str, bytes] = dict()
+
+    def update(self) -> List[str]:
+        """Reload the rule files that changed and rewrite the scripts they affect.
+
+        Returns the names of the rules that were translated again.
+        """
+        paths = dict(rule_files(self.rules))
+        changed = self._reload(paths)
+        affected = {
+            name
+            for name, file in self.files.items()
+            if name in changed or set(file.depends_on or ()) & changed
+        }
+        files = [self.files[name] for name in paths if name in self.files]
+        if self.one_file:
+            self._translate_script(files, affected)
+        else:
+            self._translate_files(files, affected, changed)
+        return [f.name for f in files if f.name in affected]
+
+    def _reload(self, paths: Dict[str, Path]) -> Set[str]:
+        changed = {name for name in self._contents if name not in paths}
+        for name in changed:
+            del self._contents[name]
+            self.files.pop(name, None)
+            self.translated.pop(name, None)
+            self.errors.pop(name, None)
+
+        for name, path in paths.items():
+            try:
+                content = path.read_bytes()
+            except FileNotFoundError:
+                # removed since the directory was listed
+                continue
+            if self._contents.get(name) == content:
+                continue
+            self._contents[name] = content
+            file = RuleFile(name, content, self.cache)
+            try:
+                file.meta
+            except (ValueError, yaml.YAMLError) as e:
+                self.errors[name] = str(e)
+                continue
+            self.errors.pop(name, None)
+            self.files[name] = file
+            changed.add(name)
+        return changed
+
+    def _translate(self, file: RuleFile, translate: Callable[[], Any]) -> None:
+        try:
+            self.translated[file.name] = translate()
+        except ValueError as e:
+            self.errors[file.name] = str(e)
+        else:
+            self.errors.pop(file.name, None)
+
+    def _translate_script(self, files: List[RuleFile], affected: Set[str]) -> None:
+        deps = [f for f in files if f.table_name is None]
+        tables = [f for f in files if f.table_name is not None]
+
+        envs = dict()
+        for dep in deps:
+            if dep.name in affected:
+                self._translate(dep, dep.translate_dependency)
+            if dep.name in self.translated:
+                envs[dep.name] = _dependency_environment(self.translated[dep.name])
+        for table in tables:
+            if table.name in affected:
+                env = table_environment(table, envs, self.options)
+                self._translate(table, lambda: table.translate_table(env))
+
+        # the rules that never translated are left out until they do
+        deps = [f for f in deps if f.name in self.translated]
+        scripts = [self.translated[f.name] for f in tables if f.name in self.translated]
+        pieces = [f"{self.translated[f.name]['script']}\n" for f in deps]
+        pieces.extend(f"{init}\n" for init, _ in scripts)
+        pieces.extend(f"{process}\n" for _, process in scripts)
+
+        pre_load, post_load = self._constraint_scripts(files)
+        if pre_load:
+            pieces.insert(0, f"{pre_load}\n")
+        if post_load:
+            pieces.append(f"{post_load}\n")
+        script = "".join(pieces)
+        write_if_changed(self.output / f"etl{self.suffix}", script, self.compress)
+
+    def _translate_files(
+        self, files: List[RuleFile], affected: Set[str], changed: Set[str]
+    ) -> None:
+        for file in files:
+            if file.name in affected:
+                self._translate(file, lambda: file.translate_script(self.options))
+            if file.name in affected and file.name in self.translated:
+                path = self.output / f"{file.name}{self.suffix}"
+                write_if_changed(path, self.translated[file.name], self.compress)
+        for name in changed - set(self.files):
+            (self.output / f"{name}{self.suffix}").unlink(missing_ok=True)
+
+        if self.constraints is not None:
+            pre_load, post_load = self._constraint_scripts(files)
+            path = self.output / f"pre_load{self.suffix}"
+            write_if_changed(path, pre_load, self.compress)
+            path = self.output / f"post_load{self.suffix}"
+            write_if_changed(path, post_load, self.compress)
+
+    def _constraint_scripts(self, files: List[RuleFile]) -> Tuple[str, str]:
+        if self.constraints is None:
+            return "", ""
+        names = [f.table_name for f in files if f.table_name is not None]
+        return self.constraints.scripts(names)
+
+
+def _snapshot(directory: Path) -> Dict[Path, Tuple[int, int]]:
+    snapshot = dict()
+    for path in directory.iterdir():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def _poll_changes(directory: Path, interval: float) -> Iterator[Set[Path]]:
+    previous = _snapshot(directory)
+    while True:
+        time.sleep(interval)
+        current = _snapshot(directory)
+        changed = {
+            path
+            for path in previous.keys() | current.keys()
+            if previous.get(path) != current.get(path)
+        }
+        previous = current
+        if changed:
+            yield changed
+
+
+def _notified_changes(directory: Path, interval: float) -> Iterator[Set[Path]]:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+
+    events = queue.Queue()
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if not event.is_directory:
+                events.put(Path(event.src_path))
+                if getattr(event, "dest_path", None):
+                    events.put(Path(event.dest_path))
+
+    observer = Observer()
+    observer.schedule(Handler(), str(directory))
+    observer.start()
+    try:
+        while True:
+            changed = {events.get()}
+            # saving a file raises several events, they are handled together
+            time.sleep(interval)
+            while not events.empty():
+                changed.add(events.get_nowait())
+            yield changed
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def iter_changes(directory: Path, interval: float = 0.1) -> Iterator[Set[Path]]:
+    """The paths of the directory that changed, as they change.
+
+    Uses the notifications of the file system when watchdog is installed and
+    otherwise polls the modification times every ``interval`` seconds.
+    """
+    try:
+        import watchdog  # noqa: F401
+    except ImportError:
+        return _poll_changes(directory, interval)
+    return _notified_changes(directory, interval)
+
+
+def watch(
+    compiler: IncrementalCompiler,
+    report: Callable[[str], None] = print,
+    interval: float = 0.1,
+) -> None:
+    """Compile the rules, then recompile them every time they change."""
+
+    def update() -> None:
+        start = time.perf_counter()
+        names = compiler.update()
+        elapsed = time.perf_counter() - start
+        if names:
+            report(f"Compiled {', '.join(names)} in {elapsed:.2f}s")
+        for name, error in compiler.errors.items():
+            report(f"{name}: {error}")
+
+    update()
+    for _ in iter_changes(compiler.rules, interval):
+        update()
@@ -0,0 +1,66 @@
+import filecmp
+import gzip
+import io
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Iterable, Optional
+
+
+class ScriptWriter:
+    """Write a script piece by piece, to a file or to the standard output.
+
+    A file is written next to its destination and only replaces it once it is
+    complete and if its content changed, so an unchanged script keeps its
+    timestamp. Compressed scripts are gzipped without a timestamp, so the same
+    script always compresses to the same bytes.
+    """
+
+    def __init__(self, path: Optional[Path] = None, compress: bool = False) -> None:
+        self.path = path
+        self.compress = compress
+        self._tmp = None
+        self._stream = None
+
+    def __enter__(self) -> "ScriptWriter":
+        if self.path is None:
+            raw = sys.stdout.buffer
+        else:
+            fd, self._tmp = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+            raw = os.fdopen(fd, "wb")
+        if self.compress:
+            raw = gzip.GzipFile(fileobj=raw, mode="wb", filename="", mtime=0)
+        self._raw = raw
+        self._stream = io.TextIOWrapper(raw, encoding="utf-8", write_through=True)
+        return self
+
+    def write(self, chunk: str) -> None:
+        self._stream.write(chunk)
+
+    def write_all(self, chunks: Iterable[str]) -> None:
+        for chunk in chunks:
+            self._stream.write(chunk)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self.path is None:
+            # leave the standard output open
+            self._stream.detach()
+            if self.compress:
+                self._raw.close()
+            sys.stdout.buffer.flush()
+            return
+        self._stream.close()
+        if exc_type is not None:
+            os.unlink(self._tmp)
+        elif self.path.exists() and filecmp.cmp(self._tmp, self.path, shallow=False):
+            os.unlink(self._tmp)
+        else:
+            os.chmod(self._tmp, 0o644)
+            os.replace(self._tmp, self.path)
+
+
+def write_if_changed(path: Path, content: str, compress: bool = False) -> None:
+    """Leave the file untouched when its content is the same."""
+    with ScriptWriter(path, compress) as writer:
+        writer.write(content)
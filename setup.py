@@ -9,6 +9,7 @@ setup(
     author_email="t.chard@unsw.edu.au",
     license="GPL-3.0",
     packages=["omop_etl"],
+    package_data={"omop_etl": ["data/*.csv", "data/*.json"]},
     entry_points={"console_scripts": ["omop_etl = omop_etl.__main__:app"],},
     install_requires=[
         "fastapi",
@@ -24,7 +25,11 @@ setup(
         "uvicorn[standard]",
         "xlrd",
     ],
-    extras_require={"dev": ["pytest-postgresql >= 2.6.1", "pytest"]},
+    extras_require={
+        "dev": ["pytest-postgresql >= 2.6.1", "pytest", "httpx"],
+        "brotli": ["brotli"],
+        "watch": ["watchdog"],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Science/Research",
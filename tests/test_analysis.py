@@ -0,0 +1,55 @@
+from omop_etl.analysis import *
+
+
+def test_tokenize():
+    tokens = tokenize('lower(Foo."Name") = \'A\' -- comment')
+    assert [t.text for t in tokens] == ["lower", "(", 'foo.Name', ")", "=", "'A'"]
+    assert [t.depth for t in tokens] == [0, 0, 1, 0, 0, 0]
+
+
+def test_conjuncts():
+    sql = "foo.id = bar.id AND foo.x BETWEEN 1 AND 2 and (a.x = 1 and b.x = 2)"
+    assert conjuncts(sql) == [
+        "foo.id = bar.id",
+        "foo.x between 1 and 2",
+        "( a.x = 1 and b.x = 2 )",
+    ]
+    assert disjuncts("foo.x = 1 or (foo.y = 2 or foo.y = 3)") == [
+        "foo.x = 1",
+        "( foo.y = 2 or foo.y = 3 )",
+    ]
+    assert count_or("foo.x = 1 or (foo.y = 2 or foo.y = 3)") == 2
+
+
+def test_referenced_tables():
+    sql = "cerner.foo.id = bar.foo_id and baz = 1"
+    assert referenced_tables(sql, ["foo", "bar", "baz"]) == {"foo", "bar"}
+    assert mentioned_tables(sql, ["foo", "bar", "baz"]) == {"foo", "bar", "baz"}
+
+
+def test_wrapped_columns():
+    sql = "lower(foo.name) = bar.name::text and cast(baz.id as text) = coalesce(x, 1)"
+    assert wrapped_columns(sql) == [
+        ("foo.name", "lower"),
+        ("bar.name", "cast"),
+        ("baz.id", "cast"),
+    ]
+    assert wrapped_columns("(foo.id = bar.id)") == []
+
+
+def test_correlations():
+    sql = "coalesce((select max(b.x) from bar b where b.foo_id = foo.id), 0)"
+    [subquery] = subqueries(sql)
+    assert subquery.startswith("select max")
+    assert correlations(subquery, ["foo", "bar", "b"]) == {"foo"}
+    assert correlations("select 1 from foo where foo.id = 1", ["foo"]) == set()
+
+
+def test_unqualified_names():
+    sql = "coalesce(foo.x, y)::text = cast(bar.z as varchar) and w is not null"
+    assert unqualified_names(sql) == ["y", "w"]
+
+
+def test_table_columns():
+    sql = "omop.BAZ.alpha + baz.beta + foo.gamma + coalesce(delta, 0)"
+    assert table_columns(sql, "baz") == {"alpha", "beta", "delta"}
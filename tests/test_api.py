@@ -0,0 +1,166 @@
+import gzip
+import json
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+from omop_etl.api import RESULTS, app, negotiate_encoding
+from omop_etl.project import compile_rules, load_rules, split_rules
+from omop_etl.schema import *
+
+
+RULES = Path("tests", "rules")
+
+client = TestClient(app)
+
+
+def as_json(rule) -> dict:
+    return json.loads(rule.json(by_alias=True))
+
+
+def project(options: dict = None) -> dict:
+    deps, tables = split_rules(load_rules(RULES))
+    return {
+        "dependencies": {name: as_json(dep) for name, dep in deps},
+        "tables": {name: as_json(table) for name, table in tables},
+        "options": options or dict(),
+    }
+
+
+def test_compile_project():
+    body = project()
+    response = client.post("/api/compile", json=body)
+    assert response.status_code == 200
+    result = response.json()
+
+    script, _ = compile_rules(RULES, {"DropTables": False})
+    assert result["script"] == script
+    assert sorted(result["warnings"]) == sorted(body["tables"])
+
+
+def test_compile_project_options():
+    options = {"fuse_updates": True, "mode": "insert", "chunk_size": 100}
+    response = client.post("/api/compile", json=project(options))
+    assert response.status_code == 200
+
+    env = {"FuseUpdates": True, "Mode": CompileMode.insert, "ChunkSize": 100}
+    script, _ = compile_rules(RULES, env)
+    assert response.json()["script"] == script
+
+
+def test_compile_project_missing_dependency():
+    body = project()
+    body["dependencies"] = dict()
+    response = client.post("/api/compile", json=body)
+    assert response.status_code == 422
+    assert "depends on missing" in response.text
+
+
+def test_compile_project_warnings():
+    body = project()
+    table = body["tables"]["copy"]
+    body["tables"] = {"person": {**table, "name": "person"}}
+    response = client.post("/api/compile", json=body)
+    assert response.status_code == 200
+    warnings = response.json()["warnings"]["person"]
+    assert any("year_of_birth" in w["msg"] for w in warnings)
+
+
+def test_translate_warnings():
+    body = project()["tables"]["copy"]
+    body["columns"][0]["tables"].append("qux")
+    response = client.post("/api/translate", json=body)
+    assert response.status_code == 200
+    [warning] = response.json()["warnings"]
+    assert warning["loc"] == ["body", "columns", 0, "tables", 1]
+    assert warning["msg"] == 'Table "qux" is not used'
+
+
+def test_translate_etag():
+    body = project()["tables"]["copy"]
+    first = client.post("/api/translate", json=body)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+
+    # the same table written differently is served from the cache
+    hits, misses = RESULTS.hits, RESULTS.misses
+    second = client.post("/api/translate", json=dict(reversed(list(body.items()))))
+    assert second.headers["etag"] == etag
+    assert second.json() == first.json()
+    assert (RESULTS.hits, RESULTS.misses) == (hits + 1, misses)
+    assert client.get("/api/cache").json()["hits"] == hits + 1
+
+    response = client.post(
+        "/api/translate", json=body, headers={"If-None-Match": f"W/{etag}"}
+    )
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+
+    other = client.post("/api/translate", json={**body, "name": "other"})
+    assert other.headers["etag"] != etag
+
+
+def stream_text(body: dict) -> str:
+    """The statements of a table, separated by an empty line."""
+    statements, _ = TargetTable.parse_obj(body).translate()
+    return "\n\n".join(stmt.to_sql() for stmt in statements) + "\n"
+
+
+def test_stream_table():
+    body = project()["tables"]["merge"]
+    script = TargetTable.parse_obj(body).get_script()
+    headers = {"Accept-Encoding": "identity"}
+    response = client.post("/api/translate/stream", json=body, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "content-encoding" not in response.headers
+    assert response.text == stream_text(body)
+
+    headers = {"Accept": "application/x-ndjson", "Accept-Encoding": "identity"}
+    response = client.post("/api/translate/stream", json=body, headers=headers)
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["index"] for line in lines] == list(range(len(lines)))
+    assert lines[0]["phase"] == "initialization"
+    assert lines[-1]["phase"] == "process"
+    assert lines[-1]["kind"] == "UpdateStatement"
+    assert "\n".join(line["sql"] for line in lines) == script
+
+
+def test_stream_table_gzip():
+    body = project()["tables"]["merge"]
+    with client.stream(
+        "POST",
+        "/api/translate/stream",
+        json=body,
+        headers={"Accept-Encoding": "gzip"},
+    ) as response:
+        assert response.headers["content-encoding"] == "gzip"
+        content = b"".join(response.iter_raw())
+    assert gzip.decompress(content).decode() == stream_text(body)
+
+
+def test_stream_table_error(monkeypatch):
+    def translate(self, env):
+        raise ValueError("Column can't be translated")
+
+    monkeypatch.setattr(TargetColumn, "translate", translate)
+    body = project()["tables"]["merge"]
+    response = client.post("/api/translate/stream", json=body)
+    assert response.status_code == 422
+    assert response.json()["detail"] == "Column can't be translated"
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip;q=0, deflate") is None
+    assert negotiate_encoding("deflate, gzip;q=0.5") == "gzip"
+    assert negotiate_encoding("*") in ("br", "gzip")
+
+
+def test_negotiate_brotli():
+    pytest.importorskip("brotli")
+    assert negotiate_encoding("gzip, br") == "br"
+    assert negotiate_encoding("gzip, br;q=0.5") == "gzip"
@@ -0,0 +1,43 @@
+import gzip
+import pickle
+from pathlib import Path
+
+import pytest
+from pydantic import ValidationError
+
+from omop_etl.bundle import MAGIC, is_bundle, read_bundle, write_bundle
+from omop_etl.project import compile_rules, load_rules, parse_rule
+from omop_etl.schema import *
+
+
+RULES = Path("tests", "rules")
+
+
+def test_parse_rule():
+    assert isinstance(parse_rule((RULES / "copy.yaml").read_text()), TargetTable)
+    assert isinstance(parse_rule((RULES / "dep.yaml").read_text()), Dependency)
+
+    # a table that fails validation is not mistaken for a dependency
+    with pytest.raises(ValidationError):
+        parse_rule("name: baz\nprimary_key: {}\ncolumns: []")
+
+
+def test_bundle_roundtrip(tmp_path):
+    path = tmp_path / "rules.bundle"
+    rules = load_rules(RULES)
+    write_bundle(rules, path)
+
+    assert is_bundle(path)
+    assert not is_bundle(RULES)
+    assert not is_bundle(RULES / "copy.yaml")
+    assert read_bundle(path) == rules
+    assert load_rules(path) == rules
+    assert compile_rules(path, dict()) == compile_rules(RULES, dict())
+
+
+def test_bundle_version(tmp_path):
+    path = tmp_path / "rules.bundle"
+    bundle = {"version": "0.0.0", "rules": []}
+    path.write_bytes(MAGIC + gzip.compress(pickle.dumps(bundle)))
+    with pytest.raises(ValueError):
+        read_bundle(path)
@@ -0,0 +1,86 @@
+import shutil
+from pathlib import Path
+
+from omop_etl.cache import CompileCache, LRUCache, environment_key
+from omop_etl.project import compile_rules
+from omop_etl.schema import *
+
+
+RULES = Path("tests", "rules")
+
+
+def test_fetch(tmp_path):
+    cache = CompileCache(tmp_path)
+    key = cache.digest("table", b"name: baz")
+    assert cache.fetch(key, lambda: {"script": "select 1;"}) == {"script": "select 1;"}
+    assert cache.fetch(key, lambda: None) == {"script": "select 1;"}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # the cache is disabled without a directory
+    cache = CompileCache()
+    assert cache.fetch(key, lambda: None) is None
+
+
+def test_environment_key():
+    env = {
+        "TempTables": {"b", "a"},
+        "Mode": CompileMode.insert,
+        "MappingStorage": TableStorage(unlogged=True),
+    }
+    assert environment_key(env) == environment_key(dict(reversed(env.items())))
+    assert '"TempTables": ["a", "b"]' in environment_key(env)
+    assert '"Mode": "insert"' in environment_key(env)
+
+
+def test_compile_rules_cached(tmp_path):
+    rules = tmp_path / "rules"
+    shutil.copytree(RULES, rules)
+    expected, names = compile_rules(rules, {"DropTables": False})
+
+    cache = CompileCache(tmp_path / "cache")
+    actual, _ = compile_rules(rules, {"DropTables": False}, cache)
+    assert actual == expected
+    misses = cache.misses
+
+    cache = CompileCache(tmp_path / "cache")
+    actual, cached_names = compile_rules(rules, {"DropTables": False}, cache)
+    assert actual == expected
+    assert cached_names == names
+    assert cache.misses == 0
+
+    # only the changed file and the environment it is translated in miss
+    copy = rules / "copy.yaml"
+    copy.write_text(copy.read_text().replace("foo.alpha", "upper(foo.alpha)"))
+    cache = CompileCache(tmp_path / "cache")
+    actual, _ = compile_rules(rules, {"DropTables": False}, cache)
+    assert "upper(foo.alpha)" in actual
+    # its description, initialization and processing
+    assert cache.misses == 3
+
+    cache = CompileCache(tmp_path / "cache")
+    compile_rules(rules, {"DropTables": True}, cache)
+    assert 0 < cache.misses < misses
+
+
+def test_lru_cache():
+    now = [0.0]
+    cache = LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    assert cache.fetch("a", lambda: 1) == 1
+    assert cache.fetch("b", lambda: 2) == 2
+    assert cache.fetch("a", lambda: None) == 1
+
+    # b is the least recently used entry
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats() == {
+        "size": 2,
+        "maxsize": 2,
+        "ttl": 10,
+        "hits": 2,
+        "misses": 3,
+    }
+
+    now[0] = 10.0
+    assert cache.get("a") is None
+    assert len(cache) == 1
@@ -0,0 +1,64 @@
+from pathlib import Path
+
+from omop_etl.catalog import *
+
+
+SCRIPT = """
+CREATE SCHEMA omop;
+SET search_path TO omop;
+
+-- people
+CREATE TABLE person (
+    person_id INTEGER NULL,
+    year_of_birth INTEGER NOT NULL,
+    value_as_number NUMERIC(10, 2),
+    care_site_id INTEGER REFERENCES care_site (care_site_id)
+);
+CREATE TABLE cerner.encounter (
+    encntr_id serial,
+    "person_id" integer,
+    primary key (encntr_id),
+    constraint fk_person foreign key (person_id) references omop.person (person_id)
+);
+ALTER TABLE omop.person ALTER COLUMN person_id SET NOT NULL;
+ALTER TABLE omop.person ADD CONSTRAINT xpk_person PRIMARY KEY (person_id);
+CREATE INDEX idx_person_id ON omop.person (person_id ASC);
+"""
+
+
+def test_parse_catalog():
+    catalog = Catalog.parse([SCRIPT])
+    assert len(catalog) == 2
+
+    person = catalog.table("omop.person")
+    assert person is catalog.table("PERSON")
+    assert person is catalog.table("person", schema="omop")
+    assert person.column("person_id") == ColumnInfo("person_id", "integer", False)
+    assert person.column("year_of_birth").nullable is False
+    assert person.column("value_as_number").datatype == "numeric(10, 2)"
+    assert person.required_columns == ("person_id", "year_of_birth")
+    assert person.primary_key == ("person_id",)
+    assert person.foreign_keys == (
+        ForeignKeyInfo(("care_site_id",), "care_site", ("care_site_id",)),
+    )
+    assert person.indexes == ("idx_person_id",)
+
+    encounter = catalog.column("encounter", "person_id", schema="cerner")
+    assert encounter == ColumnInfo("person_id", "integer", True)
+    encounter = catalog.table("cerner.encounter")
+    assert encounter.primary_key == ("encntr_id",)
+    assert encounter.foreign_keys == (
+        ForeignKeyInfo(("person_id",), "omop.person", ("person_id",)),
+    )
+    assert catalog.table("missing") is None
+
+
+def test_catalog_json():
+    catalog = Catalog.parse([SCRIPT])
+    assert Catalog.from_json(catalog.to_json()).tables == catalog.tables
+
+
+def test_shipped_catalog_is_up_to_date():
+    parsed = Catalog.load_scripts(sorted(Path("schema").glob("*.sql")))
+    assert load_catalog().tables == parsed.tables
+    assert "year_of_birth" in load_catalog().table("omop.person").required_columns
@@ -0,0 +1,79 @@
+from pathlib import Path
+
+import pytest
+from omop_etl.constraints import *
+
+from tests.utils import *
+
+SCRIPT = """
+ALTER TABLE OMOP.person ALTER COLUMN person_id SET NOT NULL;
+ALTER TABLE OMOP.person ALTER COLUMN year_of_birth SET NOT NULL;
+ALTER TABLE OMOP.visit_occurrence ALTER COLUMN person_id SET NOT NULL;
+ALTER TABLE OMOP.person ADD CONSTRAINT xpk_person PRIMARY KEY (person_id);
+ALTER TABLE OMOP.visit_occurrence ADD CONSTRAINT fpk_visit_person
+    FOREIGN KEY (person_id) REFERENCES OMOP.person (person_id);
+CREATE INDEX idx_visit_person_id ON OMOP.visit_occurrence (person_id);
+"""
+
+
+def test_parse_constraints():
+    constraints = Constraints.parse_string(SCRIPT)
+    assert len(constraints.not_null) == 3
+    assert constraints.not_null[0] == NotNull(Table("person", "omop"), "person_id")
+    assert [c.kind for c in constraints.constraints] == ["primary", "foreign"]
+    assert constraints.constraints[1].references == Table("person", "omop")
+    assert constraints.indexes[0].name == "idx_visit_person_id"
+
+    with pytest.raises(ValueError):
+        Constraints.parse_string("ALTER TABLE omop.person OWNER TO postgres;")
+
+
+def test_omop_constraints_file():
+    constraints = Constraints.load([Path("schema", "omop_constraints.sql")])
+    assert len(constraints.not_null) > 200
+    assert constraints.restrict(["PERSON"]).not_null
+
+
+def test_restrict_to_omop_tables():
+    script = SCRIPT + """
+ALTER TABLE cerner.person ALTER COLUMN person_id SET NOT NULL;
+ALTER TABLE cerner.visit ADD CONSTRAINT fk_visit_person
+    FOREIGN KEY (person_id) REFERENCES cerner.person (person_id);
+CREATE INDEX idx_cerner_person ON cerner.person (person_id);
+"""
+    constraints = Constraints.parse_string(script).restrict(["PERSON"])
+    assert {c.table.schema for c in constraints.not_null} == {"omop"}
+    assert [c.name for c in constraints.constraints] == [
+        "xpk_person",
+        "fpk_visit_person",
+    ]
+    assert constraints.indexes == []
+
+
+def test_pre_load_statements():
+    constraints = Constraints.parse_string(SCRIPT).restrict(["person"])
+    actual = [s.to_sql() for s in constraints.pre_load()]
+    # the foreign key referencing the primary key is dropped before it
+    expected = [
+        "alter table omop.visit_occurrence drop constraint if exists fpk_visit_person;",
+        "alter table omop.person drop constraint if exists xpk_person, alter column person_id drop not null, alter column year_of_birth drop not null;",
+    ]
+    assert expected == actual
+
+
+def test_post_load_statements():
+    constraints = Constraints.parse_string(SCRIPT)
+    build, add, validate = [
+        [s.to_sql() for s in stage] for stage in constraints.post_load_stages()
+    ]
+    assert build == [
+        "alter table omop.person add constraint xpk_person PRIMARY KEY (person_id);",
+        "CREATE INDEX idx_visit_person_id ON OMOP.visit_occurrence (person_id);",
+    ]
+    assert add == [
+        "alter table omop.person alter column person_id set not null, alter column year_of_birth set not null;",
+        "alter table omop.visit_occurrence alter column person_id set not null, add constraint fpk_visit_person FOREIGN KEY (person_id) REFERENCES OMOP.person (person_id) not valid;",
+    ]
+    assert validate == [
+        "alter table omop.visit_occurrence validate constraint fpk_visit_person;"
+    ]
@@ -0,0 +1,335 @@
+import pytest
+from omop_etl.constraints import Constraints
+from omop_etl.execution import (
+    Executor,
+    Task,
+    build_tasks,
+    check_acyclic,
+    is_transient,
+)
+from omop_etl.schema import *
+
+from tests.utils import *
+
+
+PERSON = """
+name: person
+primary_key:
+  name: person_id
+  sources:
+    patient:
+      table: patient
+      columns:
+        id: integer
+columns:
+  - name: year_of_birth
+    tables: [patient]
+    expression: patient.birth_year
+"""
+
+EVENT = """
+name: events
+depends_on: [shared]
+primary_key:
+  name: id
+  sources:
+    event_pk:
+      table: event
+      columns:
+        id: integer
+columns:
+  - name: patient_id
+    tables: [event]
+    references:
+      table: person
+      column: patient_id
+    expression: event.patient_id
+  - name: visit_id
+    tables: [event, visit_temp]
+    constraints:
+      - event.visit = visit_temp.id
+    expression: visit_temp.id
+"""
+
+VISIT = """
+name: visit
+pre_init:
+  - alias: visit_temp
+    query: select id from cerner.visit
+primary_key:
+  name: id
+  sources:
+    visit_pk:
+      table: visit
+      columns:
+        id: integer
+columns:
+  - name: person_id
+    tables: [visit]
+    expression: (select max(id) from mapping.person)
+"""
+
+SHARED = """
+pre_init:
+  - alias: shared_temp
+    query: select 1 as id
+"""
+
+
+@pytest.fixture
+def rules():
+    return [
+        ("event", TargetTable.parse_string(EVENT)),
+        ("person", TargetTable.parse_string(PERSON)),
+        ("visit", TargetTable.parse_string(VISIT)),
+        ("shared", Dependency.parse_string(SHARED)),
+    ]
+
+
+def test_build_tasks_edges(rules):
+    tasks = {t.name: t for t in build_tasks(rules)}
+    assert tasks["event"].depends_on == {
+        "create staging schema",
+        "shared",
+        "person",
+        "visit",
+    }
+    assert tasks["visit"].depends_on == {"create staging schema", "person"}
+    assert tasks["person"].depends_on == {"create staging schema"}
+
+
+def test_build_tasks_edges_ignore_case(rules):
+    # unquoted names are folded to lowercase whatever case the rules use
+    event = EVENT.replace("visit_temp", "Visit_Temp")
+    person = PERSON.replace("name: person", "name: PERSON")
+    visit = VISIT.replace("mapping.person", "mapping.Person")
+    rules = [
+        ("event", TargetTable.parse_string(event)),
+        ("person", TargetTable.parse_string(person)),
+        ("visit", TargetTable.parse_string(visit)),
+    ]
+    tasks = {t.name: t for t in build_tasks(rules)}
+    assert tasks["event"].depends_on == {"create staging schema", "person", "visit"}
+    assert tasks["visit"].depends_on == {"create staging schema", "person"}
+    assert "create unlogged table staging.visit_temp as" in tasks["visit"].to_sql()
+    assert "staging.Visit_Temp" in tasks["event"].to_sql()
+
+
+def test_build_tasks_promotes_shared_temp_tables(rules):
+    tasks = {t.name: t for t in build_tasks(rules)}
+    assert "create unlogged table staging.visit_temp as" in tasks["visit"].to_sql()
+    assert "create unlogged table staging.shared_temp as" in tasks["shared"].to_sql()
+    assert "create temp table" not in tasks["visit"].to_sql()
+    # the tables reading them find them in the staging schema
+    assert "staging.visit_temp" in tasks["event"].to_sql()
+    assert "cerner.visit_temp" not in tasks["event"].to_sql()
+
+
+def test_build_tasks_keeps_private_temp_tables(rules):
+    rules = [(n, r) for n, r in rules if n in {"person", "visit"}]
+    tasks = {t.name: t for t in build_tasks(rules)}
+    assert "create staging schema" not in tasks
+    assert "create temp table visit_temp as" in tasks["visit"].to_sql()
+
+
+def test_build_tasks_staged(rules):
+    tasks = build_tasks(rules, {"Mode": CompileMode.staged})
+    tasks = {t.name: t for t in tasks}
+    assert tasks["visit keys"].depends_on == {"create staging schema", "person"}
+    assert tasks["visit visit_0"].depends_on >= {"visit keys"}
+    assert tasks["visit"].depends_on >= {"visit keys", "visit visit_0"}
+    assert tasks["visit visit_0"].rule == "visit"
+    assert "insert into omop.visit" in tasks["visit"].to_sql()
+    # the columns are computed on other connections than the temp tables
+    assert "create temp table" not in tasks["visit keys"].to_sql()
+    assert "visit" in tasks["event keys"].depends_on
+
+
+def test_build_tasks_incremental(rules):
+    tasks = build_tasks(rules, {"Incremental": True})
+    assert tasks[0].name == "create watermark table"
+    assert all(tasks[0].name in t.depends_on for t in tasks[1:])
+
+
+def test_build_tasks_constraints(rules):
+    constraints = Constraints.parse_string(
+        "ALTER TABLE omop.person ALTER COLUMN person_id SET NOT NULL;"
+        "ALTER TABLE omop.visit ADD CONSTRAINT fpk_visit FOREIGN KEY (person_id) "
+        "REFERENCES omop.person (person_id);"
+    )
+    tasks = build_tasks(rules, constraints=constraints)
+    names = [t.name for t in tasks]
+    assert names[0] == "drop constraints"
+    stages = {t.name: t for t in tasks if t.name.startswith("constraints")}
+    loaded = [t for t in tasks[1:] if t.name not in stages]
+    assert all("drop constraints" in t.depends_on for t in loaded)
+    assert stages["constraints 1.1"].depends_on >= {"event", "person", "visit"}
+    validate = stages["constraints 2.1"]
+    assert validate.depends_on == {"constraints 1.1", "constraints 1.2"}
+
+
+def test_check_acyclic():
+    check_acyclic([Task("a", []), Task("b", [], {"a", "missing"})])
+    with pytest.raises(ValueError):
+        check_acyclic([Task("a", [], {"b"}), Task("b", [], {"a"})])
+
+
+def test_task_fingerprints():
+    task = Task("a", [Statement("select 1;"), Statement("select  1;")])
+    first, second = task.fingerprints()
+    # the same statement twice is run twice
+    assert first != second
+    assert Task("a", [Statement("select\n1;")]).fingerprints() == [first]
+    assert Task("b", [Statement("select 1;")]).fingerprints() != [first]
+
+
+def test_task_remaining():
+    task = Task(
+        "a",
+        [
+            Statement("create temp table t1 as select 1 as id;"),
+            Statement("create temp table t2 as select id from t1;"),
+            Statement("create temp table t3 as select 3 as id;"),
+            Statement("insert into mapping.a select id from t2;"),
+            Statement("insert into mapping.a select id from t3;"),
+        ],
+    )
+    fingerprints = task.fingerprints()
+    assert task.remaining(set(fingerprints)) == []
+    assert task.remaining(set()) == list(zip(task.statements, fingerprints))
+
+    # the temp tables read by the statements left are created again
+    remaining = task.remaining(set(fingerprints[:4]))
+    assert [fp for _, fp in remaining] == [fingerprints[2], fingerprints[4]]
+    remaining = task.remaining(set(fingerprints[:3]))
+    assert [fp for _, fp in remaining] == fingerprints
+
+
+def test_is_transient():
+    import psycopg2
+
+    class Error(psycopg2.Error):
+        def __init__(self, pgcode):
+            self._pgcode = pgcode
+
+        @property
+        def pgcode(self):
+            return self._pgcode
+
+    assert is_transient(Error("40P01"))
+    assert is_transient(Error("08006"))
+    assert not is_transient(Error("57014"))
+    assert not is_transient(Error("42P01"))
+    assert is_transient(psycopg2.OperationalError("server closed the connection"))
+
+
+class FakeCursor:
+    # the statements failing once with a lost connection
+    failing = set()
+
+    def __init__(self, executed, journal):
+        self.executed = executed
+        self.journal = journal
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        import psycopg2
+
+        if sql in self.failing:
+            self.failing.discard(sql)
+            raise psycopg2.OperationalError("server closed the connection")
+        self.executed.append(sql)
+
+    def fetchall(self):
+        return [(fingerprint,) for fingerprint in self.journal]
+
+
+class FakeConnection:
+    def __init__(self, executed, journal):
+        self.executed = executed
+        self.journal = journal
+        self.autocommit = False
+
+    def cursor(self):
+        return FakeCursor(self.executed, self.journal)
+
+
+class FakePool:
+    executed = list()
+    journal = set()
+
+    def __init__(self, minconn, maxconn, **connection):
+        pass
+
+    def getconn(self):
+        return FakeConnection(self.executed, self.journal)
+
+    def putconn(self, conn, close=False):
+        pass
+
+    def closeall(self):
+        pass
+
+
+def test_executor_resume(monkeypatch):
+    import psycopg2.pool
+
+    tasks = [
+        Task("a", [Statement("select 'a';")]),
+        Task("b", [Statement("select 'b1';"), Statement("select 'b2';")], {"a"}),
+        Task("c", [Statement("select 'c';")], {"b"}),
+    ]
+    # the load stopped after the first statement of b
+    journal = {*tasks[0].fingerprints(), tasks[1].fingerprints()[0]}
+    monkeypatch.setattr(FakePool, "executed", list())
+    monkeypatch.setattr(FakePool, "journal", journal)
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    executor = Executor(dict(), resume=True)
+    monkeypatch.setattr(executor, "available_connections", lambda: None)
+
+    executor.run(tasks)
+    statements = [sql for sql in FakePool.executed if sql.startswith("select '")]
+    assert statements == ["select 'b2';", "select 'c';"]
+
+
+def test_executor_retries_transaction_blocks(monkeypatch):
+    import psycopg2.pool
+
+    task = Task(
+        "a",
+        [
+            Statement("select 'a1';"),
+            Statement("begin;"),
+            Statement("select 'a2';"),
+            Statement("select 'a3';"),
+            Statement("commit;"),
+        ],
+    )
+    monkeypatch.setattr(FakePool, "executed", list())
+    monkeypatch.setattr(FakePool, "journal", set())
+    monkeypatch.setattr(FakeCursor, "failing", {"select 'a3';"})
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    executor = Executor(dict(), retries=1, backoff=0)
+    monkeypatch.setattr(executor, "available_connections", lambda: None)
+
+    executor.run([task])
+    statements = [
+        sql
+        for sql in FakePool.executed
+        if sql.startswith("select '") or sql in ("begin;", "commit;")
+    ]
+    # the block was rolled back with the connection and runs again as a whole
+    assert statements == [
+        "select 'a1';",
+        "begin;",
+        "select 'a2';",
+        "begin;",
+        "select 'a2';",
+        "select 'a3';",
+        "commit;",
+    ]
@@ -1,3 +1,9 @@
+import copy
+import dataclasses
+import pickle
+
+import pytest
+
 from omop_etl.generation import *
 
 from tests.utils import *
@@ -160,3 +166,217 @@ def test_insert_generation():
     expected = "insert into a.bar (id) select alpha as id from foo;"
     actual = stmt.to_sql()
     assert expected == actual
+
+
+def test_multi_column_update_generation():
+    table = Table("baz", "omop")
+    target = UpdateStatement(
+        column=Column("alpha", table),
+        expression=Expression("foo.alpha"),
+        criterion=Criterion(["omop.baz.id = mapping.baz.id"]),
+        source=[Table("baz", "mapping"), Table("foo", "cerner")],
+        assignments=[
+            (Column("alpha", table), Expression("foo.alpha")),
+            (Column("beta", table), Expression("foo.beta")),
+        ],
+    )
+    expected = "update omop.baz set alpha = foo.alpha, beta = foo.beta from mapping.baz, cerner.foo where (omop.baz.id = mapping.baz.id);"
+    assert expected == target.to_sql()
+
+
+def test_fuse_updates():
+    table = Table("baz", "omop")
+    whr = Criterion(
+        ["omop.baz.id = mapping.baz.id", "cerner.foo.id = mapping.baz.foo_id"]
+    )
+    frm = [Table("baz", "mapping"), Table("foo", "cerner")]
+    alpha = UpdateStatement(Column("alpha", table), Expression("foo.alpha"), whr, frm)
+    beta = UpdateStatement(Column("beta", table), Expression("foo.beta"), whr, frm)
+    gamma = UpdateStatement(
+        Column("gamma", table),
+        Expression("bar.gamma"),
+        Criterion([*whr, "foo.id = bar.id"]),
+        [*frm, Table("bar", "cerner")],
+    )
+
+    actual = fuse_updates([alpha, gamma, beta])
+    assert len(actual) == 2
+    assert actual[0].columns == ("alpha", "beta")
+    assert actual[1] == gamma
+
+    # the second update of alpha must stay after the update of beta
+    alpha_again = UpdateStatement(Column("alpha", table), Expression("1"))
+    actual = fuse_updates([alpha, beta, alpha_again, alpha])
+    assert [s.columns for s in actual] == [("alpha", "beta"), ("alpha",), ("alpha",)]
+
+    temp = CreateTempTableStatement(alias="foo", query="select 1")
+    actual = fuse_updates([alpha, temp, beta])
+    assert actual == [alpha, temp, beta]
+
+    # an update reading a column written before it sees the new value
+    delta = UpdateStatement(
+        Column("delta", table), Expression("omop.baz.alpha + 1"), whr, frm
+    )
+    actual = fuse_updates([alpha, beta, delta])
+    assert [s.columns for s in actual] == [("alpha", "beta"), ("delta",)]
+    actual = fuse_updates([delta, alpha, beta])
+    assert [s.columns for s in actual] == [("delta", "alpha", "beta")]
+
+
+def test_fuse_many_updates():
+    table = Table("baz", "omop")
+    whr = Criterion(["omop.baz.id = mapping.baz.id"])
+    updates = [
+        UpdateStatement(Column(f"c{i}", table), Expression(f"{i}"), whr, [table])
+        for i in range(2000)
+    ]
+    actual = fuse_updates(updates)
+    assert len(actual) == 1
+    assert actual[0].columns == tuple(f"c{i}" for i in range(2000))
+
+
+def test_tables_are_interned():
+    table = Table("foo", "bar")
+    assert table is Table("foo", "bar")
+    assert table is not Table("foo")
+    assert pickle.loads(pickle.dumps(table)) is table
+    assert copy.deepcopy(table) is table
+
+
+def test_unused_tables_are_forgotten():
+    import gc
+
+    from omop_etl.generation import _TABLES
+
+    Table("posted", "payload")
+    gc.collect()
+    assert ("posted", "payload") not in _TABLES
+
+
+def test_criterion_equality():
+    target = Criterion(["a = b", "c = d"])
+    assert target == Criterion(("c = d", "a = b"))
+    assert hash(target) == hash(Criterion(["c = d", "a = b"]))
+    assert target == ["c = d", "a = b"]
+    assert target != Criterion(["a = b"])
+    # the order of the predicates is kept when rendering
+    assert target.to_sql() == "(a = b) and (c = d)"
+
+
+def test_statements_are_immutable():
+    select = SelectStatement([Expression("*")], [Table("foo")], ["foo.id = 1"])
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        select.criterion = None
+    assert select.to_query() is select.to_query()
+
+    # a changed copy is rendered again
+    other = dataclasses.replace(select, criterion=None)
+    assert other.to_sql() == "select * from foo;"
+    assert select.to_sql() == "select * from foo where (foo.id = 1);"
+    assert hash(select) == hash(
+        SelectStatement([Expression("*")], [Table("foo")], ["foo.id = 1"])
+    )
+
+
+def test_join_generation():
+    sub = SelectStatement(
+        expressions=[
+            Expression("mapping.baz.id as id"),
+            Expression("foo.alpha as alpha"),
+        ],
+        source=[Table("baz", "mapping"), Table("foo", "cerner")],
+        criterion=Criterion(["cerner.foo.id = mapping.baz.foo_id"]),
+        distinct_on=[Expression("mapping.baz.id")],
+    )
+    expected = "select distinct on (mapping.baz.id) mapping.baz.id as id, foo.alpha as alpha from mapping.baz, cerner.foo where (cerner.foo.id = mapping.baz.foo_id)"
+    assert expected == sub.to_query()
+
+    join = Join(
+        QueryTable("baz_0", sub.to_query()), Criterion(["baz_0.id = mapping.baz.id"])
+    )
+    target = SelectStatement(
+        [Expression("mapping.baz.id"), Expression("baz_0.alpha")],
+        source=[Table("baz", "mapping"), join],
+    )
+    expected = f"select mapping.baz.id, baz_0.alpha from mapping.baz left join ({expected}) as baz_0 on (baz_0.id = mapping.baz.id);"
+    assert expected == target.to_sql()
+
+
+def test_create_unlogged_table_generation():
+    table = CreateTableStatement(
+        "id",
+        Table("baz", "mapping"),
+        [ColumnDefinition("foo_id", "integer")],
+        unlogged=True,
+        options=[("fillfactor", "100"), ("autovacuum_enabled", "false")],
+    )
+    expected = "create unlogged table mapping.baz (id serial PRIMARY KEY, foo_id integer null) with (fillfactor = 100, autovacuum_enabled = false);"
+    assert expected == table.to_sql()
+
+
+def test_create_index_generation():
+    stmt = CreateIndexStatement(Table("baz", "mapping"), ["foo_id"])
+    expected = "create index baz_foo_id_idx on mapping.baz using btree (foo_id);"
+    assert expected == stmt.to_sql()
+
+    stmt = CreateIndexStatement(Table("baz", "mapping"), ["foo_code"], method="hash")
+    expected = "create index baz_foo_code_idx on mapping.baz using hash (foo_code);"
+    assert expected == stmt.to_sql()
+
+    stmt = AnalyzeStatement(Table("baz", "mapping"))
+    assert "analyze mapping.baz;" == stmt.to_sql()
+
+
+def test_chunked_update_generation():
+    update = UpdateStatement(
+        column=Column("alpha", Table("baz", "omop")),
+        expression=Expression("foo.alpha"),
+        criterion=Criterion(["omop.baz.id = mapping.baz.id"]),
+        source=[Table("baz", "mapping"), Table("foo", "cerner")],
+    )
+    bounds = SelectStatement(
+        [Expression("min(mapping.baz.id)"), Expression("max(mapping.baz.id)")],
+        source=[Table("baz", "mapping")],
+    )
+    target = ChunkedStatement(update, ["mapping.baz.id"], bounds, size=100)
+
+    chunk = target.chunk()
+    assert chunk.columns == ("alpha",)
+    assert chunk.criterion == [
+        "omop.baz.id = mapping.baz.id",
+        "mapping.baz.id >= _chunk_lo",
+        "mapping.baz.id < _chunk_lo + 100",
+    ]
+
+    expected = (
+        "do $chunk$ declare _chunk_lo bigint; _chunk_hi bigint; begin "
+        "select min(mapping.baz.id), max(mapping.baz.id) from mapping.baz into _chunk_lo, _chunk_hi; "
+        "while _chunk_lo <= _chunk_hi loop "
+        "update omop.baz set alpha = foo.alpha from mapping.baz, cerner.foo "
+        "where (omop.baz.id = mapping.baz.id) and (mapping.baz.id >= _chunk_lo) and (mapping.baz.id < _chunk_lo + 100); "
+        "commit; _chunk_lo := _chunk_lo + 100; end loop; end $chunk$;"
+    )
+    assert expected == target.to_sql()
+
+
+def test_chunked_insert_generation():
+    select = SelectStatement([Expression("foo.id as foo_id")], [Table("foo", "cerner")])
+    insert = InsertFromStatement(["foo_id"], Table("baz", "mapping"), select)
+    bounds = SelectStatement(
+        [Expression("min(foo.id)"), Expression("max(foo.id)")], [Table("foo", "cerner")]
+    )
+    target = ChunkedStatement(insert, ["foo.id"], bounds, size=10)
+
+    expected = "insert into mapping.baz (foo_id) select foo.id as foo_id from cerner.foo where (foo.id >= _chunk_lo) and (foo.id < _chunk_lo + 10);"
+    assert expected == target.chunk().to_sql()
+    # the original statement is left untouched
+    assert insert.source.criterion is None
+
+
+def test_transaction_control():
+    assert transaction_control(Statement("begin;")) == "begin"
+    assert transaction_control(Statement("start transaction;")) == "begin"
+    assert transaction_control(Statement("COMMIT WORK;")) == "commit"
+    assert transaction_control(Statement("rollback;")) == "rollback"
+    assert transaction_control(Statement("select 'commit';")) is None
+    assert transaction_control(Script("begin; select 1; commit;")) is None
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "module", ["omop_etl.generation", "omop_etl.schema", "omop_etl.__main__"]
+)
+def test_compile_path_stays_light(module, tmp_path):
+    # run from elsewhere, the package must not depend on the working directory
+    script = (
+        "import sys\n"
+        f"import {module}\n"
+        "from omop_etl.schema import REQUIRED_FIELDS\n"
+        "assert 'person_id' in REQUIRED_FIELDS.get_fields('person')\n"
+        "heavy = ['pandas', 'fastapi', 'sqlalchemy', 'psycopg2']\n"
+        "print(','.join(m for m in heavy if m in sys.modules))\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": root}
+    out = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=tmp_path,
+        env=env,
+    )
+    assert out.stdout.strip() == ""
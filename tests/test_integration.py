@@ -175,6 +175,60 @@ class TestCopyTable(BaseTable):
         assert expected == actual
 
 
+    @skip_if_no_db
+    def test_execute_insert_mode(self, postgresql):
+        table = self.parse()
+        statements, _ = table.translate(mode=CompileMode.insert)
+        with postgresql.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement.to_sql())
+        postgresql.commit()
+
+        cur = postgresql.cursor()
+        cur.execute("SELECT alpha, beta FROM omop.baz ORDER BY id")
+        actual = cur.fetchall()
+
+        expected = [("a", 8), ("c", 4), ("d", 6)]
+        assert expected == actual
+
+
+    @skip_if_no_db
+    def test_execute_chunked(self, postgresql):
+        table = self.parse()
+        env = table.default_env
+        env["ChunkSize"] = 2
+        statements, _ = table.translate(env)
+        # the chunks are committed by the statements themselves
+        postgresql.autocommit = True
+        with postgresql.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement.to_sql())
+
+        cur = postgresql.cursor()
+        cur.execute("SELECT alpha, beta FROM omop.baz ORDER BY id")
+        actual = cur.fetchall()
+
+        expected = [("a", 8), ("c", 4), ("d", 6)]
+        assert expected == actual
+
+
+    @skip_if_no_db
+    def test_execute_staged_mode(self, postgresql):
+        table = self.parse()
+        statements, _ = table.translate(mode=CompileMode.staged)
+        with postgresql.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement.to_sql())
+        postgresql.commit()
+
+        cur = postgresql.cursor()
+        cur.execute("SELECT alpha, beta FROM omop.baz ORDER BY id")
+        actual = cur.fetchall()
+
+        expected = [("a", 8), ("c", 4), ("d", 6)]
+        assert expected == actual
+
+
 class TestCustomQueryTable(BaseTable):
     def parse(self):
         return load_table("custom_query.yaml")
@@ -0,0 +1,109 @@
+from fastapi.testclient import TestClient
+
+from omop_etl.api import app
+from omop_etl.catalog import Catalog
+from omop_etl.lint import Finding, lint_rules, lint_table, render_findings
+from omop_etl.schema import TargetTable
+
+
+CATALOG = Catalog.parse(
+    [
+        """
+        CREATE TABLE cerner.encounter (
+            encntr_id integer primary key,
+            person_id integer,
+            active_ind integer,
+            loc_facility_cd integer
+        );
+        CREATE TABLE cerner.person (
+            person_id integer primary key,
+            birth_dt_tm timestamp
+        );
+        """
+    ]
+)
+
+VISIT = """
+name: visit_occurrence
+primary_key:
+  name: visit_occurrence_id
+  sources:
+    encounter:
+      table: encounter
+      columns:
+        encntr_id: integer
+      constraints:
+        - >-
+          encounter.active_ind = 1 or encounter.active_ind = 2
+          or encounter.active_ind = 3
+columns:
+  - name: person_id
+    tables: [encounter, person]
+    expression: person.person_id
+  - name: care_site_id
+    tables: [encounter, location]
+    constraints:
+      - location.location_cd::text = encounter.loc_facility_cd::text
+    expression: location.location_cd
+  - name: visit_start_datetime
+    tables: [encounter]
+    expression: >-
+      (select min(e.beg_effective_dt_tm) from encounter_alias e
+       where e.encntr_id = encounter.encntr_id)
+"""
+
+CLEAN = """
+name: visit_occurrence
+primary_key:
+  name: visit_occurrence_id
+  sources:
+    encounter:
+      table: encounter
+      columns:
+        encntr_id: integer
+columns:
+  - name: person_id
+    tables: [ENCOUNTER, PERSON]
+    constraints:
+      - ENCOUNTER.person_id = PERSON.person_id
+    expression: PERSON.person_id
+"""
+
+
+def checks(findings):
+    return [(f.column, f.check) for f in findings]
+
+
+def test_lint_table():
+    findings = lint_table("visit", TargetTable.parse_string(VISIT), CATALOG)
+    assert checks(findings) == [
+        ("primary_key.sources.encounter", "or-predicate"),
+        ("person_id", "cartesian"),
+        ("care_site_id", "wrapped-column"),
+        ("care_site_id", "wrapped-column"),
+        ("visit_start_datetime", "correlated-subquery"),
+    ]
+    assert findings[0].suggestion == "use `encounter.active_ind in (1, 2, 3)`"
+    expected = "add the constraint `encounter.person_id = person.person_id`"
+    assert findings[1].suggestion == expected
+    assert "encounter.loc_facility_cd" in findings[3].message
+    assert "encounter" in findings[4].message
+    assert all(f.file == "visit" for f in findings)
+
+
+def test_lint_rules():
+    rules = [("clean", TargetTable.parse_string(CLEAN))]
+    assert lint_rules(rules, CATALOG) == []
+
+    finding = Finding("visit", "person_id", "cartesian", "unjoined", "join it")
+    assert render_findings([finding]) == (
+        "visit: person_id: [cartesian] unjoined\n    join it"
+    )
+
+
+def test_lint_api():
+    client = TestClient(app)
+    table = TargetTable.parse_string(VISIT)
+    response = client.post("/api/lint", json=table.dict(by_alias=True))
+    assert response.status_code == 200
+    assert {f["check"] for f in response.json()} >= {"cartesian", "or-predicate"}
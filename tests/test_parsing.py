@@ -360,3 +360,45 @@ def test_parse_preinit_table():
     assert table.pre_init is not None
     assert len(table.pre_init) == 1
     assert table.pre_init == [TempTable(alias="baz", query="select * from foo")]
+
+
+def test_parse_primary_key_storage():
+    yaml = """
+    name: specimen_id
+    storage:
+      unlogged: true
+      fillfactor: 100
+    sources:
+      V500_SPECIMEN_PK:
+        table: V500_SPECIMEN
+        columns:
+          specimen_id: bigint
+    """
+    actual = PrimaryKey.parse_string(yaml)
+    assert actual.storage == TableStorage(unlogged=True, fillfactor=100)
+    assert actual.storage.options == (("fillfactor", "100"),)
+
+    yaml = """
+    name: specimen_id
+    storage:
+      fillfactor: 5
+    sources: {}
+    """
+    with pytest.raises(ValidationError):
+        PrimaryKey.parse_string(yaml)
+
+
+def test_parse_primary_key_watermark():
+    yaml = """
+    name: specimen_id
+    sources:
+      V500_SPECIMEN_PK:
+        table: V500_SPECIMEN
+        columns:
+          specimen_id: bigint
+        watermark:
+          column: updt_dt_tm
+    """
+    actual = PrimaryKey.parse_string(yaml)
+    watermark = actual.sources["V500_SPECIMEN_PK"].watermark
+    assert watermark == Watermark(column="updt_dt_tm", datatype="timestamp")
@@ -0,0 +1,144 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from omop_etl.generation import *
+from omop_etl.plans import *
+
+
+EXPLAINED = json.loads(Path("tests", "data", "explain_update.json").read_text())
+
+UPDATE = UpdateStatement(
+    Column("gender", Table("baz", "omop")),
+    Expression("foo.gender"),
+    Criterion([Expression("baz.id = foo.id")]),
+    [Table("foo", "cerner")],
+)
+
+
+def test_profile_from_explain():
+    profile = StatementProfile.from_explain("merge", UPDATE, 42.5, EXPLAINED)
+    assert profile.table == "omop.baz"
+    assert profile.columns == ("gender",)
+    assert profile.rows == 1000
+    assert (profile.shared_hit, profile.shared_read) == (5120, 212)
+    assert profile.node == "ModifyTable on baz"
+    assert profile.node_time == pytest.approx(41.209 - 12.874)
+
+    # statements that can't be explained are only timed
+    bounds = SelectStatement([], [Table("baz", "omop")])
+    chunked = ChunkedStatement(UPDATE, ("baz.id",), bounds, 100)
+    assert not explainable(chunked)
+    profile = StatementProfile.from_explain("merge", chunked, 10.0, None)
+    assert profile.columns == ("gender",)
+    assert profile.rows is None and profile.node is None
+
+
+def test_most_expensive_node():
+    plan = EXPLAINED[0]["Plan"]
+    loop = {
+        "Node Type": "Nested Loop",
+        "Actual Total Time": 30.0,
+        "Actual Loops": 1,
+        "Plans": [
+            {
+                "Node Type": "Index Scan",
+                "Index Name": "foo_pkey",
+                "Relation Name": "foo",
+                "Alias": "f",
+                "Actual Total Time": 0.02,
+                "Actual Loops": 1000,
+            },
+        ],
+    }
+    assert node_label(loop["Plans"][0]) == "Index Scan using foo_pkey on foo f"
+    # the index scan is fast, but runs once for every row of the loop
+    label, time = most_expensive_node(loop)
+    assert label == "Index Scan using foo_pkey on foo f"
+    assert time == pytest.approx(20.0)
+    assert len(list(iter_nodes(plan))) == 5
+
+
+def test_profiles_report(tmp_path):
+    profiles = [
+        StatementProfile.from_explain("merge", UPDATE, 42.5, EXPLAINED),
+        StatementProfile("merge", "omop.baz", ("id",), 3.0),
+        StatementProfile("copy", "omop.baz", ("alpha", "beta"), 20.25),
+    ]
+    path = tmp_path / "profile.json"
+    write_profiles(path, profiles)
+    assert read_profiles(path) == profiles
+
+    lines = render_report(profiles, top=2).splitlines()
+    assert lines[1].split() == ["45.5", "merge"]
+    assert lines[2].split() == ["20.2", "copy"]
+    statements = lines[5:]
+    assert len(statements) == 2
+    assert statements[0].split()[:7] == [
+        "42.5",
+        "1,000",
+        "5,120",
+        "212",
+        "merge",
+        "omop.baz",
+        "gender",
+    ]
+    assert statements[0].endswith("ModifyTable on baz (28.3 ms)")
+    assert "alpha, beta" in statements[1]
+
+
+ESTIMATED = json.loads(Path("tests", "data", "explain_plan.json").read_text())
+
+
+def test_planning_statements():
+    temp = CreateTempTableStatement("visit_temp", "select id from cerner.visit")
+    assert planned_query(temp) == "select id from cerner.visit"
+    assert planning_setup(temp) == (
+        "create temp table visit_temp as select id from cerner.visit with no data;"
+    )
+    assert planned_query(UPDATE) == UPDATE.to_sql()
+    assert planning_setup(UPDATE) is None
+
+    bounds = SelectStatement([], [Table("baz", "omop")])
+    chunked = ChunkedStatement(UPDATE, ("baz.id",), bounds, 100)
+    assert planned_query(chunked) == UPDATE.to_sql()
+    index = CreateIndexStatement(Table("baz", "omop"), ("id",))
+    assert planned_query(index) is None and planning_setup(index) is None
+    assert planning_setup(Statement("create schema staging;")) is not None
+    # the planning transaction is rolled back as a whole
+    assert planning_setup(Statement("begin;")) is None
+    assert planning_setup(Statement("commit;")) is None
+    assert planning_setup(Script("insert into foo values (1); commit;")) is None
+    # the mapping tables of a previous load are planned with their statistics
+    mapping = CreateTableStatement(
+        "id", Table("baz", "mapping"), [ColumnDefinition("foo_id", "integer")]
+    )
+    assert planning_setup(mapping).startswith("create table if not exists mapping.baz")
+
+
+def test_thresholds():
+    plan = ESTIMATED[0]["Plan"]
+    assert scanned_relations(plan) == {"cerner.encounter"}
+    table_rows = {"cerner.encounter": 4_000_000.0}
+
+    warnings = Thresholds().check(plan, table_rows)
+    assert len(warnings) == 2
+    assert "Hash Join estimates 80,000 rows" in warnings[0]
+    assert warnings[1] == "sequential scan on cerner.encounter of 4,000,000 rows"
+
+    thresholds = Thresholds(max_cost=1000, row_explosion=100, seq_scan_rows=1e7)
+    assert thresholds.check(plan, table_rows) == ["cost 98,211 exceeds 1,000"]
+
+
+def test_render_estimates():
+    estimate = StatementEstimate.from_explain(
+        "merge", UPDATE, ESTIMATED, Thresholds(), {"cerner.encounter": 4e6}
+    )
+    assert (estimate.cost, estimate.rows) == (98210.75, 80000)
+    quiet = StatementEstimate("copy", "omop.baz", ("alpha",), 10.0, 100)
+
+    lines = render_estimates([quiet, estimate]).splitlines()
+    assert lines[1].split() == ["98,211", "80,000", "!", "merge", "omop.baz", "gender"]
+    assert lines[2].split() == ["10", "100", "copy", "omop.baz", "alpha"]
+    assert lines[4:] == ["merge gender", *(f"  {w}" for w in estimate.warnings)]
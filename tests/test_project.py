@@ -0,0 +1,41 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from omop_etl.cache import CompileCache
+from omop_etl.project import RuleFile, iter_compile
+from omop_etl.schema import *
+
+
+RULES = Path("tests", "rules")
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"FuseUpdates": True}, {"Mode": CompileMode.insert, "ChunkSize": 10}],
+)
+def test_compile_concurrently(options):
+    expected = "".join(iter_compile(RuleFile.load(RULES, CompileCache()), options))
+
+    files = RuleFile.load(RULES, CompileCache())
+    with ProcessPoolExecutor(2) as executor:
+        actual = "".join(iter_compile(files, options, executor))
+    assert actual == expected
+    # the rules were only parsed by the workers
+    assert all(f._rule is None for f in files)
+    assert [f.table_name for f in files].count("baz") > 1
+
+
+def test_compile_concurrently_cached(tmp_path):
+    expected = "".join(iter_compile(RuleFile.load(RULES, CompileCache()), {}))
+
+    cache = CompileCache(tmp_path)
+    with ProcessPoolExecutor(2) as executor:
+        files = RuleFile.load(RULES, cache)
+        assert "".join(iter_compile(files, {}, executor)) == expected
+
+    # the entries written by the workers are read by a single process
+    cache = CompileCache(tmp_path)
+    assert "".join(iter_compile(RuleFile.load(RULES, cache), {})) == expected
+    assert cache.misses == 0
@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 
+import pandas as pd
 import pytest
 from omop_etl import TargetTable
 from pandas.api.types import is_numeric_dtype
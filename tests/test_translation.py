@@ -209,6 +209,36 @@ def test_translate_foreign_key(baz_pk_env):
     assert isinstance(actual.column, Column)
 
 
+def test_translate_column_redundant_tables(baz_pk_env):
+    col = TargetColumn(
+        name="alpha",
+        primary_key="foo_pk",
+        tables=["foo", "bar", "cerner.foo", "qux"],
+        constraints=["BAR.foo_id = foo.id"],
+        expression="bar.staff_id",
+    )
+    assert col.redundant_tables(baz_pk_env, baz_pk_env["PrimaryKeyConstraints"]) == {
+        2: 'Table "foo" is listed twice',
+        3: 'Table "qux" is not used',
+    }
+
+    [actual], env = col.translate(baz_pk_env)
+    assert actual.source == (
+        Table("baz", "mapping"),
+        Table("foo", "cerner"),
+        Table("bar", "cerner"),
+    )
+
+    [actual], env = col.translate({**baz_pk_env, "PruneTables": False})
+    assert len(actual.source) == 5
+
+    # an unqualified column could be of any of the tables
+    col = TargetColumn(
+        name="alpha", primary_key="foo_pk", tables=["foo", "qux"], expression="staff_id"
+    )
+    assert col.redundant_tables(baz_pk_env, baz_pk_env["PrimaryKeyConstraints"]) == {}
+
+
 def compare_sql(expected, actual):
     expected = trim_whitespace(expected).lower()
     actual = trim_whitespace(actual).lower()
@@ -397,3 +427,193 @@ def test_translate_disabled_cols_table():
     copy_table.columns[1].enabled = True
     statements, _ = copy_table.translate()
     assert len(statements) == 5
+
+
+def test_translate_fused_updates():
+    join_table = load_table("join.yaml")
+    env = join_table.default_env
+    env["FuseUpdates"] = True
+    statements, _ = join_table.translate(env)
+    assert len(statements) == 4
+
+    actual = statements[-1]
+    assert isinstance(actual, UpdateStatement)
+    assert actual.columns == ("alpha", "beta", "gamma")
+
+    merge_table = load_table("merge.yaml")
+    env = merge_table.default_env
+    env["FuseUpdates"] = True
+    statements, _ = merge_table.translate(env)
+    updates = [s for s in statements if isinstance(s, UpdateStatement)]
+    assert [s.columns for s in updates] == [
+        ("alpha", "beta", "gamma"),
+        ("alpha", "beta", "gamma"),
+    ]
+
+
+def test_translate_rows():
+    copy_table = load_table("copy.yaml")
+    statements, _ = copy_table.translate(mode=CompileMode.insert)
+    assert len(statements) == 3
+    assert not any(isinstance(s, UpdateStatement) for s in statements)
+
+    actual = statements[-1]
+    assert isinstance(actual, InsertFromStatement)
+    assert actual.columns == ("id", "alpha", "beta")
+    assert actual.target == Table("baz", "omop")
+    expected = ("mapping.baz.id", "baz_0.alpha", "baz_1.beta")
+    assert actual.source.expressions == expected
+    assert [type(t) for t in actual.source.source] == [Table, Join, Join]
+
+
+def test_translate_rows_overlapping_columns():
+    merge_table = load_table("merge.yaml")
+    statements, _ = merge_table.translate_rows()
+    assert len(statements) == 1
+
+    actual = statements[0]
+    assert actual.columns == ("id", "alpha", "beta", "gamma")
+    expected = "case when baz_1.id is not null then baz_1.alpha when baz_0.id is not null then baz_0.alpha end"
+    assert actual.source.expressions[1] == expected
+    # columns that share the same source are selected by the same subquery
+    assert len(actual.source.source) == 3
+
+    constant_table = load_table("constant.yaml")
+    statements, _ = constant_table.translate_rows()
+    expected = "insert into omop.baz (id, alpha, beta, gamma) select mapping.baz.id, 'alpha', '1', '2' from mapping.baz;"
+    assert statements[0].to_sql() == expected
+
+
+def test_translate_staged():
+    copy_table = load_table("copy.yaml")
+    staging, assemble, _ = copy_table.translate_staged()
+    assert [s.alias for s in staging] == ["baz_0", "baz_1"]
+    assert all(s.schema == "staging" for s in staging)
+    expected = "drop table if exists staging.baz_0;\ncreate unlogged table staging.baz_0 as select distinct on (mapping.baz.id) mapping.baz.id as id, foo.alpha as alpha"
+    assert staging[0].to_sql().startswith(expected)
+
+    insert, *drops = assemble
+    assert isinstance(insert, InsertFromStatement)
+    assert insert.source.expressions == ("mapping.baz.id", "baz_0.alpha", "baz_1.beta")
+    joins = insert.source.source[1:]
+    assert [j.table for j in joins] == [
+        Table("baz_0", "staging"),
+        Table("baz_1", "staging"),
+    ]
+    assert drops == [
+        DropTableStatement(Table("baz_0", "staging")),
+        DropTableStatement(Table("baz_1", "staging")),
+    ]
+
+    statements, _ = copy_table.translate(mode=CompileMode.staged)
+    assert statements[-5:] == [*staging, *assemble]
+    # the staging tables can be created in a new database
+    assert statements[0].to_sql() == "create schema if not exists staging;"
+
+
+def test_translate_incremental():
+    copy_table = load_table("copy.yaml")
+    source = copy_table.primary_key.sources["foo_pk"]
+    source.watermark = Watermark(column="updt_dt_tm")
+    env = copy_table.default_env
+    env["Incremental"] = True
+    env["DropTables"] = True
+    statements, _ = copy_table.translate(env)
+    sql = [s.to_sql() for s in statements]
+
+    assert sql[0].startswith("create table if not exists mapping.etl_watermark")
+    expected = "insert into mapping.etl_watermark (target_table, source, pending) select 'baz', 'foo_pk', max(foo.updt_dt_tm)::text from cerner.foo on conflict (target_table, source) do update set pending = excluded.pending;"
+    assert sql[1] == expected
+    assert sql[2].startswith("create table if not exists mapping.baz")
+    expected = "create unique index if not exists baz_foo_id_key on mapping.baz using btree (foo_id);"
+    assert sql[3] == expected
+    assert sql[4].endswith("on conflict do nothing;")
+    assert "mapping.etl_watermark.value::timestamp >= foo.updt_dt_tm" in sql[4]
+    assert "mapping.baz.id > (select coalesce(max(omop.baz.id), 0)" in sql[5]
+
+    updates = [s for s in statements if isinstance(s, UpdateStatement)]
+    watermark = "mapping.etl_watermark.value::timestamp >= cerner.foo.updt_dt_tm"
+    assert all(watermark in u.to_sql() for u in updates[:-1])
+    expected = "update mapping.etl_watermark set value = pending where (mapping.etl_watermark.target_table = 'baz');"
+    assert sql[-1] == expected
+
+    with pytest.raises(ValueError):
+        env = {**copy_table.default_env, "Incremental": True}
+        copy_table.translate(env, mode=CompileMode.insert)
+
+
+def test_translate_incremental_constants():
+    constant_table = load_table("constant.yaml")
+    env = {**constant_table.default_env, "Incremental": True}
+    statements, _ = constant_table.translate(env)
+    updates = [s.to_sql() for s in statements if isinstance(s, UpdateStatement)]
+    # the rows of the previous loads are left alone
+    expected = "update omop.baz set alpha = 'alpha' where (omop.baz.alpha is distinct from 'alpha');"
+    assert updates[0] == expected
+
+
+def test_translate_mapping_storage(baz_env):
+    pk = PrimaryKey(
+        name="id",
+        sources={"PK": PrimaryKeySource(name="PK", table="foo", columns={"id": "int"})},
+        storage=TableStorage(fillfactor=90, bulk_load=True),
+    )
+    baz_env["MappingStorage"] = TableStorage(unlogged=True, fillfactor=100)
+
+    stmts, env = pk.translate(baz_env)
+    assert stmts[0] == Statement("begin;")
+    assert stmts[-1] == Statement("commit;")
+
+    create = stmts[1]
+    assert isinstance(create, CreateTableStatement)
+    assert create.unlogged
+    assert create.options == (("fillfactor", "90"),)
+
+
+def test_translate_mapping_indexes(baz_env):
+    pk = PrimaryKey(
+        name="id",
+        sources={
+            "PK1": PrimaryKeySource(name="PK1", table="foo", columns={"id": "int"}),
+            "PK2": PrimaryKeySource(
+                name="PK2", table="bar", columns={"code": "varchar(20)"}
+            ),
+        },
+    )
+    baz_env["IndexMapping"] = True
+    stmts, env = pk.translate(baz_env)
+
+    mapping = Table("baz", "mapping")
+    expected = [
+        CreateIndexStatement(mapping, ("foo_id",), method="btree"),
+        CreateIndexStatement(mapping, ("bar_code",), method="hash"),
+        AnalyzeStatement(mapping),
+    ]
+    # the indexes are built once the keys have been inserted
+    assert stmts[3:6] == expected
+    assert isinstance(stmts[2], InsertFromStatement)
+
+
+def test_translate_chunked_table():
+    merge_table = load_table("merge.yaml")
+    env = merge_table.default_env
+    env["ChunkSize"] = 500
+    statements, _ = merge_table.translate(env)
+
+    inserts = [s for s in statements if isinstance(s, ChunkedStatement)][:2]
+    assert [s.keys for s in inserts] == [("foo.id",), ("bar.id",)]
+    assert CreateIndexStatement(
+        Table("baz", "omop"), ("id",), if_not_exists=True
+    ) in statements
+
+    updates = statements[-6:]
+    assert all(isinstance(s, ChunkedStatement) for s in updates)
+    assert updates[0].keys == ("omop.baz.id", "mapping.baz.id")
+    assert updates[0].size == 500
+
+
+def test_translate_chunked_text_key(baz_env):
+    baz_env["ChunkSize"] = 500
+    pk = PrimaryKeySource(name="PK", table="foo", columns={"code": "varchar(10)"})
+    stmts, _ = pk.translate(baz_env)
+    assert isinstance(stmts[0], InsertFromStatement)
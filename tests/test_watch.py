@@ -0,0 +1,97 @@
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from omop_etl.constraints import Constraints
+from omop_etl.project import RuleFile, compile_rules
+from omop_etl.watch import IncrementalCompiler, _poll_changes
+
+
+RULES = Path("tests", "rules")
+
+CONSTRAINTS = """
+ALTER TABLE omop.baz ADD CONSTRAINT xpk_baz PRIMARY KEY (id);
+"""
+
+
+def copy_rules(tmp_path: Path) -> Path:
+    rules = tmp_path / "rules"
+    shutil.copytree(RULES, rules)
+    (tmp_path / "sql").mkdir()
+    return rules
+
+
+def test_incremental_compile(tmp_path):
+    rules = copy_rules(tmp_path)
+    output = tmp_path / "sql" / "etl.sql"
+    options = {"DropTables": False}
+    compiler = IncrementalCompiler(rules, tmp_path / "sql", options)
+    assert len(compiler.update()) == len(list(rules.iterdir()))
+    assert output.read_text() == compile_rules(rules, options)[0]
+
+    # an unchanged directory leaves the script alone
+    os.utime(output, (0, 0))
+    assert compiler.update() == []
+    assert output.stat().st_mtime == 0
+
+    # the tables depending on a changed dependency are translated again
+    dep = rules / "dep.yaml"
+    dep.write_text(dep.read_text().replace("temp_table_4", "temp_table_5"))
+    assert sorted(compiler.update()) == ["custom_query", "dep"]
+    assert "temp_table_5" in output.read_text()
+    assert output.read_text() == compile_rules(rules, options)[0]
+
+    (rules / "copy.yaml").unlink()
+    assert compiler.update() == []
+    assert output.read_text() == compile_rules(rules, options)[0]
+
+
+def test_incremental_compile_invalid(tmp_path):
+    rules = copy_rules(tmp_path)
+    output = tmp_path / "sql" / "etl.sql"
+    compiler = IncrementalCompiler(rules, tmp_path / "sql", dict())
+    compiler.update()
+    script = output.read_text()
+
+    # the previous version of a broken rule is kept until it is fixed
+    path = rules / "merge.yaml"
+    content = path.read_text()
+    path.write_text(f"{content}\n[")
+    assert compiler.update() == []
+    assert list(compiler.errors) == ["merge"]
+    assert output.read_text() == script
+
+    path.write_text(content)
+    assert compiler.update() == ["merge"]
+    assert compiler.errors == dict()
+    assert output.read_text() == script
+
+
+def test_incremental_compile_files(tmp_path):
+    rules = copy_rules(tmp_path)
+    path = tmp_path / "constraints.sql"
+    path.write_text(CONSTRAINTS)
+    compiler = IncrementalCompiler(
+        rules,
+        tmp_path / "sql",
+        dict(),
+        one_file=False,
+        constraints=Constraints.load([path]),
+    )
+    compiler.update()
+    for file in RuleFile.load(rules, compiler.cache):
+        expected = file.translate_script(dict())
+        assert (tmp_path / "sql" / f"{file.name}.sql").read_text() == expected
+    assert "xpk_baz" in (tmp_path / "sql" / "post_load.sql").read_text()
+
+    (rules / "merge.yaml").unlink()
+    compiler.update()
+    assert not (tmp_path / "sql" / "merge.sql").exists()
+
+
+def test_poll_changes(tmp_path):
+    changes = _poll_changes(tmp_path, 0.01)
+    path = tmp_path / "rule.yaml"
+    threading.Timer(0.05, path.write_text, ["name: rule"]).start()
+    assert next(changes) == {path}
@@ -0,0 +1,49 @@
+import gzip
+import os
+
+import pytest
+
+from omop_etl.writer import ScriptWriter, write_if_changed
+from omop_etl.schema import *
+
+from tests.test_translation import load_table
+
+
+def test_script_writer(tmp_path):
+    path = tmp_path / "etl.sql"
+    with ScriptWriter(path) as writer:
+        writer.write_all(["select 1;", "\n", "select 2;\n"])
+    assert path.read_text() == "select 1;\nselect 2;\n"
+
+    # an unchanged script is not replaced
+    os.utime(path, (0, 0))
+    write_if_changed(path, "select 1;\nselect 2;\n")
+    assert path.stat().st_mtime == 0
+    write_if_changed(path, "select 3;\n")
+    assert path.read_text() == "select 3;\n"
+
+    with pytest.raises(RuntimeError):
+        with ScriptWriter(path) as writer:
+            writer.write("select 4;\n")
+            raise RuntimeError()
+    assert path.read_text() == "select 3;\n"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_script_writer_gzip(tmp_path):
+    path = tmp_path / "etl.sql.gz"
+    write_if_changed(path, "select 1;\n", compress=True)
+    content = path.read_bytes()
+    assert gzip.decompress(content) == b"select 1;\n"
+
+    # the same script compresses to the same bytes
+    path.unlink()
+    write_if_changed(path, "select 1;\n", compress=True)
+    assert path.read_bytes() == content
+
+
+def test_iter_script():
+    table = load_table("merge.yaml")
+    statements = list(table.iter_script())
+    assert len(statements) > 2
+    assert "\n".join(statements) == table.get_script()